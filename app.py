@@ -2,8 +2,12 @@
 # This is the main backend server for your application.
 
 # --- Required Imports ---
+import json         # To parse trigger datagrams from stations in UDP mode
+import os           # To read the number of simulated stations to accept
+import signal       # To shut down cleanly (and save the rooms) on 'kill'
 import socket       # For networking, specifically UDP multicast
-import threading    # To run the UDP broadcast and game timers
+import sys          # To exit from the signal handler
+import threading    # To run the UDP broadcast and trigger listener threads
 import time         # To pause threads (e.g., for game sequence timing)
 
 # --- Flask and Web-related Imports ---
@@ -13,18 +17,43 @@ from flask import Flask, request, jsonify, render_template
 # jsonify: Creates a properly formatted JSON response
 # render_template: Finds and sends your 'index.html' file to the browser
 
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 # SocketIO: Enables real-time, two-way communication with the web browser
 # emit: Used to send SocketIO messages
+# join_room: Adds a browser to the SocketIO room of the game it is watching
+
+# --- Logging and Metrics ---
+from log import INFO, WARNING, dropped_count, get_logger, setup_logging # Structured, non-blocking logging
+import metrics # In-process counters and histograms, exposed on '/metrics'
 
 # --- Game Logic Import ---
-from game import Game  # Import the Game class from our new 'game.py' file
+from rooms import RoomRegistry, room_key, socketio_room_name  # Maps each room ID to its own Game and boards
+from journal import Journal # Append-only record of every game, for recovery and analysis
+from snapshot import SnapshotWriter, read_snapshot # Saves every room for a warm restart
+from leaderboard import Leaderboard, leaderboard_answer, parse_day # The level every finished game reached, in SQLite
+from playback import LEVEL_COMPLETE_PAUSE_SECONDS, SequencePlayback, playback_duration # Sends a sequence's flashes from the shared timer
+from protocol import SIMULATED_CHIP_ID_BASE, TRIGGER_PACKET_SIZE, is_binary_trigger, parse_json_trigger, parse_trigger # The compact binary trigger packet
+from tracing import trace_buffer # Per-hop latency traces for every trigger, queried on '/traces'
 
 # --- Configuration for Auto-Discovery ---
 # These must match the settings on your ESP8266
 MULTICAST_GROUP = '224.1.1.1'
 MULTICAST_PORT = 5007
 SERVER_MESSAGE = b'ESP8266_SERVER_HERE' # The "secret message" the ESP listens for
+# Seconds between two discovery packets. For the first few seconds after the
+# server starts they go out much faster: a station that lost the server
+# while it restarted finds it again straight away, not up to 5 seconds later.
+DISCOVERY_INTERVAL = 5
+DISCOVERY_STARTUP_INTERVAL = 0.25
+DISCOVERY_STARTUP_SECONDS = 5
+
+# --- Configuration for the UDP Trigger Transport ---
+# Stations in UDP mode send their triggers to this port on the server
+TRIGGER_PORT = 5008
+MAX_TRIGGER_PACKET_SIZE = 512 # Bigger than any trigger a station sends
+
+# The most triggers one request to '/data/batch' may carry
+MAX_BATCH_SIZE = 256
 
 # --- Application Setup ---
 # Initialize the Flask app
@@ -37,6 +66,35 @@ app = Flask(__name__)
 # This is far more robust and avoids dependency issues.
 socketio = SocketIO(app)
 
+# The logger for everything in this file
+log = get_logger('app')
+
+# --- Metrics ---
+# How long it takes to handle one station request or datagram, by transport
+# ('http_json', 'http_binary', 'http_batch', 'udp')
+INGEST_SECONDS = metrics.histogram(
+    'boxbots_ingest_seconds',
+    'Time to handle one station request or datagram, by transport.'
+)
+# How long each SocketIO emit to a room takes, by event name
+SOCKETIO_EMIT_SECONDS = metrics.histogram(
+    'boxbots_socketio_emit_seconds',
+    'Time spent in one SocketIO emit to a room, by event.'
+)
+# How long showing a sequence really takes, and how much longer than the
+# sleeps it is made of (1.5s + 1s per flash)
+SEQUENCE_PLAYBACK_SECONDS = metrics.histogram(
+    'boxbots_sequence_playback_seconds',
+    'Wall time of one sequence playback, from SHOWING to PLAYER_TURN.',
+    buckets=(2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+)
+SEQUENCE_PLAYBACK_OVERRUN_SECONDS = metrics.histogram(
+    'boxbots_sequence_playback_overrun_seconds',
+    'How much longer a sequence playback took than its nominal sleeps.'
+)
+# Log lines lost because the console couldn't keep up
+metrics.gauge('boxbots_log_records_dropped', 'Log records dropped because the log queue was full.', dropped_count)
+
 # --- Game & Board Management ---
 
 # This dictionary maps your specific, hard-coded chip IDs to their colors.
@@ -47,13 +105,49 @@ BOARD_COLOR_MAP = {
     "9132077": "blue"
 }
 
-# This dictionary will store the *active* boards that have connected.
-# Example: { "123456": "red", "789012": "green" }
-connected_boards = {}
-
-# This is the global instance of our game logic.
+# For load testing without real boxes: set BOXBOTS_SIMULATED_STATIONS=N to
+# also accept the N virtual stations played by 'simulate_stations.py'.
+# They get the four colors in turn.
+for i in range(int(os.environ.get('BOXBOTS_SIMULATED_STATIONS', '0'))):
+    BOARD_COLOR_MAP[str(SIMULATED_CHIP_ID_BASE + i)] = ("green", "red", "yellow", "blue")[i % 4]
+
+# Set BOXBOTS_AVOID_REPEATS=1 so a sequence never asks for the same board
+# twice in a row (with only a few boards, repeats are very common).
+AVOID_REPEATS = os.environ.get('BOXBOTS_AVOID_REPEATS') == '1'
+
+# Triggers from one board less than this many milliseconds apart are
+# dropped as noise (a station's own debounce is 1.5 s, so real hits are
+# never this close). Retried triggers, with a 'seq' already seen, are
+# always dropped. Set BOXBOTS_DEBOUNCE_MS=0 to let load tests through.
+DEBOUNCE_SECONDS = int(os.environ.get('BOXBOTS_DEBOUNCE_MS', '150')) / 1000.0
+
+# Set BOXBOTS_JOURNAL_DIR to a directory to record every game in a journal
+# there (see 'journal.py'). Without it, games are only kept in memory.
+JOURNAL_DIR = os.environ.get('BOXBOTS_JOURNAL_DIR')
+
+# Set BOXBOTS_SNAPSHOT_PATH to a file to save every room there every second,
+# and to carry on with those rooms (boards, games and turns) after a
+# restart (see 'snapshot.py').
+SNAPSHOT_PATH = os.environ.get('BOXBOTS_SNAPSHOT_PATH')
+
+# Set BOXBOTS_LEADERBOARD_PATH to a SQLite file to keep the level every
+# finished game reached, and show the best ones on the page (see
+# 'leaderboard.py'). Without it, '/leaderboard' answers 404.
+LEADERBOARD_PATH = os.environ.get('BOXBOTS_LEADERBOARD_PATH')
+
+# This is the global registry of game rooms. Each room has its own Game,
+# its own set of connected boards and its own SocketIO room, so one server
+# process can run many games at once.
 # It is initialized in the 'main' block at the bottom.
-game_instance = None
+room_registry = None
+
+# The leaderboard, or None. Also initialized in the 'main' block.
+leaderboard = None
+
+# { sid: room_id } for every connected browser, so we know which room it
+# leaves when it switches to another room or disconnects. The room itself
+# may not exist (yet): watching a room never creates it.
+watched_rooms = {}
 
 # --- UDP Multicast Thread (For Auto-Discovery) ---
 def send_discovery_packets():
@@ -62,22 +156,211 @@ def send_discovery_packets():
     Its only job is to "shout" a message onto the network every 5 seconds
     so the ESP8266 can find this server's IP address.
     """
+    started_at = time.monotonic()
     # Create a standard UDP socket
     multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     # Set the "Time To Live" (TTL) for the packet. 2 means it can cross routers.
     multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
 
-    print("Starting discovery broadcast thread...")
+    log.info('discovery_started', group=MULTICAST_GROUP, port=MULTICAST_PORT)
     while True:
         try:
             # Send the secret message to the multicast group and port
             multicast_socket.sendto(SERVER_MESSAGE, (MULTICAST_GROUP, MULTICAST_PORT))
-            print("Sending discovery packet...")
+            log.debug('discovery_packet_sent')
         except Exception as e:
-            print(f"Error sending discovery packet: {e}")
+            log.warning('discovery_packet_failed', error=e)
         
-        # Wait 5 seconds before sending the next packet
-        time.sleep(5)
+        # Wait before sending the next packet
+        time.sleep(discovery_interval(started_at))
+
+def discovery_interval(started_at):
+    """
+    Seconds to wait before the next discovery packet, for a loop that
+    started at 'started_at' (time.monotonic()).
+    """
+    if time.monotonic() - started_at < DISCOVERY_STARTUP_SECONDS:
+        return DISCOVERY_STARTUP_INTERVAL
+    return DISCOVERY_INTERVAL
+
+# --- UDP Trigger Listener (Fast Station Transport) ---
+def listen_for_udp_triggers():
+    """
+    This function runs in a separate, continuous background thread.
+    Stations in UDP mode send each trigger as ONE small datagram (a binary
+    trigger packet, or the same JSON they would POST to '/data') instead of
+    opening a new TCP connection and waiting for an HTTP response. Every
+    datagram goes through exactly the same path as '/data' ('handle_trigger').
+    """
+    trigger_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    trigger_socket.bind(('0.0.0.0', TRIGGER_PORT))
+
+    # One reusable receive buffer, read in place through a memoryview
+    buffer = bytearray(MAX_TRIGGER_PACKET_SIZE)
+    view = memoryview(buffer)
+
+    log.info('udp_trigger_listener_started', port=TRIGGER_PORT)
+    while True:
+        size, address = trigger_socket.recvfrom_into(buffer)
+        packet = view[:size]
+        try:
+            with INGEST_SECONDS.time(transport='udp'):
+                if is_binary_trigger(packet):
+                    # UDP has no response, so we don't need the result
+                    handle_binary_trigger(packet)
+                else:
+                    # Raises ValueError if a field has the wrong type
+                    handle_json_trigger(json.loads(packet.tobytes()))
+        except (ValueError, TypeError, AttributeError) as e:
+            # One bad datagram must never stop this thread, or every
+            # trigger after it would be lost
+            log.sampled(WARNING, 'malformed_trigger_datagram', source=address[0], error=e)
+
+# --- Trigger Handling (Shared by every station transport) ---
+
+def handle_trigger(chip_id, room_id, distance, message=None, seq=None, station_ms=None):
+    """
+    Handles one trigger from a station, whichever way it arrived
+    (HTTP POST to '/data' or a UDP datagram, as JSON or binary).
+    Returns False if the trigger was ignored (unknown board), True otherwise.
+
+    This function handles:
+    1. Registering new boards that connect *if* they are in the map.
+    2. Emitting the 'new_message' for the UI to flash the square.
+    3. Passing the input to the game logic if it's the player's turn.
+
+    Every step happens in the room named by 'room_id'
+    (stations that don't send one play in the default room).
+    'message' is what the browsers receive in 'new_message'; it is only
+    built here (for binary triggers) when a flash is actually sent.
+    'seq' and 'station_ms' are the station's own counter and clock, if it
+    sent them; they are only recorded in the trigger's trace.
+    """
+    # Only known boards will trigger flashes and game logic.
+    if chip_id not in BOARD_COLOR_MAP:
+        if chip_id != 'Unknown':
+            # This is an unknown board, we ignore it
+            log.sampled(INFO, 'unknown_board_ignored', chip_id=chip_id)
+        # We don't proceed to flash or use game logic for unknown boards
+        return False
+
+    # Find (or create) the room this station plays in
+    room = room_registry.get_or_create(room_id)
+
+    # A retry or a noisy repeated reading is answered like any trigger,
+    # but goes no further (no trace, no game input, no flash)
+    if room.drop_trigger(chip_id, distance, seq) is not None:
+        return True
+
+    # Every trigger that flashes a square is traced, hop by hop, until the
+    # browsers acknowledge the flash (see 'tracing.py')
+    trace = None
+    if distance > 0.0:
+        trace = trace_buffer.start(chip_id, room.room_id, seq, station_ms)
+
+    # --- 1. Board Registration + 3. Game Logic ---
+    # The room registers the board if it's new and, if it's the
+    # player's turn, passes the chipId to the game logic.
+    board_added, result = room.process_trigger(chip_id, BOARD_COLOR_MAP[chip_id], distance, seq)
+    if trace is not None:
+        trace.result = result
+        trace.hop('processed')
+
+    if board_added:
+        # Send the complete, updated list to every web browser
+        # watching this room.
+        # This is the command that makes the boards appear.
+        emit_to_room(room, 'update_boards', room.connected_boards)
+
+    # --- 2. This is the REAL-TIME flash part ---
+    # We only want to flash if the distance is *not* 0
+    # (0.0 is our special registration packet)
+    if distance > 0.0:
+        if message is None:
+            message = {'chipId': chip_id, 'distance': distance}
+            if seq is not None:
+                message['seq'] = seq
+        # The browsers send this back in 'trace_ack' once they've flashed
+        # (a new dict, so the caller's request data is left as it was)
+        message = {**message, 'traceId': trace.trace_id}
+        # Send a message (we'll call it 'new_message') to every web
+        # browser watching this room. The front-end uses this to trigger
+        # the green flash animation *every* time a board is hit.
+        emit_to_room(room, 'new_message', message)
+        trace.hop('emitted')
+
+    # Act based on the result from the game logic
+    _emit_game_result(room, result)
+
+    return True
+
+def handle_json_trigger(data):
+    """
+    Handles one JSON trigger (the format 'client.ino' POSTs by default).
+    Returns (response_dict, status_code). Raises ValueError if the trigger
+    is not valid (see 'protocol.parse_json_trigger').
+    """
+    # Check every field's type first (chipId comes back as a string)
+    chip_id, room_id, distance, seq, station_ms = parse_json_trigger(data)
+
+    if not handle_trigger(chip_id, room_id, distance, data, seq, station_ms):
+        return {"status": "success", "message": "Ignored unknown board"}, 200
+    return {"status": "success", "received_data": data}, 200
+
+def handle_binary_trigger(packet):
+    """
+    Handles one binary trigger packet (see 'protocol.py').
+    The fields are read straight out of the packet, with no JSON and no
+    dictionary in between. Raises ValueError if the packet is not valid.
+    """
+    chip_id, room_id, distance, seq, station_ms = parse_trigger(packet)
+    return handle_trigger(chip_id, room_id, distance, seq=seq, station_ms=station_ms)
+
+def handle_trigger_batch(triggers, room_id=None):
+    """
+    Handles a list of JSON triggers in order, as if each one had been
+    POSTed to '/data' on its own. Triggers without their own 'roomId' use
+    the batch's 'room_id'. Returns a summary dictionary of the results.
+    A trigger with the wrong field types is counted as invalid before
+    anything is done with it, so the rest of the batch still goes through.
+    """
+    summary = {"status": "success", "received": len(triggers), "processed": 0, "ignored": 0, "invalid": 0}
+    for data in triggers:
+        try:
+            chip_id, trigger_room_id, distance, seq, station_ms = parse_json_trigger(data, room_id)
+        except ValueError:
+            summary["invalid"] += 1
+            continue
+
+        if handle_trigger(chip_id, trigger_room_id, distance, data, seq, station_ms):
+            summary["processed"] += 1
+        else:
+            summary["ignored"] += 1
+    return summary
+
+def handle_binary_trigger_batch(buffer):
+    """
+    Handles back-to-back binary trigger packets in order, reading each one
+    in place at its offset. Returns a summary dictionary of the results.
+    Raises ValueError if the buffer isn't a whole number of packets.
+    """
+    if len(buffer) % TRIGGER_PACKET_SIZE:
+        raise ValueError("Batch is not a whole number of trigger packets")
+
+    count = len(buffer) // TRIGGER_PACKET_SIZE
+    summary = {"status": "success", "received": count, "processed": 0, "ignored": 0, "invalid": 0}
+    for offset in range(0, len(buffer), TRIGGER_PACKET_SIZE):
+        try:
+            chip_id, room_id, distance, seq, station_ms = parse_trigger(buffer, offset)
+        except ValueError:
+            summary["invalid"] += 1
+            continue
+
+        if handle_trigger(chip_id, room_id, distance, seq=seq, station_ms=station_ms):
+            summary["processed"] += 1
+        else:
+            summary["ignored"] += 1
+    return summary
 
 # --- Flask Web Server Routes ---
 
@@ -86,95 +369,127 @@ def receive_data():
     """
     This is the API endpoint that the ESP8266 sends its JSON data to.
     It's only ever contacted by the ESP, not by the browser.
-    
-    This function now handles:
-    1. Registering new boards that connect *if* they are in the map.
-    2. Emitting the 'new_message' for the UI to flash the square.
-    3. Passing the input to the game logic if it's the player's turn.
+    The actual work is done by 'handle_trigger'.
+
+    Stations can send either JSON or a compact binary trigger packet
+    ('Content-Type: application/octet-stream', see 'protocol.py').
     """
-    if request.is_json:
-        # Parse the JSON data sent from the ESP8266
-        data = request.get_json()
-
-        # Read the new chipId field from the JSON.
-        chip_id = str(data.get('chipId', 'Unknown')) # Ensure chipId is a string
-
-        # --- 1. Board Registration ---
-        # Check if the chipId is one of our known boards
-        if chip_id in BOARD_COLOR_MAP:
-            # Check if it's not already in our 'active' list
-            if chip_id not in connected_boards:
-                # This is a known board connecting for the first time
-                new_color = BOARD_COLOR_MAP[chip_id]
-                connected_boards[chip_id] = new_color
-                
-                print("=========================")
-                print(f"  KNOWN BOARD CONNECTED: {chip_id}")
-                print(f"  Assigned color: {new_color}")
-                print("=========================")
-                
-                # Update the game logic with the new list of active board IDs
-                game_instance.set_available_boards(connected_boards.keys())
-                
-                # Send the complete, updated list to ALL web browsers
-                # This is the command that makes the boards appear.
-                socketio.emit('update_boards', connected_boards)
-        elif chip_id != 'Unknown':
-            # This is an unknown board, we ignore it
-            print(f"Ignoring data from unknown board: {chip_id}")
-            # We don't proceed to flash or use game logic for unknown boards
-            return jsonify({"status": "success", "message": "Ignored unknown board"}), 200
-
-        # If the chipId is unknown, the rest of the function is skipped.
-        # Only known boards will trigger flashes and game logic.
-        if chip_id not in BOARD_COLOR_MAP:
-             return jsonify({"status": "success", "message": "Ignored unknown board"}), 200
-
-        # Print the data to your Python server console (optional)
-        # This will show all messages, including the 0.0 registration
-        print(f"[Data from {chip_id}] Dist: {data.get('distance')} cm")
-        
-        # --- 2. This is the REAL-TIME flash part ---
-        # We only want to flash if the distance is *not* 0
-        # (0.0 is our special registration packet)
-        if data.get('distance', 0.0) > 0.0:
-            # Send a message (we'll call it 'new_message') to ALL connected
-            # web browsers. The front-end uses this to trigger the green flash
-            # animation *every* time a board is hit.
-            socketio.emit('new_message', data)
-        
-            # --- 3. Game Logic Integration ---
-            # Check if the game is currently waiting for player input
-            if game_instance.state == 'PLAYER_TURN':
-                # Pass the chipId to the game logic and get the result
-                result = game_instance.check_player_input(chip_id)
-                
-                # Act based on the result from the game logic
-                if result == 'WRONG':
-                    # Player made a mistake
-                    socketio.emit('game_update', {
-                        'status': 'GAME_OVER',
-                        'level': game_instance.get_current_level(),
-                        'reason': 'wrong_input'
-                    })
-                
-                elif result == 'LEVEL_COMPLETE':
-                    # Player finished the sequence correctly
-                    # We start a background task to avoid blocking the server
-                    # This task will pause, then start the next level
-                    socketio.start_background_task(target=_handle_next_level)
-                    
-                elif result == 'CORRECT':
-                    # Player input was correct, but the sequence isn't finished
-                    # We can send a small update, e.g., to play a sound
-                    socketio.emit('game_update', {'status': 'CORRECT_INPUT'})
-        
+    if request.mimetype == 'application/octet-stream':
+        # Read the packet in place, without copying or decoding it
+        try:
+            with INGEST_SECONDS.time(transport='http_binary'):
+                handle_binary_trigger(memoryview(request.get_data()))
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid trigger packet"}), 400
+        # Binary stations don't need anything echoed back
+        return '', 204
+    elif request.is_json:
+        with INGEST_SECONDS.time(transport='http_json'):
+            # Parse the JSON data sent from the ESP8266
+            data = request.get_json()
+
+            try:
+                response, status_code = handle_json_trigger(data)
+            except ValueError as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+
         # Send a "200 OK" success response back to the ESP8266
-        return jsonify({"status": "success", "received_data": data}), 200
+        return jsonify(response), status_code
     else:
-        # If the ESP sends something that isn't JSON, send an error
-        print("Received non-JSON data")
-        return jsonify({"status": "error", "message": "Request must be JSON"}), 400
+        # If the ESP sends something that isn't JSON or binary, send an error
+        log.sampled(WARNING, 'non_json_data')
+        return jsonify({"status": "error", "message": "Request must be JSON or a binary trigger packet"}), 400
+
+@app.route('/data/batch', methods=['POST'])
+def receive_data_batch():
+    """
+    The batch version of '/data', for stations that buffer readings or a
+    gateway that collects them from several boxes. One request carries many
+    triggers, which are processed in order, and one response summarizes them.
+
+    The body is either JSON ({"roomId": "...", "triggers": [ ... ]} or just
+    a list of triggers) or back-to-back binary trigger packets
+    ('Content-Type: application/octet-stream').
+    """
+    if request.mimetype == 'application/octet-stream':
+        buffer = memoryview(request.get_data())
+        if len(buffer) // TRIGGER_PACKET_SIZE > MAX_BATCH_SIZE:
+            return jsonify({"status": "error", "message": f"Batches are limited to {MAX_BATCH_SIZE} triggers"}), 400
+        try:
+            with INGEST_SECONDS.time(transport='http_batch'):
+                summary = handle_binary_trigger_batch(buffer)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify(summary), 200
+
+    if not request.is_json:
+        log.sampled(WARNING, 'non_json_data')
+        return jsonify({"status": "error", "message": "Request must be JSON or binary trigger packets"}), 400
+
+    data = request.get_json()
+    room_id = None
+    if isinstance(data, dict):
+        # The wrapped form, with an optional room for the whole batch
+        room_id = data.get('roomId')
+        data = data.get('triggers')
+    if not isinstance(data, list):
+        return jsonify({"status": "error", "message": "Batch must contain a list of triggers"}), 400
+    if len(data) > MAX_BATCH_SIZE:
+        return jsonify({"status": "error", "message": f"Batches are limited to {MAX_BATCH_SIZE} triggers"}), 400
+
+    with INGEST_SECONDS.time(transport='http_batch'):
+        summary = handle_trigger_batch(data, room_id)
+    return jsonify(summary), 200
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Serves every counter and histogram in the Prometheus text format, so
+    a Prometheus server (or just 'curl') can see where time is spent.
+    """
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/traces')
+def traces_endpoint():
+    """
+    Returns the most recent trigger traces (newest first) and, for every
+    hop, how long after 'received' it happened (p50/p95/max), so we can see
+    where the time between a station firing and a browser flashing goes.
+
+    Optional query parameters: ?limit=50&chip=<chipId>&room=<roomId>
+    """
+    limit = request.args.get('limit', 50, type=int)
+    traces = trace_buffer.recent(limit, request.args.get('chip'), request.args.get('room'))
+    return jsonify({"summary": trace_buffer.summary(), "traces": traces})
+
+@app.route('/traces/<trace_id>')
+def trace_endpoint(trace_id):
+    """
+    Returns one trace by its ID (the 'traceId' the browsers receive).
+    """
+    trace = trace_buffer.get(trace_id)
+    if trace is None:
+        return jsonify({"status": "error", "message": "Unknown or expired trace"}), 404
+    return jsonify(trace.to_dict())
+
+@app.route('/leaderboard')
+def leaderboard_endpoint():
+    """
+    Returns the best scores (highest level reached first). They come from
+    memory ('leaderboard.py'), never from the disk. A ranking asked for
+    the first time comes back empty with '"pending": true', and is ready
+    a second later.
+
+    Optional query parameters: ?room=<roomId>&day=today (or YYYY-MM-DD)
+    """
+    if leaderboard is None:
+        return jsonify({"status": "error", "message": "The leaderboard is off (set BOXBOTS_LEADERBOARD_PATH)"}), 404
+    try:
+        day = parse_day(request.args.get('day') or None)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    room_id = request.args.get('room') or None
+    return jsonify(leaderboard_answer(room_id, day, leaderboard.top(room_id, day)))
 
 @app.route('/')
 def index():
@@ -185,7 +500,7 @@ def index():
     """
     # 'render_template' automatically looks inside your 'templates' folder
     # for the 'index.html' file.
-    print("Browser connected, serving index.html")
+    log.debug('index_served')
     return render_template('index.html')
 
 # --- SocketIO Event Handlers (Browser <-> Server) ---
@@ -194,115 +509,256 @@ def index():
 def handle_connect():
     """
     This runs when a new web browser client connects to the server.
-    We immediately send them the current list of connected boards.
+    The browser says which room it wants to watch in the '?room=' query
+    string. We add it to that room and send it the room's board list.
     """
-    print(f"New web client connected. Sending current board list.")
-    # 'emit' (without 'socketio.' prefix) sends only to the client
-    # that just connected. This updates the UI for a user who
-    # connects *after* the boards are already registered.
-    emit('update_boards', connected_boards)
+    room_id = watch_room(request.args.get('room'))
+    log.info('web_client_connected', room=room_id)
+
+@socketio.on('watch_room')
+def handle_watch_room(data=None):
+    """
+    Lets a browser switch to another room without reconnecting.
+    It sends { room: '...' } and from then on only gets that room's events.
+    """
+    room_id = watch_room((data or {}).get('room'))
+    log.info('web_client_switched_room', room=room_id)
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    """
+    This runs when a browser closes the page or loses its connection.
+    """
+    room_id = watched_rooms.pop(request.sid, None)
+    if room_id is not None:
+        room_registry.unwatch(room_id, request.sid)
+        log.info('web_client_disconnected', room=room_id)
 
 @socketio.on('start_game')
-def handle_start_game():
+def handle_start_game(data=None):
     """
     This runs when the user clicks the "Start Game" button on the webpage.
+    The browser sends { room: '...' } so we know which game to start, and
+    optionally a 'seed' to play the same sequence as an earlier game.
     """
-    if game_instance.state == 'PLAYER_TURN':
+    room = room_registry.get_or_create((data or {}).get('room'))
+    game_instance = room.game
+
+    if game_instance.is_active():
         # Prevent starting a new game while one is active
-        print("[Game] Ignoring 'start_game' request, game already in progress.")
+        log.info('start_game_ignored', room=room.room_id, state=game_instance.state)
         return
 
-    print("[Game] 'start_game' event received. Starting new game...")
+    log.info('start_game_received', room=room.room_id)
     
-    # Call start_new_game() and store its return value (True/False)
-    game_started = game_instance.start_new_game()
+    # Call start_new_game() and store its return value
+    # (the epoch of the new game, or None if it didn't start)
+    epoch = game_instance.start_new_game(seed=(data or {}).get('seed'))
     
     # Check if the game successfully started
-    if game_started:
-        # Game started (boards were connected), so show the sequence
-        # Start a background task to show the sequence, so the server
-        # doesn't get blocked by the 'time.sleep' calls.
-        socketio.start_background_task(target=show_sequence_to_client)
-    else:
+    if epoch is not None:
+        # Game started (boards were connected), so show the sequence.
+        # This doesn't block: the shared timer scheduler sends the flashes.
+        show_sequence_to_client(room, epoch)
+    elif not game_instance.available_boards:
         # Game failed to start (no boards available)
-        # Send an error message back to the client
-        print("[Game] 'start_game' failed: No boards available.")
-        socketio.emit('game_update', {
+        # Send an error message back to the room
+        log.warning('start_game_failed', room=room.room_id, reason='no_boards')
+        emit_to_room(room, 'game_update', {
             'status': 'ERROR',
             'message': 'No boards connected! Cannot start game.'
         })
+        # A room named only by this 'start_game' is not kept
+        room_registry.discard_if_idle(room)
+    # Otherwise another browser started this game at the same moment,
+    # and its 'start_game' is already showing the sequence.
+
+@socketio.on('trace_ack')
+def handle_trace_ack(data=None):
+    """
+    A browser sends { traceId: '...' } back as soon as it has flashed the
+    square for a 'new_message'. This is the last hop of the trace.
+    """
+    trace_id = (data or {}).get('traceId')
+    if trace_id:
+        trace_buffer.ack(trace_id)
+
+def watch_room(room_id):
+    """
+    Makes the browser behind the current SocketIO event watch 'room_id': it
+    leaves the room it watched before (if any), joins this one and is sent
+    this room's boards. The room is not created if it doesn't exist yet;
+    the browser starts getting its events once a station or a 'start_game'
+    creates it. Returns the room ID it watches.
+    """
+    sid = request.sid
+    room_id = room_key(room_id)
+    previous = watched_rooms.get(sid)
+    if previous is not None and previous != room_id:
+        leave_room(socketio_room_name(previous))
+        room_registry.unwatch(previous, sid)
+
+    join_room(socketio_room_name(room_id))
+    room = room_registry.watch(room_id, sid)
+    watched_rooms[sid] = room_id
+
+    # 'emit' (without 'socketio.' prefix) sends only to this client.
+    # This updates the UI for a user who connects *after* the boards
+    # are already registered.
+    emit('update_boards', room.connected_boards if room is not None else {})
+    return room_id
 
 # --- Game Helper Functions (Run by Server) ---
 
-def show_sequence_to_client():
+def emit_to_room(room, event, data):
+    """
+    Sends a SocketIO event to every browser watching 'room', and records
+    how long the emit took. Only that room's browsers get it, so the cost
+    of an emit grows with the room's audience, not with every browser
+    connected to the server.
+    """
+    # Nobody is watching, so there is nothing to send
+    if not room.has_watchers():
+        return
+    with SOCKETIO_EMIT_SECONDS.time(event=event):
+        socketio.emit(event, data, to=room.socketio_room)
+
+def _emit_game_result(room, result):
+    """
+    Tells a room's browsers what the game logic decided about an input.
+    'result' is the value returned by Game.check_player_input (or None).
+    """
+    if result == 'WRONG':
+        # Player made a mistake
+        emit_to_room(room, 'game_update', {
+            'status': 'GAME_OVER',
+            'level': room.game.get_current_level(),
+            'reason': 'wrong_input'
+        })
+
+    elif result == 'LEVEL_COMPLETE':
+        # Player finished the sequence correctly
+        # This arms a timer that starts the next level after a pause. It is
+        # given the epoch the level was completed at, so it does nothing if
+        # the game is restarted while it waits.
+        _handle_next_level(room, room.game.epoch)
+
+    elif result == 'CORRECT':
+        # Player input was correct, but the sequence isn't finished
+        # We can send a small update, e.g., to play a sound
+        emit_to_room(room, 'game_update', {'status': 'CORRECT_INPUT'})
+
+def show_sequence_to_client(room, epoch):
     """
-    This function "plays" the game's sequence for the user.
-    It runs in a background thread to avoid blocking the server.
+    This function "plays" a room's sequence for the user.
+    It returns straight away: the flashes are sent on time by the shared
+    timer scheduler (see 'playback.py'), so no thread waits for them.
+    'epoch' is the epoch of the 'SHOWING' state this sequence belongs to;
+    if the game moves on (e.g. it is restarted), the playback stops quietly.
     """
-    # Give a brief pause before starting the sequence
-    print("[Game] Showing sequence...")
+    game_instance = room.game
+    started_at = time.perf_counter()
+
     # Tell the browser to show the "Level X! Watch..." message
-    socketio.emit('game_update', {
+    log.debug('showing_sequence', room=room.room_id, level=game_instance.get_current_level())
+    emit_to_room(room, 'game_update', {
         'status': 'SHOWING', 
         'level': game_instance.get_current_level()
     })
-    socketio.sleep(1.5) # Wait for 1.5s so user can read the "Level X" message
-    
-    # Get the sequence of chipIds from the game instance
-    sequence_to_show = game_instance.sequence
-    
-    # Loop through each chipId in the correct sequence
-    for chip_id in sequence_to_show:
-        # Check if the board is still connected (it might have disconnected)
-        if chip_id in connected_boards:
-            # Tell the browser to flash this specific board
-            socketio.emit('show_flash', {'chipId': chip_id})
-            
-            # Wait 1 second before showing the next flash
-            # (This timing can be adjusted)
-            socketio.sleep(1.0) 
-            
-    # The sequence is finished. Tell the game logic to start the player's turn.
-    game_instance.start_player_turn()
-    
-    # Tell the browser the player's turn has begun
-    socketio.emit('game_update', {'status': 'PLAYER_TURN','level': game_instance.get_current_level()})
-    print("[Game] Player turn has started.")
 
-def _handle_next_level():
+    def show_flash(chip_id):
+        # Tell the browser to flash this specific board
+        emit_to_room(room, 'show_flash', {'chipId': chip_id})
+
+    def start_turn(flashes):
+        # The sequence is finished. Tell the game logic to start the player's turn.
+        # If the game moved on while we were showing, the turn is not started.
+        if game_instance.start_player_turn(epoch) is None:
+            return
+
+        # Record how long the playback really took versus its timeline
+        playback_seconds = time.perf_counter() - started_at
+        SEQUENCE_PLAYBACK_SECONDS.observe(playback_seconds)
+        SEQUENCE_PLAYBACK_OVERRUN_SECONDS.observe(max(0.0, playback_seconds - playback_duration(flashes)))
+
+        # Tell the browser the player's turn has begun
+        emit_to_room(room, 'game_update', {'status': 'PLAYER_TURN','level': game_instance.get_current_level()})
+        log.debug('player_turn_announced', room=room.room_id)
+
+    # Only flash the boards that are still connected (one might have disconnected)
+    SequencePlayback(
+        game_instance.scheduler,
+        [chip_id for chip_id in game_instance.sequence_chip_ids() if chip_id in room.connected_boards],
+        is_current=lambda: game_instance.epoch == epoch,
+        on_flash=show_flash,
+        on_finished=start_turn
+    ).start()
+
+def _handle_next_level(room, epoch):
     """
-    A helper function to manage the transition between levels.
-    Runs in a background thread.
+    A helper function to manage a room's transition between levels.
+    'epoch' is the epoch at which the level was completed. It returns
+    straight away: the pause is a timer on the shared scheduler, like the
+    sequence playback, so no thread sleeps through it.
     """
+    game_instance = room.game
+
     # Tell the client the level is complete
-    print("[Game] Level complete. Waiting 2.5s for next level.")
-    socketio.emit('game_update', {
+    log.debug('next_level_pending', room=room.room_id, delay=LEVEL_COMPLETE_PAUSE_SECONDS)
+    emit_to_room(room, 'game_update', {
         'status': 'LEVEL_COMPLETE',
         'level': game_instance.get_current_level()
     })
-    socketio.sleep(2.5) # Pause so the player can celebrate
-    
-    # Tell the game instance to advance to the next level
-    game_instance.next_level()
-    
-    # Start *another* background task to show the new, longer sequence
-    socketio.start_background_task(target=show_sequence_to_client)
 
-def on_player_timeout_callback():
+    def start_next_level():
+        # Tell the game instance to advance to the next level
+        # (nothing happens if the game changed while we were pausing)
+        showing_epoch = game_instance.next_level(epoch)
+        if showing_epoch is None:
+            return
+
+        # Show the new, longer sequence
+        show_sequence_to_client(room, showing_epoch)
+
+    # Pause so the player can celebrate
+    game_instance.scheduler.call_later(LEVEL_COMPLETE_PAUSE_SECONDS, start_next_level)
+
+def restore_rooms(snapshot):
     """
-    This function is passed to the Game instance when it's created.
-    The Game instance's internal timer will call this from a separate
-    thread if the player runs out of time.
+    Carries on with every room saved in 'snapshot' (see 'snapshot.py')
+    after a restart. A player's turn goes on with the time that was left;
+    a level that was being shown is shown again.
     """
-    print("[Game] Player timed out (callback triggered).")
+    started_at = time.perf_counter()
+    games = 0
+    for saved in snapshot['rooms']:
+        room = room_registry.get_or_create(saved['roomId'])
+        epoch = room.restore(saved['boards'], saved['game'])
+        if epoch is None:
+            continue
+        games += 1
+        if room.game.state == 'SHOWING':
+            show_sequence_to_client(room, epoch)
+        elif room.game.state == 'LEVEL_COMPLETE':
+            _handle_next_level(room, epoch)
+    log.info('rooms_restored', rooms=len(snapshot['rooms']), games=games,
+             ms=round((time.perf_counter() - started_at) * 1000, 3))
+
+def on_player_timeout_callback(room):
+    """
+    This function is passed to the room registry, which hands it to every
+    Game instance it creates. The Game instance's internal timer will call
+    this from a separate thread if the player runs out of time.
+    """
+    log.debug('player_timeout_callback', room=room.room_id)
     
     # We must emit from within the socketio context.
     # The correct function is 'app.app_context()', not 'app.app_config()'.
     with app.app_context():
-        # Tell all browsers that the game is over due to a timeout
-        socketio.emit('game_update', {
+        # Tell the room's browsers that the game is over due to a timeout
+        emit_to_room(room, 'game_update', {
             'status': 'GAME_OVER',
-            'level': game_instance.get_current_level(),
+            'level': room.game.get_current_level(),
             'reason': 'timeout'
         })
 
@@ -310,8 +766,31 @@ def on_player_timeout_callback():
 if __name__ == '__main__':
     # This block runs only when you execute 'python app.py' directly
 
-    # 1. Initialize the Game instance, passing it the timeout function
-    game_instance = Game(player_timeout_callback=on_player_timeout_callback)
+    # 0. Send all log lines through the non-blocking console writer
+    setup_logging()
+
+    # 1. Initialize the room registry, passing it the timeout function
+    #    that every room's Game instance will use
+    if LEADERBOARD_PATH:
+        leaderboard = Leaderboard(LEADERBOARD_PATH)
+    room_registry = RoomRegistry(
+        player_timeout_callback=on_player_timeout_callback,
+        avoid_repeats=AVOID_REPEATS,
+        debounce_seconds=DEBOUNCE_SECONDS,
+        journal=Journal(JOURNAL_DIR) if JOURNAL_DIR else None,
+        leaderboard=leaderboard
+    )
+
+    # 1b. Warm restart: carry on with the rooms saved before the last stop,
+    #     then keep saving them
+    if SNAPSHOT_PATH:
+        snapshot = read_snapshot(SNAPSHOT_PATH)
+        if snapshot is not None:
+            restore_rooms(snapshot)
+        SnapshotWriter(SNAPSHOT_PATH, room_registry).start()
+        # 'kill' (e.g. a service manager stopping us) exits like Ctrl+C,
+        # so the last snapshot is still written on the way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     # 2. Start the UDP discovery thread.
     #    'daemon=True' means the thread will automatically close
@@ -319,10 +798,14 @@ if __name__ == '__main__':
     discovery_thread = threading.Thread(target=send_discovery_packets, daemon=True)
     discovery_thread.start()
 
-    # 3. Start the main Flask-SocketIO web server.
+    # 3. Start the UDP trigger listener thread for stations in UDP mode.
+    trigger_thread = threading.Thread(target=listen_for_udp_triggers, daemon=True)
+    trigger_thread.start()
+
+    # 4. Start the main Flask-SocketIO web server.
     #    'host='0.0.0.0'' means it's accessible from any device on your network
     #    (which is what the ESP needs to find it).
-    print("Starting Flask-SocketIO server on 0.0.0.0:5000...")
+    log.info('server_starting', host='0.0.0.0', port=5000)
     # We use 'socketio.run' here instead of 'app.run' to ensure
     # both Flask and SocketIO work correctly together.
     # This will automatically use 'eventlet' or 'gevent' if installed,
@@ -0,0 +1,797 @@
+# asgi_app.py
+# This is the optional asyncio version of the backend server in 'app.py'.
+# It serves the same web page, the same '/data' endpoint and the same
+# SocketIO events, but everything runs as coroutines on ONE event loop:
+# '/data' ingestion, the sequence playback and the turn timeouts. This lets a
+# single process hold thousands of browser sockets and station connections
+# without a thread per task.
+#
+# Run it with:   python asgi_app.py
+# or with any ASGI server, e.g.:   uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+# --- Required Imports ---
+import asyncio      # The event loop everything in this file runs on
+import json         # To parse the station's JSON and build our responses
+import os           # To find the 'templates' and 'static' folders
+import socket       # For networking, specifically UDP multicast
+import time         # To measure how long sequence playback really takes
+from urllib.parse import parse_qs # To read '?room=' from the browser's URL
+
+import socketio     # python-socketio, which provides the asyncio SocketIO server
+from jinja2 import Environment, FileSystemLoader # Jinja2 is installed with Flask
+
+# --- Shared Configuration and Game Logic ---
+# The board map and discovery settings live in 'app.py' so there is only one
+# place to edit them, whichever server mode you run.
+from app import BOARD_COLOR_MAP, MULTICAST_GROUP, MULTICAST_PORT, SERVER_MESSAGE, TRIGGER_PORT, discovery_interval
+from app import AVOID_REPEATS, DEBOUNCE_SECONDS, JOURNAL_DIR, LEADERBOARD_PATH, MAX_BATCH_SIZE, SNAPSHOT_PATH
+from app import INGEST_SECONDS, SOCKETIO_EMIT_SECONDS, SEQUENCE_PLAYBACK_SECONDS, SEQUENCE_PLAYBACK_OVERRUN_SECONDS
+import metrics
+from broker import client_manager_for # Shares SocketIO rooms between worker processes
+from cluster import Cluster # Which worker owns which room, and forwarding to it
+from log import INFO, WARNING, get_logger, setup_logging
+from protocol import TRIGGER_PACKET_SIZE, is_binary_trigger, parse_json_trigger, parse_trigger
+from playback import LEVEL_COMPLETE_PAUSE_SECONDS, SequencePlayback, playback_duration # Sends a sequence's flashes from the event loop's timers
+from rooms import RoomRegistry, room_key, socketio_room_name
+from journal import Journal # Append-only record of every game
+from snapshot import SnapshotWriter, read_snapshot # Saves every room for a warm restart
+from leaderboard import Leaderboard, leaderboard_answer, parse_day # The level every finished game reached, in SQLite
+from scheduler import AsyncioScheduler # Turn timeouts on the event loop, not on a thread
+from tracing import trace_buffer
+
+# The folder this file is in, so it works from any working directory
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Application Setup ---
+# This process's place among the workers (see 'cluster.py'). Run on its
+# own, it is the only worker and owns every room.
+cluster = Cluster.from_environment()
+
+# The asyncio SocketIO server. 'async_mode="asgi"' makes it run on the
+# same event loop as the ASGI server (e.g. uvicorn). With several workers,
+# the client manager shares every SocketIO room through the message queue.
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    client_manager=client_manager_for(os.environ.get('BOXBOTS_MESSAGE_QUEUE'))
+)
+
+# The logger for everything in this file
+log = get_logger('asgi_app')
+
+# { sid: room_id } for every connected browser (see 'app.watched_rooms')
+watched_rooms = {}
+
+# --- UDP Multicast Task (For Auto-Discovery) ---
+async def send_discovery_packets():
+    """
+    The asyncio version of 'app.send_discovery_packets'. It runs as a
+    background task and "shouts" the server message every 5 seconds.
+    """
+    multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    # Never let a send block the event loop
+    multicast_socket.setblocking(False)
+    started_at = time.monotonic()
+
+    log.info('discovery_started', group=MULTICAST_GROUP, port=MULTICAST_PORT)
+    while True:
+        try:
+            multicast_socket.sendto(SERVER_MESSAGE, (MULTICAST_GROUP, MULTICAST_PORT))
+            log.debug('discovery_packet_sent')
+        except OSError as e:
+            log.warning('discovery_packet_failed', error=e)
+
+        # Wait before sending the next packet (faster just after a start)
+        await asyncio.sleep(discovery_interval(started_at))
+
+# --- UDP Trigger Listener (Fast Station Transport) ---
+class TriggerDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    The asyncio version of 'app.listen_for_udp_triggers'. The event loop
+    calls 'datagram_received' for every trigger datagram, with no thread.
+    """
+
+    def datagram_received(self, packet, address):
+        started_at = time.perf_counter()
+        try:
+            handling = self._parse(packet)
+        except (ValueError, TypeError, AttributeError) as e:
+            log.sampled(WARNING, 'malformed_trigger_datagram', source=address[0], error=e)
+            return
+
+        # Handle it as a task so the next datagram isn't held up
+        asyncio.ensure_future(self._handle(handling, time.perf_counter() - started_at))
+
+    @staticmethod
+    async def _handle(handling, parse_seconds):
+        """
+        Runs the coroutine from '_parse' and records the parsing plus the
+        handling in the ingest histogram, like the Flask listener does (the
+        time the task waited to start is left out).
+        """
+        started_at = time.perf_counter()
+        try:
+            await handling
+        finally:
+            INGEST_SECONDS.observe(parse_seconds + time.perf_counter() - started_at, transport='udp')
+
+    def _parse(self, packet):
+        """
+        Turns one datagram into the coroutine that will handle it.
+        Raises ValueError if the datagram is not a valid trigger.
+        """
+        if is_binary_trigger(packet):
+            # Read the fields now, so the task doesn't hold the packet
+            chip_id, room_id, distance, seq, station_ms = parse_trigger(packet)
+            return handle_trigger(chip_id, room_id, distance, seq=seq, station_ms=station_ms)
+
+        # Check the fields now, so a bad trigger is rejected here and not
+        # in the task
+        data = json.loads(packet)
+        chip_id, room_id, distance, seq, station_ms = parse_json_trigger(data)
+        return handle_trigger(chip_id, room_id, distance, data, seq, station_ms)
+
+# --- HTTP Routes ---
+
+async def receive_data(headers, body):
+    """
+    The asyncio version of the '/data' endpoint in 'app.py'.
+    Returns (status_code, response_dict), where a None response means
+    "no body" (204).
+    """
+    # Same rule as Flask's 'request.mimetype'
+    content_type = headers.get(b'content-type', b'').split(b';')[0].strip()
+
+    if content_type == b'application/octet-stream':
+        try:
+            with INGEST_SECONDS.time(transport='http_binary'):
+                chip_id, room_id, distance, seq, station_ms = parse_trigger(memoryview(body))
+                await handle_trigger(chip_id, room_id, distance, seq=seq, station_ms=station_ms)
+        except ValueError:
+            return 400, {"status": "error", "message": "Invalid trigger packet"}
+        return 204, None
+
+    if content_type != b'application/json':
+        # If the ESP sends something that isn't JSON or binary, send an error
+        log.sampled(WARNING, 'non_json_data')
+        return 400, {"status": "error", "message": "Request must be JSON or a binary trigger packet"}
+
+    with INGEST_SECONDS.time(transport='http_json'):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, {"status": "error", "message": "Invalid JSON"}
+
+        try:
+            return await handle_json_trigger(data)
+        except ValueError as e:
+            return 400, {"status": "error", "message": str(e)}
+
+
+async def handle_json_trigger(data):
+    """
+    The asyncio version of 'app.handle_json_trigger'.
+    Returns (status_code, response_dict). Raises ValueError if the trigger
+    is not valid.
+    """
+    chip_id, room_id, distance, seq, station_ms = parse_json_trigger(data)
+
+    if not await handle_trigger(chip_id, room_id, distance, data, seq, station_ms):
+        return 200, {"status": "success", "message": "Ignored unknown board"}
+    return 200, {"status": "success", "received_data": data}
+
+
+async def receive_data_batch(headers, body):
+    """
+    The asyncio version of the '/data/batch' endpoint in 'app.py'.
+    Returns (status_code, response_dict).
+    """
+    content_type = headers.get(b'content-type', b'').split(b';')[0].strip()
+
+    if content_type == b'application/octet-stream':
+        buffer = memoryview(body)
+        if len(buffer) % TRIGGER_PACKET_SIZE:
+            return 400, {"status": "error", "message": "Batch is not a whole number of trigger packets"}
+        if len(buffer) // TRIGGER_PACKET_SIZE > MAX_BATCH_SIZE:
+            return 400, {"status": "error", "message": f"Batches are limited to {MAX_BATCH_SIZE} triggers"}
+
+        summary = _new_batch_summary(len(buffer) // TRIGGER_PACKET_SIZE)
+        for offset in range(0, len(buffer), TRIGGER_PACKET_SIZE):
+            try:
+                chip_id, room_id, distance, seq, station_ms = parse_trigger(buffer, offset)
+            except ValueError:
+                summary["invalid"] += 1
+                continue
+            handled = await handle_trigger(chip_id, room_id, distance, seq=seq, station_ms=station_ms)
+            summary["processed" if handled else "ignored"] += 1
+        return 200, summary
+
+    if content_type != b'application/json':
+        log.sampled(WARNING, 'non_json_data')
+        return 400, {"status": "error", "message": "Request must be JSON or binary trigger packets"}
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return 400, {"status": "error", "message": "Invalid JSON"}
+
+    batch_room_id = None
+    if isinstance(data, dict):
+        # The wrapped form, with an optional room for the whole batch
+        batch_room_id = data.get('roomId')
+        data = data.get('triggers')
+    if not isinstance(data, list):
+        return 400, {"status": "error", "message": "Batch must contain a list of triggers"}
+    if len(data) > MAX_BATCH_SIZE:
+        return 400, {"status": "error", "message": f"Batches are limited to {MAX_BATCH_SIZE} triggers"}
+
+    summary = _new_batch_summary(len(data))
+    for trigger in data:
+        # Checked before anything is done with it, like 'app.handle_trigger_batch'
+        try:
+            chip_id, room_id, distance, seq, station_ms = parse_json_trigger(trigger, batch_room_id)
+        except ValueError:
+            summary["invalid"] += 1
+            continue
+        handled = await handle_trigger(chip_id, room_id, distance, trigger, seq, station_ms)
+        summary["processed" if handled else "ignored"] += 1
+    return 200, summary
+
+
+def _new_batch_summary(count):
+    """
+    The summary '/data/batch' answers with, before any trigger is handled.
+    """
+    return {"status": "success", "received": count, "processed": 0, "ignored": 0, "invalid": 0}
+
+
+async def handle_trigger(chip_id, room_id, distance, message=None, seq=None, station_ms=None):
+    """
+    The asyncio version of 'app.handle_trigger', shared by '/data' and the
+    UDP trigger listener, for JSON and binary triggers.
+    Returns False if the trigger was ignored (unknown board), True otherwise.
+    """
+    # Only known boards will trigger flashes and game logic.
+    if chip_id not in BOARD_COLOR_MAP:
+        if chip_id != 'Unknown':
+            log.sampled(INFO, 'unknown_board_ignored', chip_id=chip_id)
+        return False
+
+    # Only the room's owner runs its game; any other worker hands it over
+    forwarded = {
+        'type': 'trigger', 'chipId': chip_id, 'roomId': room_id, 'distance': distance,
+        'message': message, 'seq': seq, 'stationMs': station_ms
+    }
+    if await cluster.route(room_id, forwarded):
+        await _handle_owned_trigger(chip_id, room_id, distance, message, seq, station_ms)
+    return True
+
+
+async def _handle_owned_trigger(chip_id, room_id, distance, message, seq, station_ms):
+    """
+    The part of 'handle_trigger' that runs on the worker owning the room.
+    """
+    # Find (or create) the room this station plays in
+    room = room_registry.get_or_create(room_id)
+
+    # Drop retries and noisy repeated readings (shared with 'app.py').
+    # Only the owner knows the board's last trigger, so this happens here.
+    if room.drop_trigger(chip_id, distance, seq) is not None:
+        return True
+
+    # Trace every trigger that flashes a square (see 'tracing.py')
+    trace = None
+    if distance > 0.0:
+        trace = trace_buffer.start(chip_id, room.room_id, seq, station_ms)
+
+    # Register the board and check the input (shared with 'app.py')
+    board_added, result = room.process_trigger(chip_id, BOARD_COLOR_MAP[chip_id], distance, seq)
+    if trace is not None:
+        trace.result = result
+        trace.hop('processed')
+
+    if board_added:
+        await emit_to_room(room, 'update_boards', room.connected_boards)
+
+    # Flash the square, except for the 0.0 registration packet
+    if distance > 0.0:
+        if message is None:
+            message = {'chipId': chip_id, 'distance': distance}
+            if seq is not None:
+                message['seq'] = seq
+        # (a new dict, so the caller's request data is left as it was)
+        message = {**message, 'traceId': trace.trace_id}
+        await emit_to_room(room, 'new_message', message)
+        trace.hop('emitted')
+
+    await _emit_game_result(room, result)
+    return True
+
+
+def _render_index():
+    """
+    Renders 'templates/index.html' once. Flask's 'url_for' isn't available
+    here, so we provide the one form of it the template uses.
+    """
+    env = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, 'templates')))
+    page = env.get_template('index.html').render(
+        url_for=lambda endpoint, filename: f'/{endpoint}/{filename}',
+        # Long-polling needs every request of a session to reach the same
+        # worker, which a shared port can't promise; WebSockets don't
+        websocket_only=cluster.distributed
+    )
+    return page.encode('utf-8')
+
+# The page never changes, so we only render it once
+INDEX_HTML = _render_index()
+
+
+async def http_app(scope, receive, send):
+    """
+    The plain ASGI app for every HTTP request that isn't SocketIO traffic
+    or a static file: the web page and the '/data' endpoint.
+    """
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+
+    if path == '/data' and method == 'POST':
+        headers = dict(scope['headers'])
+        status, payload = await receive_data(headers, await _read_body(receive))
+        if payload is None:
+            await _send_response(send, status, b'', b'application/json')
+        else:
+            await _send_response(send, status, json.dumps(payload).encode('utf-8'), b'application/json')
+    elif path == '/data/batch' and method == 'POST':
+        headers = dict(scope['headers'])
+        body = await _read_body(receive)
+        with INGEST_SECONDS.time(transport='http_batch'):
+            status, payload = await receive_data_batch(headers, body)
+        await _send_response(send, status, json.dumps(payload).encode('utf-8'), b'application/json')
+    elif path == '/traces' and method == 'GET':
+        await _send_response(send, 200, json.dumps(_query_traces(scope)).encode('utf-8'), b'application/json')
+    elif path.startswith('/traces/') and method == 'GET':
+        trace = trace_buffer.get(path[len('/traces/'):])
+        if trace is None:
+            payload = {"status": "error", "message": "Unknown or expired trace"}
+            await _send_response(send, 404, json.dumps(payload).encode('utf-8'), b'application/json')
+        else:
+            await _send_response(send, 200, json.dumps(trace.to_dict()).encode('utf-8'), b'application/json')
+    elif path == '/leaderboard' and method == 'GET':
+        if leaderboard is None:
+            payload = {"status": "error", "message": "The leaderboard is off (set BOXBOTS_LEADERBOARD_PATH)"}
+            await _send_response(send, 404, json.dumps(payload).encode('utf-8'), b'application/json')
+        else:
+            status, payload = await _query_leaderboard(scope)
+            await _send_response(send, status, json.dumps(payload).encode('utf-8'), b'application/json')
+    elif path == '/metrics' and method == 'GET':
+        await _send_response(send, 200, metrics.render().encode('utf-8'), metrics.CONTENT_TYPE.encode())
+    elif path == '/' and method == 'GET':
+        log.debug('index_served')
+        await _send_response(send, 200, INDEX_HTML, b'text/html; charset=utf-8')
+    else:
+        await _send_response(send, 404, b'Not Found', b'text/plain')
+
+
+def _query_traces(scope):
+    """
+    The asyncio version of the '/traces' endpoint in 'app.py'.
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        limit = int(query.get('limit', ['50'])[0])
+    except ValueError:
+        limit = 50
+    traces = trace_buffer.recent(limit, query.get('chip', [None])[0], query.get('room', [None])[0])
+    return {"summary": trace_buffer.summary(), "traces": traces}
+
+
+async def _query_leaderboard(scope):
+    """
+    The asyncio version of the '/leaderboard' endpoint in 'app.py'.
+    Returns (status_code, response_dict).
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        day = parse_day(query.get('day', [None])[0] or None)
+    except ValueError as e:
+        return 400, {"status": "error", "message": str(e)}
+    room_id = query.get('room', [None])[0] or None
+    # 'top' only reads memory, but nothing about the leaderboard runs on
+    # the event loop, so it could never hold up the rooms on this worker
+    scores = await asyncio.get_running_loop().run_in_executor(None, leaderboard.top, room_id, day)
+    return 200, leaderboard_answer(room_id, day, scores)
+
+
+async def _read_body(receive):
+    """
+    Collects the whole request body from the ASGI 'receive' channel.
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_response(send, status, body, content_type):
+    """
+    Sends a complete HTTP response through the ASGI 'send' channel.
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+# --- SocketIO Event Handlers (Browser <-> Server) ---
+
+@sio.event
+async def connect(sid, environ):
+    """
+    This runs when a new web browser client connects to the server.
+    We add it to the room it asked for and send it that room's boards.
+    """
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    room_id = await _watch_room(sid, query.get('room', [None])[0])
+    log.info('web_client_connected', room=room_id)
+
+@sio.event
+async def watch_room(sid, data=None):
+    """
+    The asyncio version of 'app.handle_watch_room'.
+    """
+    room_id = await _watch_room(sid, (data or {}).get('room'))
+    log.info('web_client_switched_room', room=room_id)
+
+@sio.event
+async def disconnect(sid, *args):
+    """
+    This runs when a browser closes the page or loses its connection.
+    """
+    room_id = watched_rooms.pop(sid, None)
+    if room_id is not None:
+        room_registry.unwatch(room_id, sid)
+        log.info('web_client_disconnected', room=room_id)
+
+async def _watch_room(sid, room_id):
+    """
+    The asyncio version of 'app.watch_room'. Returns the room ID watched.
+    """
+    room_id = room_key(room_id)
+    previous = watched_rooms.get(sid)
+    if previous is not None and previous != room_id:
+        await sio.leave_room(sid, socketio_room_name(previous))
+        room_registry.unwatch(previous, sid)
+
+    await sio.enter_room(sid, socketio_room_name(room_id))
+    room = room_registry.watch(room_id, sid)
+    watched_rooms[sid] = room_id
+
+    # Only the owner knows the room's boards, so it sends them
+    if cluster.owns(room_id):
+        await sio.emit('update_boards', room.connected_boards if room is not None else {}, to=sid)
+    else:
+        await cluster.forward(cluster.owner_of(room_id), {
+            'type': 'send_boards', 'roomId': room_id, 'sid': sid
+        })
+    return room_id
+
+@sio.event
+async def start_game(sid, data=None):
+    """
+    This runs when the user clicks the "Start Game" button on the webpage.
+    """
+    room_id = (data or {}).get('room')
+    seed = (data or {}).get('seed')
+    if await cluster.route(room_id, {'type': 'start_game', 'roomId': room_id, 'seed': seed}):
+        await _start_game(room_registry.get_or_create(room_id), seed)
+
+async def _start_game(room, seed=None):
+    """
+    Starts the game in 'room'. Only runs on the worker owning the room.
+    """
+    game_instance = room.game
+
+    if game_instance.is_active():
+        # Prevent starting a new game while one is active
+        log.info('start_game_ignored', room=room.room_id, state=game_instance.state)
+        return
+
+    log.info('start_game_received', room=room.room_id)
+    epoch = game_instance.start_new_game(seed=seed)
+    if epoch is not None:
+        # Show the sequence (the timers send the flashes, nothing waits)
+        await show_sequence_to_client(room, epoch)
+    elif not game_instance.available_boards:
+        log.warning('start_game_failed', room=room.room_id, reason='no_boards')
+        await emit_to_room(room, 'game_update', {
+            'status': 'ERROR',
+            'message': 'No boards connected! Cannot start game.'
+        })
+        # A room named only by this 'start_game' is not kept
+        room_registry.discard_if_idle(room)
+
+@sio.event
+async def trace_ack(sid, data=None):
+    """
+    A browser acknowledges the flash for one trace (see 'app.handle_trace_ack').
+    """
+    trace_id = (data or {}).get('traceId')
+    room_id = watched_rooms.get(sid)
+    if not trace_id:
+        return
+    if room_id is None or cluster.owns(room_id):
+        trace_buffer.ack(trace_id)
+    else:
+        # The trace is kept by the worker that handled the trigger
+        await cluster.forward(cluster.owner_of(room_id), {'type': 'trace_ack', 'traceId': trace_id})
+
+async def handle_forwarded_message(message):
+    """
+    Runs work another worker forwarded to us because we own the room. If
+    the room has just moved to yet another worker, it is passed on.
+    """
+    kind = message.get('type')
+    if kind == 'take_over':
+        # Sent by the room's previous owner, who already decided it's ours
+        await _take_over_room(message)
+    elif kind == 'trace_ack':
+        trace_buffer.ack(message['traceId'])
+    elif not await cluster.route(message['roomId'], message):
+        return
+    elif kind == 'trigger':
+        await _handle_owned_trigger(message['chipId'], message['roomId'], message['distance'],
+                                    message['message'], message['seq'], message['stationMs'])
+    elif kind == 'start_game':
+        await _start_game(room_registry.get_or_create(message['roomId']), message.get('seed'))
+    elif kind == 'send_boards':
+        # Asking for the boards never creates the room
+        room = room_registry.get(message['roomId'])
+        await sio.emit('update_boards', room.connected_boards if room is not None else {}, to=message['sid'])
+
+async def hand_off_rooms(previous_shard_map):
+    """
+    Called when a worker joins or leaves. Every room this worker owned that
+    now belongs to another worker is handed over to it, game and all.
+    """
+    for room in list(room_registry.rooms.values()):
+        owner = cluster.owner_of(room.room_id)
+        if previous_shard_map.owner_of(room.room_id) != cluster.worker_id or owner in (None, cluster.worker_id):
+            continue
+        await cluster.forward(owner, {
+            'type': 'take_over',
+            'roomId': room.room_id,
+            'boards': room.connected_boards,
+            'game': room.game.hand_off()
+        })
+        log.info('room_handed_off', room=room.room_id, to=owner)
+
+async def _take_over_room(message):
+    """
+    Carries on with a room another worker handed over to us, or one saved
+    in a snapshot before a restart.
+    """
+    room = room_registry.get_or_create(message['roomId'])
+    epoch = room.restore(message['boards'], message['game'])
+    if epoch is None:
+        # A handed-over room with no boards and no game is not kept
+        room_registry.discard_if_idle(room)
+        return
+    # A step that was in progress on the old owner starts again here
+    if room.game.state == 'SHOWING':
+        await show_sequence_to_client(room, epoch)
+    elif room.game.state == 'LEVEL_COMPLETE':
+        await _handle_next_level(room, epoch)
+
+async def restore_rooms(snapshot):
+    """
+    The asyncio version of 'app.restore_rooms'. With several workers, each
+    one only carries on with the rooms it owns: a room it had taken over
+    from another worker goes back to that worker's own snapshot.
+    """
+    started_at = time.perf_counter()
+    restored = 0
+    for saved in snapshot['rooms']:
+        if cluster.owns(saved['roomId']):
+            await _take_over_room(saved)
+            restored += 1
+    log.info('rooms_restored', rooms=restored, skipped=len(snapshot['rooms']) - restored,
+             ms=round((time.perf_counter() - started_at) * 1000, 3))
+
+# --- Game Helper Coroutines ---
+
+async def emit_to_room(room, event, data):
+    """
+    The asyncio version of 'app.emit_to_room'.
+    """
+    # With several workers the watchers may be on other workers, which this
+    # one can't see, so it always emits
+    if not cluster.distributed and not room.has_watchers():
+        return
+    with SOCKETIO_EMIT_SECONDS.time(event=event):
+        await sio.emit(event, data, to=room.socketio_room)
+
+async def _emit_game_result(room, result):
+    """
+    The asyncio version of 'app._emit_game_result'.
+    """
+    if result == 'WRONG':
+        await emit_to_room(room, 'game_update', {
+            'status': 'GAME_OVER',
+            'level': room.game.get_current_level(),
+            'reason': 'wrong_input'
+        })
+
+    elif result == 'LEVEL_COMPLETE':
+        # Pause (on a timer) and start the next level
+        await _handle_next_level(room, room.game.epoch)
+
+    elif result == 'CORRECT':
+        await emit_to_room(room, 'game_update', {'status': 'CORRECT_INPUT'})
+
+async def show_sequence_to_client(room, epoch):
+    """
+    "Plays" a room's sequence for the user. Returns as soon as the "Level X"
+    message is sent: the flashes are sent on time from the event loop's
+    timers (see 'playback.py'), so no task waits for them. Stops quietly if
+    the game leaves the 'SHOWING' state of 'epoch'.
+    """
+    game_instance = room.game
+    started_at = time.perf_counter()
+
+    log.debug('showing_sequence', room=room.room_id, level=game_instance.get_current_level())
+    await emit_to_room(room, 'game_update', {
+        'status': 'SHOWING',
+        'level': game_instance.get_current_level()
+    })
+
+    # Timer callbacks are plain functions, so each emit runs as a short task
+    def show_flash(chip_id):
+        sio.start_background_task(emit_to_room, room, 'show_flash', {'chipId': chip_id})
+
+    def start_turn(flashes):
+        # The sequence is finished. Tell the game logic to start the player's turn.
+        if game_instance.start_player_turn(epoch) is None:
+            return
+
+        playback_seconds = time.perf_counter() - started_at
+        SEQUENCE_PLAYBACK_SECONDS.observe(playback_seconds)
+        SEQUENCE_PLAYBACK_OVERRUN_SECONDS.observe(max(0.0, playback_seconds - playback_duration(flashes)))
+
+        sio.start_background_task(emit_to_room, room, 'game_update',
+                                  {'status': 'PLAYER_TURN', 'level': game_instance.get_current_level()})
+        log.debug('player_turn_announced', room=room.room_id)
+
+    # Only flash the boards that are still connected (one might have disconnected)
+    SequencePlayback(
+        game_instance.scheduler,
+        [chip_id for chip_id in game_instance.sequence_chip_ids() if chip_id in room.connected_boards],
+        is_current=lambda: game_instance.epoch == epoch,
+        on_flash=show_flash,
+        on_finished=start_turn
+    ).start()
+
+async def _handle_next_level(room, epoch):
+    """
+    Manages a room's transition between levels (see 'app._handle_next_level').
+    Returns once the "level complete" message is sent: the pause is a timer
+    on the event loop, so no task waits through it.
+    """
+    game_instance = room.game
+    log.debug('next_level_pending', room=room.room_id, delay=LEVEL_COMPLETE_PAUSE_SECONDS)
+    await emit_to_room(room, 'game_update', {
+        'status': 'LEVEL_COMPLETE',
+        'level': game_instance.get_current_level()
+    })
+
+    # Timer callbacks are plain functions, so the next level is shown by a task
+    def start_next_level():
+        showing_epoch = game_instance.next_level(epoch)
+        if showing_epoch is not None:
+            sio.start_background_task(show_sequence_to_client, room, showing_epoch)
+
+    # Pause so the player can celebrate
+    game_instance.scheduler.call_later(LEVEL_COMPLETE_PAUSE_SECONDS, start_next_level)
+
+async def _emit_player_timeout(room):
+    """
+    Tells the room's browsers that the game is over due to a timeout.
+    """
+    await emit_to_room(room, 'game_update', {
+        'status': 'GAME_OVER',
+        'level': room.game.get_current_level(),
+        'reason': 'timeout'
+    })
+
+def on_player_timeout_callback(room):
+    """
+    Called on the event loop by the AsyncioScheduler when a player runs out
+    of time. It only schedules the coroutine that notifies the browsers.
+    """
+    log.debug('player_timeout_callback', room=room.room_id)
+    sio.start_background_task(_emit_player_timeout, room)
+
+async def on_startup():
+    """
+    Runs once when the ASGI server starts, on its event loop.
+    """
+    # Send all log lines through the non-blocking console writer
+    setup_logging()
+
+    # Warm restart: carry on with the rooms saved before the last stop,
+    # then keep saving them
+    if snapshot_writer is not None:
+        snapshot = read_snapshot(snapshot_writer.path)
+        if snapshot is not None:
+            await restore_rooms(snapshot)
+        snapshot_writer.start()
+
+    # One discovery broadcast is enough, whatever the number of workers
+    if cluster.worker_id == 0:
+        sio.start_background_task(send_discovery_packets)
+
+    # Receive the triggers and events other workers forward to us, and
+    # the rooms they hand over when a worker joins or leaves
+    sio.start_background_task(cluster.start, handle_forwarded_message, hand_off_rooms)
+
+    # Start listening for UDP triggers from stations in UDP mode. With
+    # several workers they all bind the port and the kernel shares it out.
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(TriggerDatagramProtocol, local_addr=('0.0.0.0', TRIGGER_PORT),
+                                        reuse_port=cluster.distributed or None)
+    log.info('udp_trigger_listener_started', port=TRIGGER_PORT, worker=cluster.worker_id)
+
+async def on_shutdown():
+    """
+    Runs once when the ASGI server stops. The other workers take over this
+    worker's rooms straight away.
+    """
+    # The last snapshot is taken while this worker still has its games
+    if snapshot_writer is not None:
+        snapshot_writer.stop()
+    await cluster.leave()
+
+# The leaderboard. With several workers they all share one SQLite file.
+leaderboard = Leaderboard(LEADERBOARD_PATH) if LEADERBOARD_PATH else None
+
+# The room registry. Every room's Game arms its turn timer on the event loop.
+room_registry = RoomRegistry(
+    player_timeout_callback=on_player_timeout_callback,
+    scheduler=AsyncioScheduler(),
+    avoid_repeats=AVOID_REPEATS,
+    debounce_seconds=DEBOUNCE_SECONDS,
+    # Every worker writes its own segments into the shared journal directory
+    journal=Journal(JOURNAL_DIR, prefix=f'worker{cluster.worker_id}-' if cluster.distributed else '')
+    if JOURNAL_DIR else None,
+    leaderboard=leaderboard
+)
+
+# Saves every room this worker has for a warm restart (see 'snapshot.py').
+# Every worker keeps its own snapshot file.
+snapshot_writer = SnapshotWriter(
+    f'{SNAPSHOT_PATH}.worker{cluster.worker_id}' if cluster.distributed else SNAPSHOT_PATH,
+    room_registry
+) if SNAPSHOT_PATH else None
+
+# The ASGI application: SocketIO traffic goes to 'sio', '/static/...' is
+# served from the 'static' folder, and everything else goes to 'http_app'.
+app = socketio.ASGIApp(
+    sio,
+    other_asgi_app=http_app,
+    static_files={'/static': os.path.join(BASE_DIR, 'static')},
+    on_startup=on_startup,
+    on_shutdown=on_shutdown
+)
+
+# --- Main execution ---
+if __name__ == '__main__':
+    # uvicorn is only needed when running this file directly
+    import uvicorn
+
+    log.info('server_starting', host='0.0.0.0', port=5000)
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,439 @@
+# benchmark.py
+# This file is a small benchmark suite for the server's hot paths:
+#
+#   check_player_input       one correct input, during a level of 100 boards
+#   next_level[len=N]        adding a level to a sequence that is already N long
+#   receive_data[json]       one JSON trigger through '/data' (Flask test client)
+#   receive_data[binary]     one binary trigger through '/data'
+#   fanout[game_update,N]    one 'game_update' emit to a room watched by N clients
+#   timer_arm_cancel         arming and cancelling one turn timer
+#   journal_append           recording one checked input in the game journal
+#   leaderboard_top          one cached ranking, as '/leaderboard' serves it
+#
+# and weighs the objects a server holds one of per room or per board:
+#
+#   memory:idle_room         a Room (and its Game) that nobody is playing in
+#   memory:game[level=100]   a Game with 4 boards, 100 levels into a game
+#   memory:board             one connected board's record
+#
+# Every benchmark is run several times and the best and median time per
+# operation are reported. The results can be saved as a baseline, and later
+# runs compared against it, so a change that slows a hot path down is caught:
+#
+#   python benchmark.py --save-baseline benchmark_baseline.json   # on main
+#   python benchmark.py --baseline benchmark_baseline.json         # on a branch
+#
+# A comparison exits with status 1 if any benchmark got slower (or, for
+# the memory benchmarks, bigger) than the allowed threshold (default 20%). Baselines are only meaningful on the
+# machine they were recorded on, so none is committed to the repository.
+
+from array import array # Game sequences are arrays of board indexes
+import argparse # Command line options
+import gc       # Switched off while timing, like 'timeit' does
+import itertools # A fresh 'seq' for every binary trigger
+import json     # Machine-readable results and baselines
+import platform # Recorded with the results, to tell machines apart
+import sys      # For the exit status
+import tempfile # The journal and leaderboard benchmarks write into a throwaway directory
+import time     # The clock every benchmark is measured with
+import tracemalloc # Weighs the objects of the memory benchmarks
+
+from game import Game
+from journal import INPUT, Journal
+from leaderboard import Leaderboard, parse_day
+from protocol import pack_trigger
+from rooms import Board, Room
+from scheduler import TimerScheduler
+
+# Each measurement runs the operation for at least this long (seconds)
+MIN_SAMPLE_TIME = 0.2
+
+# Each memory benchmark weighs this many objects and reports the average
+MEMORY_SAMPLE_COUNT = 1000
+
+# { name: function that builds the operation to time }, in run order
+BENCHMARKS = {}
+# { name: function that builds the function that builds one object }, in run order
+MEMORY_BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function sets everything up and
+    returns (operation, operations_per_call): a function to call over and
+    over, and how many operations one call of it performs.
+    """
+    def register(build):
+        BENCHMARKS[name] = build
+        return build
+    return register
+
+
+def memory_benchmark(name):
+    """
+    Registers a memory benchmark. The decorated function sets everything up
+    and returns a function that builds one object; the benchmark reports
+    how many bytes one such object takes, with everything it holds.
+    """
+    def register(build):
+        MEMORY_BENCHMARKS[name] = build
+        return build
+    return register
+
+
+def _playable_game(length):
+    """
+    A Game with 'length' boards in its sequence, which never arms a real
+    timer (the benchmark shouldn't start the timer thread).
+    """
+    game = Game(player_timeout_callback=lambda: None, scheduler=TimerScheduler())
+    game.set_available_boards(str(board) for board in range(4))
+    game.sequence = array('H', (index % 4 for index in range(length)))
+    return game
+
+
+# --- game.py ---
+
+@benchmark('check_player_input')
+def bench_check_player_input():
+    game = _playable_game(100)
+    sequence = game.sequence_chip_ids()
+
+    def play_level():
+        # Each call plays one whole level from its first input
+        game._machine = ('PLAYER_TURN', game.epoch, 0)
+        for chip_id in sequence:
+            game.check_player_input(chip_id)
+
+    return play_level, len(sequence)
+
+
+def _bench_next_level(length):
+    def build():
+        game = _playable_game(length)
+
+        def next_level():
+            game._machine = ('LEVEL_COMPLETE', game.epoch, 0)
+            game.next_level()
+            # Keep the sequence at the same length for the next call
+            game.sequence.pop()
+
+        return next_level, 1
+    return build
+
+
+for _length in (10, 1000, 100000):
+    benchmark(f'next_level[len={_length}]')(_bench_next_level(_length))
+
+
+# --- scheduler.py ---
+
+@benchmark('timer_arm_cancel')
+def bench_timer_arm_cancel():
+    scheduler = TimerScheduler()
+
+    def arm_and_cancel():
+        scheduler.call_later(10.0, lambda: None).cancel()
+
+    return arm_and_cancel, 1
+
+
+# --- journal.py ---
+
+@benchmark('journal_append')
+def bench_journal_append():
+    journal = Journal(tempfile.mkdtemp(prefix='boxbots-journal-'))
+
+    def append():
+        journal.append(INPUT, 'bench', 1, 10, 3, 1)
+
+    return append, 1
+
+
+# --- leaderboard.py ---
+
+@benchmark('leaderboard_top')
+def bench_leaderboard_top():
+    leaderboard = Leaderboard(tempfile.mkdtemp(prefix='boxbots-leaderboard-') + '/leaderboard.db', flush_interval=0.05)
+    for level in range(1, 101):
+        leaderboard.record('bench', level, 'wrong')
+    day = parse_day('today')
+    # Ask once, then give the writer thread time to work the ranking out
+    leaderboard.top('bench', day)
+    time.sleep(0.2)
+
+    def top():
+        leaderboard.top('bench', day)
+
+    return top, 1
+
+
+# --- app.py ---
+
+def _flask_app():
+    """
+    Imports the Flask server and gives it a room registry, like its 'main'
+    block does. Imported lazily, so the game benchmarks run without Flask.
+    """
+    import app
+    from rooms import RoomRegistry
+
+    if app.room_registry is None:
+        app.room_registry = RoomRegistry(app.on_player_timeout_callback)
+    return app
+
+
+@benchmark('receive_data[json]')
+def bench_receive_data_json():
+    app = _flask_app()
+    client = app.app.test_client()
+    chip_id = next(iter(app.BOARD_COLOR_MAP))
+    client.post('/data', json={'chipId': chip_id, 'distance': 0.0, 'roomId': 'bench'})
+    body = json.dumps({'chipId': chip_id, 'distance': 12.5, 'roomId': 'bench'})
+
+    def post():
+        client.post('/data', data=body, content_type='application/json')
+
+    return post, 1
+
+
+@benchmark('receive_data[binary]')
+def bench_receive_data_binary():
+    app = _flask_app()
+    client = app.app.test_client()
+    chip_id = next(iter(app.BOARD_COLOR_MAP))
+    # Every packet needs its own seq, or the server drops it as a retry
+    seqs = itertools.count(1)
+
+    def post():
+        packet = pack_trigger(chip_id, 12.5, next(seqs), room_id='bench')
+        client.post('/data', data=packet, content_type='application/octet-stream')
+
+    return post, 1
+
+
+def _bench_fanout(clients):
+    def build():
+        app = _flask_app()
+        room = app.room_registry.get_or_create(f'fanout{clients}')
+        watchers = [
+            app.socketio.test_client(app.app, query_string=f'room={room.room_id}')
+            for _ in range(clients)
+        ]
+        update = {'status': 'PLAYER_TURN', 'level': 12}
+
+        def emit():
+            app.emit_to_room(room, 'game_update', update)
+            # Empty every client's inbox, like a browser reading its socket
+            for watcher in watchers:
+                watcher.get_received()
+
+        return emit, 1
+    return build
+
+
+for _clients in (10, 100):
+    benchmark(f'fanout[game_update,{_clients}]')(_bench_fanout(_clients))
+
+
+# --- Memory ---
+
+@memory_benchmark('memory:idle_room')
+def weigh_idle_room():
+    scheduler = TimerScheduler()
+    room_ids = iter(range(10 ** 9))
+
+    def build():
+        return Room(f'room-{next(room_ids)}', lambda room: None, scheduler)
+
+    return build
+
+
+@memory_benchmark('memory:game[level=100]')
+def weigh_game():
+    # Every game of a server shares one scheduler, so it isn't weighed
+    scheduler = TimerScheduler()
+    chip_ids = [str(board) for board in range(4)]
+
+    def build():
+        game = Game(player_timeout_callback=lambda: None, scheduler=scheduler)
+        game.set_available_boards(chip_ids)
+        game.start_new_game(seed=1)
+        for _ in range(99):
+            game._machine = ('LEVEL_COMPLETE', game.epoch, 0)
+            game.next_level()
+        return game
+
+    return build
+
+
+@memory_benchmark('memory:board')
+def weigh_board():
+    chip_ids = iter(range(10 ** 9))
+
+    def build():
+        return Board(str(next(chip_ids)), 'green', 0)
+
+    return build
+
+
+# --- Running ---
+
+def measure(operation, per_call, repeat):
+    """
+    Times 'operation' and returns (best, median) seconds per operation.
+    The number of calls per sample is picked so a sample takes at least
+    MIN_SAMPLE_TIME, which keeps the clock's resolution out of the result.
+    The garbage collector is off while timing, so its pauses don't land
+    on whichever benchmark happens to be running.
+    """
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _measure(operation, per_call, repeat)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _measure(operation, per_call, repeat):
+    calls = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(calls):
+            operation()
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_SAMPLE_TIME:
+            break
+        calls *= 2
+
+    samples = [elapsed]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(calls):
+            operation()
+        samples.append(time.perf_counter() - started)
+
+    samples = sorted(sample / (calls * per_call) for sample in samples)
+    return samples[0], samples[len(samples) // 2]
+
+
+def measure_memory(build, count=MEMORY_SAMPLE_COUNT):
+    """
+    Returns how many bytes one object made by 'build' takes on average,
+    measured with tracemalloc while 'count' of them are kept alive.
+    """
+    objects = [None] * count
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for index in range(count):
+            objects[index] = build()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def run(names, memory_names, repeat):
+    """
+    Runs the named benchmarks and returns the results dictionary.
+    """
+    results = {}
+    memory = {}
+    for name in names:
+        operation, per_call = BENCHMARKS[name]()
+        best, median = measure(operation, per_call, repeat)
+        results[name] = {
+            'best_us': round(best * 1e6, 3),
+            'median_us': round(median * 1e6, 3),
+            'ops_per_s': round(1.0 / best, 1),
+        }
+        print(f"{name:<28} best {results[name]['best_us']:>12.3f} us   median {results[name]['median_us']:>12.3f} us",
+              file=sys.stderr)
+    for name in memory_names:
+        memory[name] = {'bytes': round(measure_memory(MEMORY_BENCHMARKS[name]()))}
+        print(f"{name:<28} {memory[name]['bytes']:>12} bytes", file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'benchmarks': results,
+        'memory': memory,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints how every benchmark changed against the baseline (by best time,
+    or by size for memory) and returns the names of those that got slower
+    or bigger than 'threshold'.
+    """
+    regressions = []
+    if baseline.get('platform') != results['platform'] or baseline.get('python') != results['python']:
+        print("warning: the baseline was recorded on a different platform or Python version", file=sys.stderr)
+
+    for name, result in results['benchmarks'].items():
+        before = baseline.get('benchmarks', {}).get(name)
+        if before is None:
+            print(f"{name:<28} (not in baseline)", file=sys.stderr)
+            continue
+        ratio = result['best_us'] / before['best_us']
+        verdict = 'REGRESSION' if ratio > 1.0 + threshold else 'ok'
+        if verdict == 'REGRESSION':
+            regressions.append(name)
+        print(f"{name:<28} {before['best_us']:>12.3f} -> {result['best_us']:>12.3f} us  ({ratio:5.2f}x)  {verdict}",
+              file=sys.stderr)
+
+    for name, result in results['memory'].items():
+        before = baseline.get('memory', {}).get(name)
+        if before is None:
+            print(f"{name:<28} (not in baseline)", file=sys.stderr)
+            continue
+        ratio = result['bytes'] / before['bytes']
+        verdict = 'REGRESSION' if ratio > 1.0 + threshold else 'ok'
+        if verdict == 'REGRESSION':
+            regressions.append(name)
+        print(f"{name:<28} {before['bytes']:>12} -> {result['bytes']:>12} bytes  ({ratio:5.2f}x)  {verdict}",
+              file=sys.stderr)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the boxBots server's hot paths.")
+    parser.add_argument('--filter', default='', help="only run benchmarks whose name contains this")
+    parser.add_argument('--repeat', type=int, default=7, help="samples per benchmark")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against the results saved in this file")
+    parser.add_argument('--save-baseline', help="save the results as the new baseline in this file")
+    parser.add_argument('--threshold', type=float, default=0.20,
+                        help="how much slower than the baseline counts as a regression (0.20 = 20%%)")
+    options = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if options.filter in name]
+    memory_names = [name for name in MEMORY_BENCHMARKS if options.filter in name]
+    if not names and not memory_names:
+        parser.error(f"no benchmark matches '{options.filter}'")
+
+    results = run(names, memory_names, max(1, options.repeat))
+    # The results go to standard output, everything else to standard error
+    print(json.dumps(results, indent=2))
+
+    for path in (options.output, options.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# broker.py
+# This file contains a tiny local message broker, so several server worker
+# processes on one machine can talk to each other without any outside
+# service (no Redis, no RabbitMQ).
+#
+# The broker listens on a Unix domain socket. Every connected process can
+# subscribe to topics and publish messages to them; the broker forwards each
+# message to every connection subscribed to its topic (including the
+# sender, if it is subscribed). It never looks inside a message.
+#
+# Every frame on the socket is:
+#
+#   op (1 byte)   b'S' subscribe, b'P' publish, b'M' message (broker -> client)
+#   topic length  2 bytes, big-endian
+#   data length   4 bytes, big-endian
+#   topic         UTF-8
+#   data          any bytes
+#
+# It also contains 'LocalBrokerManager', the python-socketio client manager
+# that shares SocketIO rooms between workers through the broker.
+
+import asyncio # The broker and its clients are asyncio streams
+import json    # SocketIO manager messages are JSON
+import os      # To remove a stale socket file
+import struct  # The frame header
+
+from socketio.async_pubsub_manager import AsyncPubSubManager # python-socketio's base class for shared rooms
+
+from log import get_logger, setup_logging # Structured, level-gated logging
+
+log = get_logger('broker')
+
+FRAME_HEADER = struct.Struct('>cHI')
+SUBSCRIBE = b'S'
+PUBLISH = b'P'
+MESSAGE = b'M'
+
+# A subscriber that falls this far behind (bytes waiting to be sent) is
+# disconnected, so one stuck worker can't make the broker run out of memory
+MAX_SUBSCRIBER_BACKLOG = 16 * 1024 * 1024
+
+# The longest wait between two attempts to reconnect to a lost broker (seconds)
+MAX_RECONNECT_SLEEP = 30
+
+
+def _frame(op, topic, data):
+    topic = topic.encode('utf-8')
+    return FRAME_HEADER.pack(op, len(topic), len(data)) + topic + data
+
+
+async def _read_frame(reader):
+    """
+    Reads one frame. Returns (op, topic, data), or raises
+    asyncio.IncompleteReadError when the other side has closed.
+    """
+    op, topic_length, data_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    topic = (await reader.readexactly(topic_length)).decode('utf-8')
+    data = await reader.readexactly(data_length)
+    return op, topic, data
+
+
+class Broker:
+    """
+    The broker itself: one asyncio server on a Unix domain socket.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # { topic: set of StreamWriters subscribed to it }
+        self.subscribers = {}
+
+    async def serve_forever(self):
+        if os.path.exists(self.path):
+            # Left over from a broker that didn't shut down cleanly
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        log.info('broker_started', path=self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        topics = set()
+        try:
+            while True:
+                op, topic, data = await _read_frame(reader)
+                if op == SUBSCRIBE:
+                    topics.add(topic)
+                    self.subscribers.setdefault(topic, set()).add(writer)
+                elif op == PUBLISH:
+                    self._publish(topic, data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic in topics:
+                self.subscribers.get(topic, set()).discard(writer)
+            writer.close()
+
+    def _publish(self, topic, data):
+        frame = _frame(MESSAGE, topic, data)
+        for writer in list(self.subscribers.get(topic, ())):
+            if writer.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BACKLOG:
+                log.warning('subscriber_dropped', topic=topic)
+                writer.close()
+                self.subscribers[topic].discard(writer)
+                continue
+            writer.write(frame)
+
+
+def run_broker(path):
+    """
+    Runs a broker on 'path' until the process is stopped.
+    """
+    setup_logging()
+    asyncio.run(Broker(path).serve_forever())
+
+
+class BrokerClient:
+    """
+    One connection to the broker, for one asyncio event loop.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+
+    async def subscribe(self, topic):
+        self.writer.write(_frame(SUBSCRIBE, topic, b''))
+        await self.writer.drain()
+
+    async def publish(self, topic, data):
+        self.writer.write(_frame(PUBLISH, topic, data))
+        await self.writer.drain()
+
+    async def messages(self):
+        """
+        Yields (topic, data) for every message on a subscribed topic.
+        """
+        while True:
+            op, topic, data = await _read_frame(self.reader)
+            if op == MESSAGE:
+                yield topic, data
+
+
+class LocalBrokerManager(AsyncPubSubManager):
+    """
+    A python-socketio client manager that shares rooms between worker
+    processes through the local broker. An emit to a room on any worker
+    reaches the room's browsers on every worker.
+    """
+
+    name = 'localbroker'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.client = None
+        self._connecting = None
+
+    async def _connected_client(self):
+        # Publishing can start before the listener has connected, so
+        # whoever gets here first connects and everyone else waits for it
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        await self._connecting
+        return self.client
+
+    async def _connect(self):
+        client = BrokerClient(self.path)
+        await client.connect()
+        await client.subscribe(self.channel)
+        self.client = client
+
+    async def _publish(self, data):
+        try:
+            client = await self._connected_client()
+            await client.publish(self.channel, json.dumps(data).encode('utf-8'))
+        except OSError:
+            # Connect again next time
+            self._connecting = None
+            raise
+
+    async def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                client = await self._connected_client()
+                async for _, data in client.messages():
+                    retry_sleep = 1
+                    yield data
+            except (asyncio.IncompleteReadError, OSError):
+                # The broker went away. Keep trying, less and less often,
+                # like python-socketio's own Redis manager does.
+                log.warning('broker_connection_lost', retry_in=retry_sleep)
+                self._connecting = None
+                await asyncio.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, MAX_RECONNECT_SLEEP)
+
+
+def client_manager_for(url):
+    """
+    Returns the SocketIO client manager for a message queue URL:
+    'local:<socket path>' for the local broker. None (no URL) means a
+    single process, which needs no manager.
+    """
+    if not url:
+        return None
+    if url.startswith('local:'):
+        return LocalBrokerManager(url[len('local:'):])
+    raise ValueError(f"Unsupported message queue URL: {url}")
@@ -0,0 +1,385 @@
+# cluster.py
+# This file lets the asyncio server ('asgi_app.py') run as several worker
+# processes on one machine, so it can use every CPU core.
+#
+# - All workers share one TCP port (SO_REUSEPORT), so the kernel spreads
+#   station requests and browser sockets across them.
+# - SocketIO rooms are shared through the local broker ('broker.py'): an
+#   emit on one worker reaches the room's browsers on every worker.
+# - Every room's Game lives on exactly ONE worker, its owner. A worker that
+#   receives a trigger or a 'start_game' for a room it doesn't own forwards
+#   it to the owner through the broker, so each game's sequence and timer
+#   only ever exist in one place and need no lock shared between processes.
+# - Owners are picked with a consistent-hash ring ('ShardMap'). Workers
+#   send each other heartbeats; when one joins or leaves, only the rooms
+#   that change owner move, and the old owner hands each of them (boards,
+#   sequence, level, turn time left) over to the new one.
+#
+# Run it with:   python cluster.py --workers 4
+
+import argparse        # Command line options
+import asyncio         # Heartbeats, and to notice the broker closing the connection
+import bisect          # To find a room's place on the hash ring
+import hashlib         # A hash of the room ID that is the same in every process
+import json            # Forwarded messages are JSON
+import multiprocessing # One process for the broker and one per worker
+import os              # Worker settings are passed in environment variables
+import signal          # To stop the workers when the launcher is stopped
+import socket          # The shared listening socket
+import sys             # To turn SIGTERM into a clean exit
+import tempfile        # Where the broker's socket file lives by default
+import time            # To wait for the broker to start
+
+from broker import BrokerClient, run_broker
+from log import get_logger, setup_logging
+from rooms import DEFAULT_ROOM_ID
+
+log = get_logger('cluster')
+
+# Forwarded messages for worker N are published on this topic
+WORKER_TOPIC = 'worker:{}'
+# Heartbeats and goodbyes between workers are published on this topic
+MEMBERSHIP_TOPIC = 'cluster'
+
+# Every worker sends a heartbeat this often (seconds)...
+HEARTBEAT_INTERVAL = 1.0
+# ...and is considered gone (crashed or stopped) after this long without one
+MEMBER_TIMEOUT = 3.5
+
+# Each worker is placed this many times on the hash ring, so rooms spread
+# evenly and a worker joining or leaving only moves its fair share of them
+RING_REPLICAS = 64
+
+# While workers join or leave they may briefly disagree about who owns a
+# room. A forwarded message is passed on at most this many times, then
+# handled where it is, so it can never bounce around forever.
+MAX_FORWARD_HOPS = 3
+
+
+def _ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class ShardMap:
+    """
+    A consistent-hash ring that maps every room ID to one worker ID.
+
+    Each worker owns the stretches of the ring just before its points. When
+    a worker is added or removed, only the rooms in its stretches change
+    owner; all other rooms stay where they are.
+    """
+
+    def __init__(self, workers=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self.workers = set()
+        # The sorted hash points, and the worker at each of them
+        self._points = []
+        self._owners = []
+        for worker_id in workers:
+            self.add(worker_id)
+
+    def add(self, worker_id):
+        """
+        Adds a worker. Returns False if it was already on the ring.
+        """
+        if worker_id in self.workers:
+            return False
+        self.workers.add(worker_id)
+        self._build()
+        return True
+
+    def remove(self, worker_id):
+        """
+        Removes a worker. Returns False if it wasn't on the ring.
+        """
+        if worker_id not in self.workers:
+            return False
+        self.workers.discard(worker_id)
+        self._build()
+        return True
+
+    def _build(self):
+        ring = sorted(
+            (_ring_hash(f'worker:{worker_id}:{replica}'), worker_id)
+            for worker_id in self.workers
+            for replica in range(self.replicas)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [worker_id for _, worker_id in ring]
+
+    def owner_of(self, room_id):
+        """
+        Returns the ID of the worker that owns 'room_id', or None if there
+        are no workers at all.
+        """
+        if not self._points:
+            return None
+        room_id = str(room_id) if room_id else DEFAULT_ROOM_ID
+        index = bisect.bisect(self._points, _ring_hash(room_id)) % len(self._points)
+        return self._owners[index]
+
+    def copy(self):
+        return ShardMap(self.workers, self.replicas)
+
+
+class Cluster:
+    """
+    This worker's place in the cluster: its ID, the shard map that says
+    which worker owns each room, and the broker connection used to forward
+    work to the owner. With one worker, it owns every room and nothing is
+    ever forwarded.
+    """
+
+    def __init__(self, worker_id=0, worker_count=1, broker_path=None):
+        if worker_count > 1 and not broker_path:
+            raise ValueError("Several workers need a broker to forward messages through")
+        self.worker_id = worker_id
+        self.worker_count = worker_count
+        self.broker_path = broker_path
+        self.client = None
+
+        # Every worker starts out expecting all 'worker_count' workers, so
+        # they all agree on the owners from the start. Workers that never
+        # send a heartbeat are dropped after MEMBER_TIMEOUT.
+        self.shard_map = ShardMap(range(worker_count))
+        # { worker_id: event loop time of its last heartbeat }, other workers only
+        self.last_seen = {}
+        # Called with the previous ShardMap whenever a worker joins or leaves
+        self.on_change = None
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Reads the settings 'run_workers' gives each worker process.
+        """
+        message_queue = os.environ.get('BOXBOTS_MESSAGE_QUEUE', '')
+        return cls(
+            worker_id=int(os.environ.get('BOXBOTS_WORKER_ID', '0')),
+            worker_count=int(os.environ.get('BOXBOTS_WORKERS', '1')),
+            broker_path=message_queue[len('local:'):] if message_queue.startswith('local:') else None
+        )
+
+    @property
+    def distributed(self):
+        """True when there is more than one worker."""
+        return self.worker_count > 1
+
+    def owner_of(self, room_id):
+        """
+        Returns the ID of the worker that owns 'room_id'. Every worker
+        computes the same answer from its shard map, without asking anyone.
+        """
+        return self.shard_map.owner_of(room_id)
+
+    def owns(self, room_id):
+        return self.owner_of(room_id) == self.worker_id
+
+    async def route(self, room_id, message):
+        """
+        Returns True if this worker should handle 'message' (a JSON-able
+        dictionary about 'room_id') itself. Otherwise forwards it to the
+        room's owner and returns False.
+        """
+        hops = message.get('hops', 0)
+        if self.owns(room_id) or hops >= MAX_FORWARD_HOPS:
+            return True
+        await self.forward(self.owner_of(room_id), dict(message, hops=hops + 1))
+        return False
+
+    async def start(self, handle_message, on_change):
+        """
+        Connects to the broker, then calls 'await handle_message(message)'
+        for every message forwarded to this worker, and
+        'await on_change(previous_shard_map)' whenever a worker joins or
+        leaves. Runs until cancelled.
+        """
+        if not self.distributed:
+            return
+        self.on_change = on_change
+        self.client = BrokerClient(self.broker_path)
+        await self.client.connect()
+        await self.client.subscribe(WORKER_TOPIC.format(self.worker_id))
+        await self.client.subscribe(MEMBERSHIP_TOPIC)
+        log.info('worker_joined', worker=self.worker_id, workers=self.worker_count)
+
+        loop = asyncio.get_running_loop()
+        for worker_id in self.shard_map.workers - {self.worker_id}:
+            self.last_seen[worker_id] = loop.time()
+        heartbeats = asyncio.ensure_future(self._send_heartbeats())
+
+        try:
+            async for topic, data in self.client.messages():
+                message = json.loads(data)
+                try:
+                    if topic == MEMBERSHIP_TOPIC:
+                        await self._handle_membership(message)
+                    else:
+                        await handle_message(message)
+                except Exception:
+                    log.exception('forwarded_message_failed', topic=topic)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The broker stopped, which only happens when the cluster does
+            log.warning('broker_disconnected', worker=self.worker_id)
+        finally:
+            heartbeats.cancel()
+
+    async def forward(self, worker_id, message):
+        """
+        Sends 'message' (a JSON-able dictionary) to another worker.
+        """
+        await self.client.publish(WORKER_TOPIC.format(worker_id), json.dumps(message).encode('utf-8'))
+
+    async def leave(self):
+        """
+        Hands this worker's rooms over to the others and says goodbye, so
+        they don't have to wait MEMBER_TIMEOUT to notice it is gone. Called
+        when the worker shuts down.
+        """
+        if self.client is None:
+            return
+        previous = self.shard_map.copy()
+        self.shard_map.remove(self.worker_id)
+        try:
+            await self.on_change(previous)
+            await self._announce('leave')
+        except OSError:
+            # The broker is already gone, so the whole cluster is stopping
+            log.warning('leave_failed', worker=self.worker_id)
+
+    # --- Membership ---
+
+    async def _announce(self, kind):
+        await self.client.publish(MEMBERSHIP_TOPIC, json.dumps({'type': kind, 'worker': self.worker_id}).encode('utf-8'))
+
+    async def _send_heartbeats(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._announce('heartbeat')
+            # Drop the workers that have gone quiet
+            now = loop.time()
+            for worker_id, seen_at in list(self.last_seen.items()):
+                if now - seen_at > MEMBER_TIMEOUT:
+                    del self.last_seen[worker_id]
+                    await self._change_members(remove=worker_id)
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def _handle_membership(self, message):
+        worker_id = message['worker']
+        if worker_id == self.worker_id:
+            return
+        if message['type'] == 'leave':
+            self.last_seen.pop(worker_id, None)
+            await self._change_members(remove=worker_id)
+            return
+
+        is_new = worker_id not in self.last_seen
+        self.last_seen[worker_id] = asyncio.get_running_loop().time()
+        if is_new:
+            # Answer right away, so the new worker learns about us too
+            await self._announce('heartbeat')
+            await self._change_members(add=worker_id)
+
+    async def _change_members(self, add=None, remove=None):
+        previous = self.shard_map.copy()
+        if add is not None:
+            changed = self.shard_map.add(add)
+        else:
+            changed = self.shard_map.remove(remove)
+        if changed:
+            log.info('shard_map_changed', worker=self.worker_id, workers=sorted(self.shard_map.workers))
+            await self.on_change(previous)
+
+
+# --- Launcher ---
+
+def _listening_socket(host, port):
+    """
+    A TCP socket that several processes can listen on at once.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    return listener
+
+
+def _run_worker(worker_id, worker_count, broker_path, host, port):
+    """
+    The body of one worker process.
+    """
+    # 'asgi_app' reads these when it is imported
+    os.environ['BOXBOTS_WORKER_ID'] = str(worker_id)
+    os.environ['BOXBOTS_WORKERS'] = str(worker_count)
+    os.environ['BOXBOTS_MESSAGE_QUEUE'] = f"local:{broker_path}"
+
+    import uvicorn
+    import asgi_app
+
+    server = uvicorn.Server(uvicorn.Config(asgi_app.app, log_level='warning', lifespan='on'))
+    server.run(sockets=[_listening_socket(host, port)])
+
+
+def run_workers(worker_count, host='0.0.0.0', port=5000, broker_path=None):
+    """
+    Starts the broker and 'worker_count' workers, and waits for them.
+    """
+    broker_path = broker_path or os.path.join(tempfile.gettempdir(), f"boxbots-broker-{port}.sock")
+    # 'spawn' gives every worker a fresh interpreter, with nothing
+    # (threads, sockets, rooms) copied from this one
+    context = multiprocessing.get_context('spawn')
+
+    # A socket file left by a broker that was killed would look like a
+    # running broker below, so remove it first
+    if os.path.exists(broker_path):
+        os.unlink(broker_path)
+    broker = context.Process(target=run_broker, args=(broker_path,), name='broker', daemon=True)
+    broker.start()
+    deadline = time.monotonic() + 10.0
+    while not os.path.exists(broker_path):
+        if time.monotonic() > deadline or not broker.is_alive():
+            raise RuntimeError("The broker didn't start")
+        time.sleep(0.05)
+
+    workers = [
+        context.Process(target=_run_worker, args=(worker_id, worker_count, broker_path, host, port),
+                        name=f'worker-{worker_id}')
+        for worker_id in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    log.info('cluster_started', workers=worker_count, port=port, broker=broker_path)
+
+    # Stopping the launcher (Ctrl+C, or SIGTERM from a service manager)
+    # stops the workers too, instead of leaving them holding the port
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        # Stop the broker last, so no worker loses it while shutting down
+        for worker in workers:
+            worker.join()
+        broker.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the asyncio server as several worker processes.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--broker', help="path of the broker's Unix socket")
+    options = parser.parse_args(argv)
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    setup_logging()
+    run_workers(options.workers, options.host, options.port, options.broker)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,17 @@
   to the server if the distance is between 5cm and 50cm.
   It will not send a trigger message more than once every 0.5 seconds.
 
+  TRIGGER TRANSPORT:
+  - By default every trigger is an HTTP POST to /data.
+  - Set USE_UDP_TRIGGERS to 1 to send triggers as single UDP datagrams to
+    the server's trigger port instead. There is no new TCP connection and
+    no response to wait for, so the trigger reaches the game in a few
+    milliseconds. The first "registration" packet is still sent over HTTP
+    so the station knows the server is really there.
+  - UDP triggers use the compact 24-byte binary packet defined in the
+    server's protocol.py (see 'TriggerPacket' below) instead of JSON.
+    Binary packets only fit room names of up to 8 characters.
+
   LED STATUS CODES:
   - Fast Flash (100ms): Connecting to Wi-Fi.
   - Slow Blink (1000ms): Wi-Fi connected, but searching for the server.
@@ -33,6 +44,12 @@ const int MAX_MSG_LEN = 50;
 // --- Configuration: Server ---
 String server_ip = ""; // Will be populated by discovery
 const int server_port = 5000; // Flask server port
+const char* room_id = "default"; // The game room this station plays in
+
+// --- Configuration: Trigger Transport ---
+// 0 = HTTP POST to /data for every trigger, 1 = one UDP datagram per trigger
+#define USE_UDP_TRIGGERS 0
+const int trigger_port = 5008; // Must match TRIGGER_PORT in app.py
 
 // --- Configuration: LED Control ---
 // Define the logic level for turning the built-in LED ON or OFF
@@ -52,8 +69,23 @@ unsigned long lastLedToggleTime = 0;
 unsigned long lastTriggerTime = 0; // Time of the last successful trigger
 const unsigned long triggerInterval = 1500; // 1.5 second debounce time
 
+// --- Binary Trigger Packet (must match protocol.py on the server) ---
+#define TRIGGER_MAGIC 0xB7
+#define TRIGGER_VERSION 1
+struct __attribute__((packed)) TriggerPacket {
+  uint8_t magic;       // Always TRIGGER_MAGIC
+  uint8_t version;     // Always TRIGGER_VERSION
+  uint32_t chipId;     // ESP.getChipId()
+  uint16_t distanceMm; // Distance in millimetres (0 = registration)
+  uint32_t seq;        // +1 for every packet this station sends
+  uint32_t stationMs;  // millis() when the trigger fired
+  char roomId[8];      // Room name, NUL-padded
+};
+uint32_t triggerSeq = 0; // Sequence number of the last packet sent
+
 // --- Global Objects ---
 WiFiUDP udp; // UDP object for multicast listening
+WiFiUDP triggerUdp; // UDP object for sending triggers in UDP mode
 char incoming_packet[MAX_MSG_LEN]; // Buffer for incoming UDP packets
 int currentLedState = LED_OFF_STATE; // Tracks the current state of the LED
 
@@ -225,7 +257,11 @@ void handleRunning() {
       Serial.print(distance);
       Serial.println(" cm ---");
       
+#if USE_UDP_TRIGGERS
+      sendTriggerDatagram(distance);
+#else
       sendTriggerData(distance);
+#endif
     }
     // else: A trigger happened, but we are inside the 500ms
     //       debounce window, so we do nothing.
@@ -289,6 +325,65 @@ void startServerDiscovery() {
   }
 }
 
+// =================================================================
+// HELPER FUNCTION: Build the Trigger JSON
+// =================================================================
+String buildTriggerJson(float distance) {
+  return String("{\"message\":\"Triggered\"") +
+         ", \"chipId\":" + String(ESP.getChipId()) +
+         ", \"roomId\":\"" + room_id + "\"" +
+         ", \"distance\":" + String(distance, 2) +
+         // Our own counter and clock, so the server's trace of this trigger
+         // can be matched to this board's serial log
+         ", \"seq\":" + String(++triggerSeq) +
+         ", \"ms\":" + String(millis()) + "}";
+}
+
+// =================================================================
+// HELPER FUNCTION: Send a Trigger as one UDP Datagram
+// =================================================================
+void sendTriggerDatagram(float distance) {
+  // Check if Wi-Fi is still connected.
+  if (WiFi.status() != WL_CONNECTED) {
+    Serial.println("WiFi disconnected, attempting to reconnect...");
+    currentState = STATE_CONNECTING_WIFI;
+    server_ip = "";
+    digitalWrite(LED_BUILTIN, LED_OFF_STATE);
+    currentLedState = LED_OFF_STATE;
+    return;
+  }
+
+  IPAddress server_address;
+  server_address.fromString(server_ip);
+
+  // Fill in the fixed-layout binary packet (the ESP8266 is little-endian,
+  // which is the byte order the server expects)
+  TriggerPacket packet;
+  memset(&packet, 0, sizeof(packet));
+  packet.magic = TRIGGER_MAGIC;
+  packet.version = TRIGGER_VERSION;
+  packet.chipId = ESP.getChipId();
+  packet.distanceMm = (uint16_t)(distance * 10.0);
+  packet.seq = ++triggerSeq;
+  packet.stationMs = millis();
+  strncpy(packet.roomId, room_id, sizeof(packet.roomId));
+
+  // Fire and forget: there is no connection to open and no response.
+  if (triggerUdp.beginPacket(server_address, trigger_port)) {
+    triggerUdp.write((const uint8_t*)&packet, sizeof(packet));
+    if (triggerUdp.endPacket()) {
+      Serial.print("Sent UDP trigger #");
+      Serial.println(packet.seq);
+      return;
+    }
+  }
+
+  // The datagram couldn't even leave the board, so fall back to HTTP.
+  // If the server is gone, sendTriggerData will notice and rediscover it.
+  Serial.println("UDP send failed, falling back to HTTP.");
+  sendTriggerData(distance);
+}
+
 // =================================================================
 // HELPER FUNCTION: Send Data to Server
 // =================================================================
@@ -321,9 +416,7 @@ void sendTriggerData(float distance) {
     http.addHeader("Content-Type", "application/json");
     
     // Create the JSON payload as a string
-    String jsonPayload = String("{\"message\":\"Triggered\"") +
-                         ", \"chipId\":" + String(ESP.getChipId()) +
-                         ", \"distance\":" + String(distance, 2) + "}";
+    String jsonPayload = buildTriggerJson(distance);
                          
     Serial.print("Sending JSON: ");
     Serial.println(jsonPayload);
@@ -3,166 +3,559 @@
 # It is designed to be imported by the main 'app.py' server and does not
 # contain any Flask or SocketIO-specific code.
 
-import random # Used to pick a new board for the sequence
-import threading # Used to manage the 10-second player timer
+from array import array # Compact storage for sequences and precomputed board picks
+import os # Fresh seeds for games that weren't given one
+import random # Each game has its own seeded generator for its sequence
+import threading # Used for the tiny per-game lock behind compare-and-set
+
+import journal # Records what happens to the game, if the server keeps a journal
+from log import DEBUG, get_logger # Structured, level-gated logging
+import metrics # Counts turns that ran out of time
+from scheduler import default_scheduler # Shared timer service for the 10-second player timer
+
+log = get_logger('game')
+
+TURN_TIMEOUTS = metrics.counter('boxbots_turn_timeouts_total', 'Player turns that ended because time ran out.')
+
+# Board picks are worked out this many levels at a time
+SEQUENCE_PLAN_BLOCK = 64
+
+
+def new_seed():
+    """
+    A fresh random seed for a game that wasn't given one.
+    """
+    return int.from_bytes(os.urandom(4), 'big')
+
+
+class SequencePlan:
+    """
+    Every board a game will ask for, level after level, worked out ahead of
+    time from one seed. The picks are board indexes (positions in the
+    game's 'available_boards') in a compact array, generated
+    SEQUENCE_PLAN_BLOCK at a time, so advancing a level is an array lookup
+    and not a call into a random number generator.
+
+    Each block comes from its own 'random.Random', seeded with the game's
+    seed and the block's position, so games never share (or wait for) the
+    global generator, and the same seed with the same boards always gives
+    the same sequence. The generator is thrown away after its block, since
+    keeping one per game would cost about 3 KB.
+    """
+
+    __slots__ = ('seed', 'avoid_repeats', 'board_count', 'indexes')
+
+    def __init__(self, seed, board_count, avoid_repeats=False):
+        self.seed = seed
+        # If True, a board is never picked twice in a row
+        self.avoid_repeats = avoid_repeats
+        self.board_count = board_count
+        self.indexes = array('H')
+
+    def index_at(self, position):
+        """
+        Returns the board index for the 'position'-th board of the sequence
+        (0 for level 1's board, 1 for level 2's, ...).
+        """
+        while position >= len(self.indexes):
+            self._extend()
+        return self.indexes[position]
+
+    def change_board_count(self, board_count, used):
+        """
+        Boards were added or removed during a game. The first 'used' picks
+        have already been played; the rest are worked out again for the new
+        number of boards.
+        """
+        if board_count != self.board_count:
+            del self.indexes[used:]
+            self.board_count = board_count
+
+    def _extend(self):
+        count = self.board_count
+        rng = random.Random(f'{self.seed}:{len(self.indexes)}')
+        if not self.avoid_repeats or count < 2:
+            self.indexes.extend(rng.choices(range(count), k=SEQUENCE_PLAN_BLOCK))
+            return
+
+        # Pick one of the *other* boards: draw from count - 1 boards and
+        # skip over the previous pick
+        previous = self.indexes[-1] if self.indexes else count
+        block = array('H')
+        for index in rng.choices(range(count - 1), k=SEQUENCE_PLAN_BLOCK):
+            if index >= previous:
+                index += 1
+            block.append(index)
+            previous = index
+        self.indexes.extend(block)
+
 
 class Game:
     """
     Manages the state and logic of a single "Simon Says" game instance.
+
+    The game is a versioned state machine. Its state is one immutable tuple,
+    (state, epoch, player_input_index), and every change is a
+    compare-and-set on it: "if the game is still in state S at epoch E,
+    move it to state T". The epoch goes up by one on every state change, so
+    anything that was started for an older epoch (a turn timer, a sequence
+    being shown, a late input) is rejected cheaply instead of corrupting the
+    current turn.
+
+    Several threads call into a Game at once (request threads, the timer
+    scheduler, SocketIO background tasks). Reads never lock; writes take
+    this game's own lock only for the few instructions of the
+    compare-and-set, so games in different rooms never wait for each other.
+
+    Games use '__slots__' instead of a per-instance '__dict__', because a
+    server may hold one for each of thousands of mostly idle rooms.
     """
 
-    def __init__(self, player_timeout_callback):
+    __slots__ = (
+        'room_id', '_machine', '_cas_lock', 'available_boards', 'board_indexes',
+        'sequence', 'plan', 'avoid_repeats', 'scheduler', 'player_timer',
+        'on_player_timeout', 'turn_timeout_duration', 'journal', 'leaderboard'
+    )
+
+    # The states in which a game can be (re)started
+    STARTABLE_STATES = ('IDLE', 'GAME_OVER')
+
+    def __init__(self, player_timeout_callback, scheduler=None, room_id=None, avoid_repeats=False, journal=None,
+                 leaderboard=None):
+        # The room this game belongs to (only used to label log lines)
+        self.room_id = room_id
+
         # --- Game State ---
         # 'IDLE': Waiting for the 'Start' button
         # 'SHOWING': The server is showing the sequence to the player
         # 'PLAYER_TURN': The server is waiting for the player's input
+        # 'LEVEL_COMPLETE': The player finished the level, next one coming
         # 'GAME_OVER': The player made a mistake or timed out
-        self.state = 'IDLE'
+        #
+        # (state, epoch, player_input_index). Only ever replaced as a whole,
+        # so reading it gives a consistent snapshot without any lock.
+        self._machine = ('IDLE', 0, 0)
+        # Makes each compare-and-set atomic. One lock per game, never global.
+        self._cas_lock = threading.Lock()
 
         # --- Board Configuration ---
         # This list will be populated by 'app.py' with the chipIds
-        # of the ESP boards that have connected.
+        # of the ESP boards that have connected. A board's position in it
+        # is its board index, which never changes once given out.
         self.available_boards = []
+        # { chipId: board index }, the reverse of 'available_boards'
+        self.board_indexes = {}
 
         # --- Sequence Management ---
-        # This list stores the correct sequence of chipIds for the current game
-        self.sequence = []
-        # This tracks how many inputs the player has correctly entered so far
-        self.player_input_index = 0
+        # The correct sequence for the current game, as board indexes in a
+        # compact array (2 bytes per level). Inputs are checked by comparing
+        # small integers; chipIds are only looked up to show the sequence.
+        self.sequence = array('H')
+        # The boards the current game will pick, worked out from its seed
+        # (see 'SequencePlan'). Created when a game starts.
+        self.plan = None
+        # If True, the sequence never asks for the same board twice in a row
+        self.avoid_repeats = avoid_repeats
 
         # --- Game Timer ---
-        # Stores the threading.Timer object for the player's 10-second turn
+        # The shared scheduler that fires turn timeouts for every game.
+        # All games register their deadlines with it instead of each
+        # starting its own timer thread.
+        self.scheduler = scheduler or default_scheduler
+        # Stores the TimerHandle for the player's 10-second turn
         self.player_timer = None
         # The callback function (provided by 'app.py') to run if the timer expires
         self.on_player_timeout = player_timeout_callback
         # The duration (in seconds) the player has for their turn
-        self.turn_timeout_duration = 10.0 
+        self.turn_timeout_duration = 10.0
+
+        # The server's journal (see 'journal.py'), or None to keep no record
+        self.journal = journal
+        # The server's leaderboard (see 'leaderboard.py'), or None
+        self.leaderboard = leaderboard
+
+    def _record(self, kind, board=0, index=0, value=0):
+        """
+        Appends one record about this game to the journal, if there is one.
+        """
+        if self.journal is not None:
+            self.journal.append(kind, self.room_id, board, len(self.sequence), index, value)
+
+    def _game_over(self, reason):
+        """
+        Records the end of the game ('reason' is one of the journal's
+        REASON_ codes) in the journal and the level it reached on the
+        leaderboard.
+        """
+        self._record(journal.GAME_OVER, value=reason)
+        if self.leaderboard is not None:
+            self.leaderboard.record(self.room_id, len(self.sequence), journal.GAME_OVER_REASONS[reason],
+                                    self.plan.seed if self.plan is not None else None)
+
+    # --- Versioned State ---
+
+    @property
+    def state(self):
+        """The current state name, e.g. 'PLAYER_TURN'."""
+        return self._machine[0]
+
+    @property
+    def epoch(self):
+        """Goes up by one every time the state changes."""
+        return self._machine[1]
+
+    @property
+    def player_input_index(self):
+        """How many inputs the player has correctly entered so far."""
+        return self._machine[2]
+
+    def get_snapshot(self):
+        """
+        Returns (state, epoch, player_input_index) as one consistent tuple.
+        """
+        return self._machine
+
+    def _compare_and_set(self, expected_state, expected_epoch, new_state,
+                         expected_index=None, new_index=0):
+        """
+        Atomically moves the game to 'new_state' if, and only if, it is still
+        in 'expected_state' at 'expected_epoch' (and, if given, at
+        'expected_index'). Returns the new epoch, or None if something else
+        changed the game first.
+        """
+        with self._cas_lock:
+            state, epoch, index = self._machine
+            if state != expected_state or epoch != expected_epoch:
+                return None
+            if expected_index is not None and index != expected_index:
+                return None
+
+            # Moving within the same state (e.g. the player's next input)
+            # keeps the epoch, so timers armed for this turn stay valid.
+            if new_state != state:
+                epoch += 1
+            self._machine = (new_state, epoch, new_index)
+            return epoch
 
     def set_available_boards(self, board_chip_ids):
         """
         Called by the server to update the list of boards available for the game.
         This allows the game to know which chipIds are valid to use.
+        Every new chipId gets the next board index; boards that are already
+        known keep theirs, so the sequence stays valid.
         """
-        self.available_boards = list(board_chip_ids)
-        print(f"[Game] Available boards updated: {self.available_boards}")
+        for chip_id in board_chip_ids:
+            if chip_id not in self.board_indexes:
+                self.board_indexes[chip_id] = len(self.available_boards)
+                self.available_boards.append(chip_id)
+                if self.journal is not None:
+                    self._record(journal.BOARD_ADDED, self.board_indexes[chip_id],
+                                 value=journal.journal_chip_id(chip_id))
+        if self.plan is not None:
+            self.plan.change_board_count(len(self.available_boards), len(self.sequence))
+        log.info('boards_updated', room=self.room_id, boards=len(self.available_boards))
 
-    def start_new_game(self):
+    def is_active(self):
+        """
+        True while a game is running (showing, waiting for input, or
+        between levels), i.e. when it can't be started again.
+        """
+        return self.state not in self.STARTABLE_STATES
+
+    def start_new_game(self, seed=None):
         """
         Resets all game variables to start a fresh game from level 1.
+        'seed' replays the game that was played with that seed (and the same
+        boards); without it, the game gets a fresh random seed.
+        Returns the epoch of the new 'SHOWING' state, or None if the game
+        couldn't be started (no boards, or a game is already running).
         """
         # Do not start a game if no boards are connected
         if not self.available_boards:
-            print("[Game] Cannot start game, no boards are available.")
-            return False
+            log.warning('start_failed', room=self.room_id, reason='no_boards')
+            return None
+
+        state, epoch, _ = self._machine
+        if state not in self.STARTABLE_STATES:
+            log.info('start_ignored', room=self.room_id, state=state)
+            return None
+
+        # Claim the game. If another thread started it first, we lose here.
+        new_epoch = self._compare_and_set(state, epoch, 'SHOWING')
+        if new_epoch is None:
+            log.info('start_ignored', room=self.room_id, reason='lost_race')
+            return None
 
-        print("[Game] Starting new game...")
-        self.sequence = [] # Clear the sequence
-        self.player_input_index = 0 # Reset player's position
-        self.state = 'IDLE' # Set to idle before starting the first level
         self._cancel_player_timer() # Ensure any old timer is cancelled
-        
+        self.sequence = array('H') # Clear the sequence
+        self.plan = SequencePlan(new_seed() if seed is None else seed, len(self.available_boards), self.avoid_repeats)
+        log.info('game_started', room=self.room_id, epoch=new_epoch, seed=self.plan.seed)
+        self._record(journal.GAME_STARTED, index=int(self.avoid_repeats), value=journal.journal_seed(self.plan.seed))
+
         # Automatically move to the first level
-        self.next_level()
-        return True
+        self._add_to_sequence()
+        return new_epoch
 
-    def next_level(self):
+    def next_level(self, expected_epoch=None):
         """
         Adds one new random board to the end of the sequence and prepares
         the game state for the server to show the sequence.
+        'expected_epoch' is the epoch at which the level was completed; if
+        the game has moved on since (e.g. it was restarted), nothing happens.
+        Returns the epoch of the new 'SHOWING' state, or None.
         """
+        state, epoch, _ = self._machine
+        if expected_epoch is None:
+            expected_epoch = epoch
+
         # This should not be called if no boards are available,
         # but 'start_new_game' already checks this.
         if not self.available_boards:
-            print("[Game] Cannot advance to next level, no boards available.")
-            self.state = 'GAME_OVER'
-            return
+            log.warning('next_level_failed', room=self.room_id, reason='no_boards')
+            if self._compare_and_set('LEVEL_COMPLETE', expected_epoch, 'GAME_OVER') is not None:
+                self._game_over(journal.REASON_NO_BOARDS)
+            return None
+
+        new_epoch = self._compare_and_set('LEVEL_COMPLETE', expected_epoch, 'SHOWING')
+        if new_epoch is None:
+            log.debug('stale_next_level', room=self.room_id, state=self.state)
+            return None
 
-        # Pick a random chipId from the list of available boards
-        random_board_id = random.choice(self.available_boards)
-        self.sequence.append(random_board_id)
-        
-        # Reset the player's input position for the new (longer) sequence
-        self.player_input_index = 0
-        
-        # Set the state so the server knows to play the sequence animation
-        self.state = 'SHOWING'
         self._cancel_player_timer() # No timer while the sequence is showing
+        self._add_to_sequence()
+        return new_epoch
+
+    def _add_to_sequence(self):
+        """
+        Appends one random board to the sequence. Only called by the thread
+        that just moved the game into 'SHOWING', so nobody else is reading
+        the sequence for input checks at the same time.
+        """
+        # A game that was set up without 'start_new_game' plans on demand
+        if self.plan is None:
+            self.plan = SequencePlan(new_seed(), len(self.available_boards), self.avoid_repeats)
+
+        # The next board comes from the plan, no random number needed
+        board_index = self.plan.index_at(len(self.sequence))
+        self.sequence.append(board_index)
+        self._record(journal.LEVEL_ADVANCED, board_index)
 
-        print(f"[Game] Advancing to level {len(self.sequence)}.")
-        print(f"[Game] New sequence: {self.sequence}")
+        log.info('level_advanced', room=self.room_id, level=len(self.sequence))
+        # The whole sequence is only worth building for DEBUG output
+        if log.is_enabled(DEBUG):
+            log.debug('sequence', room=self.room_id, sequence=','.join(self.sequence_chip_ids()))
 
-    def start_player_turn(self):
+    def sequence_chip_ids(self):
+        """
+        The current sequence as chipIds, e.g. to show it to the player.
+        """
+        available_boards = self.available_boards
+        return [available_boards[board_index] for board_index in self.sequence]
+
+    def start_player_turn(self, expected_epoch=None):
         """
         Called by the server *after* it has finished showing the sequence.
         This sets the game state and starts the 10-second timer.
+        'expected_epoch' is the epoch of the 'SHOWING' state the sequence was
+        shown for. Returns the epoch of the new turn, or None if the game
+        moved on while the sequence was showing.
+        """
+        state, epoch, _ = self._machine
+        if expected_epoch is None:
+            expected_epoch = epoch
+
+        # The player always starts from the beginning of the sequence
+        turn_epoch = self._compare_and_set('SHOWING', expected_epoch, 'PLAYER_TURN')
+        if turn_epoch is None:
+            log.debug('stale_player_turn', room=self.room_id, state=self.state)
+            return None
+
+        self._arm_player_timer(turn_epoch, self.turn_timeout_duration)
+        self._record(journal.TURN_STARTED, value=int(self.turn_timeout_duration * 1000))
+        log.info('player_turn_started', room=self.room_id, epoch=turn_epoch, timeout=self.turn_timeout_duration)
+        return turn_epoch
+
+    def _arm_player_timer(self, turn_epoch, delay):
+        """
+        Cancels any previous timer and arms a new one for the turn at
+        'turn_epoch'. The timer remembers the turn's epoch, so if it fires
+        late (after the turn is over) it is simply ignored.
         """
-        self.state = 'PLAYER_TURN'
-        self.player_input_index = 0 # Ensure player starts from the beginning
-        
-        # Cancel any previous timer and start a new 10-second one
         self._cancel_player_timer()
-        self.player_timer = threading.Timer(
-            self.turn_timeout_duration, 
-            self._handle_timeout
+        self.player_timer = self.scheduler.call_later(
+            delay,
+            lambda: self._handle_timeout(turn_epoch)
         )
-        self.player_timer.start()
-        print("[Game] Player turn started. 10-second timer running.")
 
     def check_player_input(self, chip_id):
         """
         Checks a single chipId input from the player against the sequence.
         Returns a status: 'INVALID', 'CORRECT', 'WRONG', 'LEVEL_COMPLETE'.
         """
-        # Ignore any triggers if it's not the player's turn
-        if self.state != 'PLAYER_TURN':
-            print(f"[Game] Ignoring input {chip_id} (state is {self.state}).")
-            return 'INVALID'
-        
-        # Check if the triggered board's ID is correct for the current index
-        if chip_id == self.sequence[self.player_input_index]:
-            # The input was correct
-            self.player_input_index += 1
-            
-            # Check if this was the last input for the level
-            if self.player_input_index == len(self.sequence):
-                # Player completed the level
-                print("[Game] Player input correct. LEVEL COMPLETE.")
-                self._cancel_player_timer() # Stop the timer, they won
-                self.state = 'IDLE' # Go to a neutral state before next level
-                return 'LEVEL_COMPLETE'
+        # A board this game doesn't know can never be the right one
+        board_index = self.board_indexes.get(chip_id, -1)
+        while True:
+            state, epoch, index = self._machine
+
+            # Ignore any triggers if it's not the player's turn
+            if state != 'PLAYER_TURN':
+                log.debug('input_ignored', room=self.room_id, chip_id=chip_id, state=state)
+                return 'INVALID'
+
+            expected_index = self.sequence[index]
+            # Check if the triggered board is correct for the current index
+            if board_index == expected_index:
+                # Check if this was the last input for the level
+                if index + 1 == len(self.sequence):
+                    # Player completed the level
+                    if self._compare_and_set(state, epoch, 'LEVEL_COMPLETE', index, index + 1) is not None:
+                        self._record(journal.INPUT, board_index, index, journal.RESULT_LEVEL_COMPLETE)
+                        log.info('level_complete', room=self.room_id, level=len(self.sequence))
+                        self._cancel_player_timer() # Stop the timer, they won
+                        return 'LEVEL_COMPLETE'
+                else:
+                    # Player was correct but sequence is not finished
+                    if self._compare_and_set(state, epoch, state, index, index + 1) is not None:
+                        self._record(journal.INPUT, board_index, index, journal.RESULT_CORRECT)
+                        log.debug('input_correct', room=self.room_id, chip_id=chip_id, index=index)
+                        return 'CORRECT'
             else:
-                # Player was correct but sequence is not finished
-                print(f"[Game] Player input {chip_id} correct. Waiting for next.")
-                return 'CORRECT'
-        else:
-            # The input was wrong
-            print(f"[Game] Player input {chip_id} WRONG. Expected {self.sequence[self.player_input_index]}.")
-            self.state = 'GAME_OVER'
-            self._cancel_player_timer() # Stop the timer, they lost
-            return 'WRONG'
-
-    def _handle_timeout(self):
-        """
-        Internal function called by the threading.Timer if time runs out.
-        """
-        # Ensure the game is still in PLAYER_TURN (e.g., they didn't
-        # win on the very last second, which would cancel the timer).
-        if self.state == 'PLAYER_TURN':
-            print("[Game] Player TIMED OUT.")
-            self.state = 'GAME_OVER'
+                # The input was wrong
+                if self._compare_and_set(state, epoch, 'GAME_OVER', index, index) is not None:
+                    self._record(journal.INPUT, journal.NO_BOARD if board_index < 0 else board_index,
+                                 index, journal.RESULT_WRONG)
+                    self._game_over(journal.REASON_WRONG)
+                    log.info('input_wrong', room=self.room_id, chip_id=chip_id,
+                             expected=self.available_boards[expected_index])
+                    self._cancel_player_timer() # Stop the timer, they lost
+                    return 'WRONG'
+
+            # Another input (or the timer) changed the game between our read
+            # and our write. Read the new state and check again.
+
+    def _handle_timeout(self, turn_epoch):
+        """
+        Internal function called by the scheduler if time runs out.
+        """
+        # Only end the game if it is still the *same* turn (e.g. they didn't
+        # win on the very last second, which would have moved the epoch on).
+        if self._compare_and_set('PLAYER_TURN', turn_epoch, 'GAME_OVER') is not None:
+            self._record(journal.TIMEOUT, index=self.player_input_index)
+            self._game_over(journal.REASON_TIMEOUT)
+            log.info('player_timed_out', room=self.room_id, level=len(self.sequence))
+            TURN_TIMEOUTS.inc()
             # Call the callback function in 'app.py' to notify the client
             self.on_player_timeout()
 
+    # --- Moving a game to another worker (see 'cluster.py') ---
+
+    def hand_off(self):
+        """
+        Stops this game so another server process can carry on with it, and
+        returns everything that process needs as a JSON-able dictionary
+        (see 'take_over'). The game here goes back to 'IDLE' at a new epoch,
+        so a sequence still being shown or a timer still armed for it does
+        nothing any more.
+        """
+        with self._cas_lock:
+            state, epoch, index = self._machine
+            self._machine = ('IDLE', epoch + 1, 0)
+
+        turn_remaining = None
+        if state == 'PLAYER_TURN' and self.player_timer is not None:
+            turn_remaining = self.player_timer.remaining()
+        self._cancel_player_timer()
+
+        self._record(journal.HANDED_OFF, index=index)
+        log.info('game_handed_off', room=self.room_id, state=state, level=len(self.sequence))
+        return self._described(state, index, self.sequence_chip_ids(), turn_remaining)
+
+    def describe(self):
+        """
+        Returns the same dictionary as 'hand_off', but leaves the game
+        running. Used for the snapshots of a warm restart ('snapshot.py'),
+        which are taken from another thread while the game goes on.
+        """
+        # The state and the sequence are read separately; if the state
+        # changed in between, read both again
+        while True:
+            state, epoch, index = self._machine
+            sequence = self.sequence_chip_ids()
+            player_timer = self.player_timer
+            if self._machine[1] == epoch:
+                break
+
+        turn_remaining = None
+        if state == 'PLAYER_TURN' and player_timer is not None:
+            turn_remaining = player_timer.remaining()
+        return self._described(state, index, sequence, turn_remaining)
+
+    def _described(self, state, index, sequence, turn_remaining):
+        return {
+            'state': state,
+            'playerInputIndex': index,
+            # As chipIds: the other process numbers its boards itself
+            'sequence': sequence,
+            'seed': self.plan.seed if self.plan is not None else None,
+            'turnRemaining': turn_remaining
+        }
+
+    def take_over(self, handed_off):
+        """
+        Carries on with a game another process gave up with 'hand_off'.
+        A player's turn continues with the time that was left. Returns the
+        epoch of the restored state; if it is 'SHOWING' or 'LEVEL_COMPLETE',
+        the server has to show the sequence or move to the next level again.
+        """
+        epoch = self.restore(handed_off)
+        state = handed_off['state']
+
+        turn_remaining = None
+        if state == 'PLAYER_TURN':
+            turn_remaining = handed_off['turnRemaining']
+            if turn_remaining is None:
+                turn_remaining = self.turn_timeout_duration
+            self._arm_player_timer(epoch, turn_remaining)
+
+        if self.journal is not None:
+            seed = journal.journal_seed(self.plan.seed if self.plan is not None else None)
+            for level, board_index in enumerate(self.sequence, 1):
+                self.journal.append(journal.RESTORED_LEVEL, self.room_id, board_index, level, 0, seed)
+            self._record(journal.GAME_RESUMED, journal.STATES.index(state), self.player_input_index,
+                         -1 if turn_remaining is None else int(turn_remaining * 1000))
+        log.info('game_taken_over', room=self.room_id, state=state, level=len(self.sequence))
+        return epoch
+
+    def restore(self, handed_off):
+        """
+        Puts this game in the state 'hand_off' described, without arming
+        its timer. 'take_over' uses it to carry a game on, and the replay
+        engine ('journal.py') to rebuild one. Returns the restored epoch.
+        """
+        self._cancel_player_timer()
+        self.set_available_boards(handed_off['sequence'])
+        self.sequence = array('H', (self.board_indexes[chip_id] for chip_id in handed_off['sequence']))
+        # The same seed and boards plan the same levels the old owner would have
+        self.plan = None
+        if handed_off.get('seed') is not None:
+            self.plan = SequencePlan(handed_off['seed'], len(self.available_boards), self.avoid_repeats)
+
+        with self._cas_lock:
+            epoch = self._machine[1] + 1
+            self._machine = (handed_off['state'], epoch, handed_off['playerInputIndex'])
+        return epoch
+
     def _cancel_player_timer(self):
         """
         Safely cancels the player timer if it exists.
         """
-        if self.player_timer:
-            self.player_timer.cancel()
+        player_timer = self.player_timer
+        if player_timer:
+            player_timer.cancel()
             self.player_timer = None
 
     def get_current_level(self):
         """
         Helper function to get the current level number (1-based).
         """
-        return len(self.sequence)
\ No newline at end of file
+        return len(self.sequence)
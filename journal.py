@@ -0,0 +1,572 @@
+# journal.py
+# This file contains the game journal: an append-only, binary record of
+# everything that happens to every game (a board joined, a game started, a
+# level was added, an input was checked, a turn timed out, a game ended),
+# and the replay engine that rebuilds games from it.
+#
+# Games still live in memory; the journal is what is left of them after the
+# server restarts. It can be replayed to any moment, to recover the games
+# or to study them, without touching the live server. (The server itself
+# does not replay it when it starts: a warm restart uses the much smaller
+# snapshots in 'snapshot.py'.)
+#
+#   python journal.py journal/                      every room's game now
+#   python journal.py journal/ --room gym-1 --until 1767225600
+#
+# Writing never waits for the disk. Records are packed into a buffer, and
+# ONE background thread writes the buffer out and fsyncs it every
+# JOURNAL_FLUSH_INTERVAL seconds (or sooner once the buffer is big), so a
+# hundred records cost one fsync instead of a hundred. A crash loses at
+# most the last flush interval.
+#
+# The journal is a directory of segment files ('00000001.journal', ...).
+# A new segment is started when the server starts and whenever the current
+# one is full; old segments are never written again. Every record is
+# exactly JOURNAL_RECORD.size (32) bytes, little-endian:
+#
+#   offset  size  field
+#   0       1     kind    what happened (GAME_STARTED, INPUT, ...)
+#   1       1     -       padding
+#   2       2     board   the board index (in the room's Game) it was about
+#   4       4     room    the room's number in this journal (see ROOM_NAME)
+#   8       8     time    time.time() when it happened
+#   16      2     level   the length of the game's sequence
+#   18      2     index   the player's input index, or a kind's own number
+#   20      4     -       padding
+#   24      8     value   a kind's own number (a seed, a chipId, a result)
+#
+# Readers map a segment into memory ('MappedSegment') instead of reading
+# it, and look at its records in place; 'journal_stats.py' views them as a
+# NumPy array.
+#
+# Every segment starts with a HEADER record, then ROOM_NAME records that
+# give every room's number its name. A ROOM_NAME record carries up to 24
+# bytes of the name where 'time' and the fields after it would be ('board'
+# says which 24-byte piece it is), so long names take several records.
+
+import argparse  # Command line options of the replay tool
+import atexit    # To write out the last records when the server exits
+import heapq     # Merges the journals of several worker processes by time
+import mmap      # Segments are read straight from the page cache, without copying
+import os        # Segment files and fsync
+import struct    # The record layout
+import threading # The writer thread and the lock around the buffer
+import time      # Record timestamps and flush timing
+from collections import namedtuple # One replayed event
+
+from log import get_logger # Structured, level-gated logging
+import metrics # Journal write and fsync timings
+
+log = get_logger('journal')
+
+# --- Metrics ---
+JOURNAL_RECORDS = metrics.counter('boxbots_journal_records_total', 'Records appended to the game journal.')
+JOURNAL_FSYNC_SECONDS = metrics.histogram(
+    'boxbots_journal_fsync_seconds',
+    'Time to write and fsync one batch of journal records.'
+)
+
+JOURNAL_RECORD = struct.Struct('<BxHIdHH4xq')
+ROOM_NAME_RECORD = struct.Struct('<BxHI24s')
+ROOM_NAME_PIECE = 24
+
+# The HEADER record's 'value' and 'index', so a reader knows what it opened
+JOURNAL_MAGIC = int.from_bytes(b'BXJRNL01', 'little')
+JOURNAL_VERSION = 1
+JOURNAL_SUFFIX = '.journal'
+
+# Seconds the writer thread collects records for before one write and fsync
+JOURNAL_FLUSH_INTERVAL = 0.1
+# A buffer this big is written out straight away
+JOURNAL_BUFFER_BYTES = 64 * 1024
+# A segment this big is closed and a new one started
+JOURNAL_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# --- Record kinds ---
+HEADER = 0          # index: JOURNAL_VERSION, value: JOURNAL_MAGIC
+ROOM_NAME = 1       # see ROOM_NAME_RECORD
+BOARD_ADDED = 2     # board: its index, value: its chipId (-1 if it isn't a whole number)
+GAME_STARTED = 3    # index: 1 if the game avoids repeats, value: the seed (-1 if it isn't a whole number)
+LEVEL_ADVANCED = 4  # board: the board added to the sequence, level: the new length
+TURN_STARTED = 5    # value: the turn's time limit in milliseconds
+INPUT = 6           # board: the board triggered (NO_BOARD if unknown), index: its position, value: INPUT_RESULTS code
+TIMEOUT = 7         # index: how many inputs the player got right
+GAME_OVER = 8       # value: GAME_OVER_REASONS code
+HANDED_OFF = 9      # the game moved to another worker process
+RESTORED_LEVEL = 10 # like LEVEL_ADVANCED, for every board of a sequence a game carries on with;
+                    # value: the game's seed, like GAME_STARTED's
+GAME_RESUMED = 11   # board: STATES code of the state it carries on in, index: the input index,
+                    # value: milliseconds left of the turn (-1 outside a turn)
+
+KIND_NAMES = (
+    'HEADER', 'ROOM_NAME', 'BOARD_ADDED', 'GAME_STARTED', 'LEVEL_ADVANCED', 'TURN_STARTED',
+    'INPUT', 'TIMEOUT', 'GAME_OVER', 'HANDED_OFF', 'RESTORED_LEVEL', 'GAME_RESUMED'
+)
+
+# The codes some kinds keep in their fields, and their names
+STATES = ('IDLE', 'SHOWING', 'PLAYER_TURN', 'LEVEL_COMPLETE', 'GAME_OVER')
+INPUT_RESULTS = ('INVALID', 'CORRECT', 'WRONG', 'LEVEL_COMPLETE')
+RESULT_CORRECT, RESULT_WRONG, RESULT_LEVEL_COMPLETE = 1, 2, 3
+GAME_OVER_REASONS = ('none', 'wrong', 'timeout', 'no_boards')
+REASON_WRONG, REASON_TIMEOUT, REASON_NO_BOARDS = 1, 2, 3
+
+# The 'board' of an INPUT from a board the game doesn't know
+NO_BOARD = 0xFFFF
+
+
+def journal_chip_id(chip_id):
+    """
+    A chipId as a journal 'value'. ChipIds are numbers sent as strings, but
+    a station can send any string, and only whole numbers fit.
+    """
+    chip_id = str(chip_id)
+    if chip_id.isdigit() and int(chip_id) < 2 ** 63:
+        return int(chip_id)
+    return -1
+
+
+def journal_seed(seed):
+    """
+    A seed as a journal 'value': seeds are usually 32-bit numbers, but a
+    browser can ask for any seed, and only whole numbers fit.
+    """
+    if isinstance(seed, int) and 0 <= seed < 2 ** 63:
+        return seed
+    return -1
+
+
+class Journal:
+    """
+    Appends records to the segment files in 'directory'. 'append' can be
+    called from any thread (and from the event loop); it only packs the
+    record into a buffer.
+    """
+
+    def __init__(self, directory, prefix='', flush_interval=JOURNAL_FLUSH_INTERVAL,
+                 segment_bytes=JOURNAL_SEGMENT_BYTES):
+        self.directory = directory
+        # Told apart from other processes' segments in the same directory
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+
+        # { room_id: room number }, for the whole life of this journal
+        self._rooms = {}
+        # Records waiting for the writer thread
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        # Never write into an old segment: its end may be torn by a crash
+        self._segment_number = max(segment_numbers(directory, prefix), default=0)
+        self._file = None
+        self._file_size = 0
+
+        self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        log.info('journal_opened', directory=directory, prefix=prefix)
+
+    def append(self, kind, room_id, board=0, level=0, index=0, value=0):
+        """
+        Adds one record. It reaches the disk within 'flush_interval'.
+        """
+        with self._condition:
+            # The writer sleeps while there is nothing to write; the first
+            # record wakes it, and it then gathers the rest of the batch
+            if not self._buffer:
+                self._condition.notify()
+            room = self._rooms.get(room_id)
+            if room is None:
+                room = self._name_room(room_id)
+            self._buffer += JOURNAL_RECORD.pack(kind, board, room, time.time(), level, index, value)
+            if len(self._buffer) >= JOURNAL_BUFFER_BYTES:
+                self._condition.notify()
+        JOURNAL_RECORDS.inc()
+
+    def _name_room(self, room_id):
+        # Caller holds the lock
+        room = len(self._rooms)
+        self._rooms[room_id] = room
+        self._buffer += _room_name_records(room, room_id)
+        return room
+
+    def close(self):
+        """
+        Writes out every record still in the buffer and stops the writer.
+        Safe to call more than once.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        """
+        The body of the writer thread: wait for records, let a batch build
+        up for 'flush_interval', then write and fsync it in one go.
+        """
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closed:
+                    self._condition.wait()
+                if not self._closed and len(self._buffer) < JOURNAL_BUFFER_BYTES:
+                    self._condition.wait(self.flush_interval)
+                data, self._buffer = self._buffer, bytearray()
+                closed = self._closed
+            if data:
+                try:
+                    self._write(data)
+                except OSError:
+                    log.exception('journal_write_failed', records=len(data) // JOURNAL_RECORD.size)
+            if closed:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _write(self, data):
+        with JOURNAL_FSYNC_SECONDS.time():
+            if self._file is None or self._file_size >= self.segment_bytes:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file_size += len(data)
+
+    def _open_segment(self):
+        """
+        Closes the current segment and starts the next one with its header
+        and the names of every room so far, so each segment can be read on
+        its own.
+        """
+        if self._file is not None:
+            self._file.close()
+        self._segment_number += 1
+        path = segment_path(self.directory, self.prefix, self._segment_number)
+        self._file = open(path, 'wb')
+
+        with self._condition:
+            rooms = list(self._rooms.items())
+        header = bytearray(JOURNAL_RECORD.pack(HEADER, 0, 0, time.time(), 0, JOURNAL_VERSION, JOURNAL_MAGIC))
+        for room_id, room in rooms:
+            header += _room_name_records(room, room_id)
+        self._file.write(header)
+        self._file_size = len(header)
+        log.info('journal_segment_started', path=path)
+
+
+def _room_name_records(room, room_id):
+    name = str(room_id).encode('utf-8')
+    records = bytearray()
+    for piece, start in enumerate(range(0, max(len(name), 1), ROOM_NAME_PIECE)):
+        records += ROOM_NAME_RECORD.pack(ROOM_NAME, piece, room, name[start:start + ROOM_NAME_PIECE])
+    return records
+
+
+# --- Reading ---
+
+def segment_path(directory, prefix, number):
+    return os.path.join(directory, f'{prefix}{number:08d}{JOURNAL_SUFFIX}')
+
+
+def segment_numbers(directory, prefix=''):
+    """
+    The numbers of the segments in 'directory' written with 'prefix'.
+    """
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(JOURNAL_SUFFIX):
+            number = name[len(prefix):-len(JOURNAL_SUFFIX)]
+            if number.isdigit():
+                numbers.append(int(number))
+    return numbers
+
+
+def segment_groups(directory):
+    """
+    Returns { prefix: [segment paths in order] }: one list per process that
+    wrote to 'directory'.
+    """
+    groups = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(JOURNAL_SUFFIX):
+            continue
+        prefix, number = name[:-len(JOURNAL_SUFFIX) - 8], name[-len(JOURNAL_SUFFIX) - 8:-len(JOURNAL_SUFFIX)]
+        if number.isdigit():
+            groups.setdefault(prefix, []).append(os.path.join(directory, name))
+    return groups
+
+
+class MappedSegment:
+    """
+    One segment file mapped into memory (read-only). Nothing is copied or
+    parsed up front: 'view' is the segment's records as one memoryview, and
+    'records()' yields each record as a 32-byte slice of it. A record cut
+    short by a crash at the end of the file is left out.
+
+    Use it in a 'with' block; views taken from it must not be kept after.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as segment:
+            if os.fstat(segment.fileno()).st_size < JOURNAL_RECORD.size:
+                raise ValueError(f"{path} is not a journal segment")
+            # The map stays valid after the file is closed
+            self._map = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        size = JOURNAL_RECORD.size
+        self.view = memoryview(self._map)[:len(self._map) - len(self._map) % size]
+        kind, _, _, _, _, version, magic = JOURNAL_RECORD.unpack_from(self.view)
+        if kind != HEADER or magic != JOURNAL_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a journal segment")
+        if version != JOURNAL_VERSION:
+            self.close()
+            raise ValueError(f"{path} is journal version {version}, not {JOURNAL_VERSION}")
+
+    def __len__(self):
+        return len(self.view) // JOURNAL_RECORD.size
+
+    def records(self):
+        """
+        Yields every record (the header too) as a zero-copy memoryview.
+        """
+        size = JOURNAL_RECORD.size
+        view = self.view
+        for offset in range(0, len(view), size):
+            yield view[offset:offset + size]
+
+    def close(self):
+        try:
+            self.view.release()
+            self._map.close()
+        except BufferError:
+            # Someone still holds a view of the map (e.g. a NumPy array);
+            # it is unmapped once the last of them is gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_segment(path):
+    """
+    Yields every record of one segment as (kind, board, room, time, level,
+    index, value). ROOM_NAME records come as (ROOM_NAME, piece, room, name
+    bytes).
+    """
+    with MappedSegment(path) as segment:
+        view = segment.view
+        for offset, record in zip(range(0, len(view), JOURNAL_RECORD.size), JOURNAL_RECORD.iter_unpack(view)):
+            if record[0] == ROOM_NAME:
+                yield ROOM_NAME_RECORD.unpack_from(view, offset)
+            else:
+                yield record
+
+
+# One record with its room resolved to its name. 'chip_id' is the chipId of
+# the record's board (None if the record isn't about a board).
+JournalEvent = namedtuple('JournalEvent', 'time room_id kind board chip_id level index value')
+
+
+def _writer_events(paths):
+    """
+    Yields the JournalEvents of one process's segments, in order.
+    """
+    # { room number: name } and { room number: [chipIds by board index] }
+    names = {}
+    boards = {}
+    for path in paths:
+        pieces = {}
+        for record in read_segment(path):
+            kind = record[0]
+            if kind == ROOM_NAME:
+                _, piece, room, name = record
+                pieces.setdefault(room, {})[piece] = name.rstrip(b'\0')
+                names[room] = b''.join(piece_bytes for _, piece_bytes in sorted(pieces[room].items())).decode('utf-8')
+                continue
+            if kind == HEADER:
+                continue
+            _, board, room, at, level, index, value = record
+            room_boards = boards.setdefault(room, [])
+            chip_id = None
+            if kind == BOARD_ADDED:
+                # A chipId that didn't fit gets a name of its own, so boards
+                # still tell apart
+                chip_id = str(value) if value >= 0 else f'board-{board}'
+                if board == len(room_boards):
+                    room_boards.append(chip_id)
+                elif board < len(room_boards):
+                    # A board index given out again, e.g. by a room that
+                    # was forgotten and created again: later records mean
+                    # the newer board
+                    room_boards[board] = chip_id
+                else:
+                    # Every later INPUT would resolve to the wrong chipId
+                    raise ValueError(f"corrupt journal {path}: board {board} of room "
+                                     f"{names.get(room, room)!r} added after only {len(room_boards)} boards")
+            elif kind in (LEVEL_ADVANCED, RESTORED_LEVEL) or (kind == INPUT and board != NO_BOARD):
+                chip_id = room_boards[board] if board < len(room_boards) else None
+            yield JournalEvent(at, names.get(room, str(room)), kind, board, chip_id, level, index, value)
+
+
+def read_journal(directory):
+    """
+    Yields every JournalEvent in 'directory', the journals of several
+    worker processes merged by time.
+    """
+    writers = [_writer_events(paths) for paths in segment_groups(directory).values()]
+    if len(writers) == 1:
+        return writers[0]
+    return heapq.merge(*writers, key=lambda event: event.time)
+
+
+# --- Replay ---
+
+class GameReplay:
+    """
+    One room's game, rebuilt event by event from the journal.
+    """
+
+    __slots__ = (
+        'room_id', 'boards', 'sequence', 'state', 'player_input_index', 'seed',
+        'avoid_repeats', 'turn_started_at', 'turn_timeout', 'updated_at'
+    )
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        # Every chipId that joined the room, in order
+        self.boards = []
+        # The game's sequence as chipIds
+        self.sequence = []
+        self.state = 'IDLE'
+        self.player_input_index = 0
+        self.seed = None
+        self.avoid_repeats = False
+        # When the current player's turn started, and how long it may last
+        self.turn_started_at = None
+        self.turn_timeout = None
+        # The time of the last event applied
+        self.updated_at = None
+
+    def apply(self, event):
+        kind = event.kind
+        self.updated_at = event.time
+        if kind == BOARD_ADDED:
+            if event.chip_id not in self.boards:
+                self.boards.append(event.chip_id)
+        elif kind == GAME_STARTED:
+            self.sequence = []
+            self.seed = None if event.value < 0 else event.value
+            self.avoid_repeats = bool(event.index)
+            self.state = 'SHOWING'
+            self.player_input_index = 0
+        elif kind in (LEVEL_ADVANCED, RESTORED_LEVEL):
+            # 'level' is the new length, so a restored sequence replaces
+            # whatever was left of an older game
+            del self.sequence[event.level - 1:]
+            self.sequence.append(event.chip_id)
+            if kind == RESTORED_LEVEL:
+                self.seed = None if event.value < 0 else event.value
+            self.state = 'SHOWING'
+            self.player_input_index = 0
+        elif kind == TURN_STARTED:
+            self.state = 'PLAYER_TURN'
+            self.player_input_index = 0
+            self.turn_started_at = event.time
+            self.turn_timeout = event.value / 1000.0
+        elif kind == INPUT:
+            if event.value == RESULT_CORRECT:
+                self.player_input_index = event.index + 1
+            elif event.value == RESULT_LEVEL_COMPLETE:
+                self.state = 'LEVEL_COMPLETE'
+                self.player_input_index = event.index + 1
+        elif kind in (TIMEOUT, GAME_OVER):
+            self.state = 'GAME_OVER'
+        elif kind == HANDED_OFF:
+            self.state = 'IDLE'
+            self.player_input_index = 0
+        elif kind == GAME_RESUMED:
+            self.state = STATES[event.board]
+            self.player_input_index = event.index
+            if event.value >= 0:
+                # The rest of the turn counts as a turn of its own
+                self.turn_started_at = event.time
+                self.turn_timeout = event.value / 1000.0
+
+    def hand_off(self, at=None):
+        """
+        The game as 'Game.hand_off' would have returned it at time 'at'
+        (default: its last event), ready for 'Game.take_over'.
+        """
+        at = self.updated_at if at is None else at
+        turn_remaining = None
+        if self.state == 'PLAYER_TURN' and self.turn_timeout is not None:
+            turn_remaining = max(0.0, self.turn_timeout - (at - self.turn_started_at))
+        return {
+            'state': self.state,
+            'playerInputIndex': self.player_input_index,
+            'sequence': list(self.sequence),
+            'seed': self.seed,
+            'turnRemaining': turn_remaining
+        }
+
+    def to_game(self, at=None, player_timeout_callback=None, scheduler=None):
+        """
+        A Game in this state at time 'at'. Nothing is armed: it only runs
+        again once it is given to 'take_over', like a game handed over by
+        another worker.
+        """
+        from game import Game # Imported here, because 'game.py' imports this module
+
+        game = Game(player_timeout_callback or (lambda: None), scheduler=scheduler,
+                    room_id=self.room_id, avoid_repeats=self.avoid_repeats)
+        game.set_available_boards(self.boards)
+        game.restore(self.hand_off(at))
+        return game
+
+
+def replay(directory, until=None, room_id=None):
+    """
+    Replays the journal in 'directory' up to time 'until' (default: its
+    end) and returns { room_id: GameReplay }. With 'room_id', only that
+    room is rebuilt.
+    """
+    games = {}
+    for event in read_journal(directory):
+        if until is not None and event.time > until:
+            break
+        if room_id is not None and event.room_id != room_id:
+            continue
+        game = games.get(event.room_id)
+        if game is None:
+            game = games[event.room_id] = GameReplay(event.room_id)
+        game.apply(event)
+    return games
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the game journal and show every room's game.")
+    parser.add_argument('directory', help="the journal directory (BOXBOTS_JOURNAL_DIR)")
+    parser.add_argument('--room', help="only replay this room")
+    parser.add_argument('--until', type=float, help="replay up to this time (seconds since the epoch)")
+    options = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    games = replay(options.directory, options.until, options.room)
+    elapsed = time.perf_counter() - started
+
+    for game in games.values():
+        print(f"{game.room_id}: {game.state} level={len(game.sequence)} input={game.player_input_index} "
+              f"seed={game.seed} boards={len(game.boards)}")
+    print(f"replayed {len(games)} room(s) in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+# journal_stats.py
+# This file computes post-game statistics from the game journal
+# ('journal.py'): how fast players react at every station, which level
+# games end on, and how often turns time out, per station and per level.
+#
+# It never parses records one by one. Every segment is memory-mapped and
+# viewed as a NumPy array of records (no copy), the few columns the
+# statistics need are picked out of it in one go, and every statistic is
+# computed with whole-array operations, so a season's worth of games
+# (millions of records) takes seconds:
+#
+#   python journal_stats.py journal/
+#   python journal_stats.py journal/ --json > season.json
+#
+# Needs NumPy:  pip install numpy
+
+import argparse # Command line options
+import json     # The --json report
+import sys      # Error messages and the exit status
+import time     # How long loading and computing took
+
+try:
+    import numpy as np # Only needed for the statistics, not by the server
+except ImportError:
+    np = None
+
+from journal import (
+    BOARD_ADDED, GAME_OVER, GAME_RESUMED, GAME_STARTED, INPUT, JOURNAL_RECORD, ROOM_NAME,
+    ROOM_NAME_RECORD, RESULT_CORRECT, RESULT_LEVEL_COMPLETE, RESULT_WRONG, TIMEOUT, TURN_STARTED,
+    MappedSegment, segment_groups
+)
+
+# The kinds of record the statistics are computed from
+STAT_KINDS = (GAME_STARTED, TURN_STARTED, INPUT, TIMEOUT, GAME_OVER, GAME_RESUMED)
+
+# The records that start the clock for the player's next input
+CLOCK_KINDS = (TURN_STARTED, INPUT, GAME_RESUMED)
+
+
+def record_dtype():
+    """
+    The journal's record layout (see 'journal.py') as a NumPy dtype.
+    """
+    dtype = np.dtype([
+        ('kind', 'u1'), ('_pad', 'u1'), ('board', '<u2'), ('room', '<u4'), ('time', '<f8'),
+        ('level', '<u2'), ('index', '<u2'), ('_pad2', '<u4'), ('value', '<i8')
+    ])
+    assert dtype.itemsize == JOURNAL_RECORD.size
+    return dtype
+
+
+class JournalEvents:
+    """
+    The records the statistics need, from every segment of a journal, as
+    one NumPy array per field. 'room' is a position in 'rooms' (the room
+    names), and 'chip' the chipId of an INPUT's board (-1 if unknown).
+    """
+
+    def __init__(self, rooms, columns):
+        self.rooms = rooms
+        self.time = columns['time']
+        self.kind = columns['kind']
+        self.room = columns['room']
+        self.chip = columns['chip']
+        self.level = columns['level']
+        self.index = columns['index']
+        self.value = columns['value']
+
+    def __len__(self):
+        return len(self.kind)
+
+
+def load_events(directory):
+    """
+    Reads the journal in 'directory' (every worker's segments) into a
+    JournalEvents.
+    """
+    dtype = record_dtype()
+    # Room names, and { name: position in 'rooms' }
+    rooms = []
+    room_positions = {}
+    parts = []
+
+    for paths in segment_groups(directory).values():
+        # { this writer's room number: room position }
+        room_map = {}
+        # { (room position, board index): chipId }; every writer numbers
+        # its boards itself
+        chips = {}
+        for path in paths:
+            with MappedSegment(path) as segment:
+                records = np.frombuffer(segment.view, dtype=dtype)
+                kinds = records['kind']
+
+                # Room names and boards are rare, so they are read one by one
+                pieces = {}
+                for offset in (np.flatnonzero(kinds == ROOM_NAME) * JOURNAL_RECORD.size).tolist():
+                    _, piece, room, name = ROOM_NAME_RECORD.unpack_from(segment.view, offset)
+                    pieces.setdefault(room, {})[piece] = name.rstrip(b'\0')
+                for room, room_pieces in pieces.items():
+                    name = b''.join(piece for _, piece in sorted(room_pieces.items())).decode('utf-8')
+                    if name not in room_positions:
+                        room_positions[name] = len(rooms)
+                        rooms.append(name)
+                    room_map[room] = room_positions[name]
+
+                added = records[kinds == BOARD_ADDED]
+                for room, board, chip in zip(added['room'].tolist(), added['board'].tolist(), added['value'].tolist()):
+                    chips[(room_map[room], board)] = chip
+
+                # Copy out only the records the statistics use, so the map
+                # can be closed
+                wanted = records[np.isin(kinds, STAT_KINDS)]
+                del records, kinds, added
+
+            lookup = np.full(max(room_map, default=0) + 1, -1, dtype=np.int64)
+            lookup[list(room_map)] = list(room_map.values())
+            room = lookup[wanted['room']]
+            parts.append({
+                'time': wanted['time'],
+                'kind': wanted['kind'],
+                'room': room,
+                'chip': _input_chips(wanted, room, chips),
+                'level': wanted['level'].astype(np.int64),
+                'index': wanted['index'],
+                'value': wanted['value'],
+            })
+
+    if not parts:
+        columns = {name: np.empty(0, dtype=np.int64) for name in ('kind', 'room', 'chip', 'level', 'index', 'value')}
+        columns['time'] = np.empty(0)
+        return JournalEvents(rooms, columns)
+    return JournalEvents(rooms, {name: np.concatenate([part[name] for part in parts]) for name in parts[0]})
+
+
+def _input_chips(records, room, chips):
+    """
+    The chipId of every INPUT record's board, -1 for other records.
+    """
+    chip = np.full(len(records), -1, dtype=np.int64)
+    inputs = records['kind'] == INPUT
+    if inputs.any():
+        # Look every (room, board) pair up once, however many inputs it has
+        keys, inverse = np.unique(room[inputs] * 65536 + records['board'][inputs], return_inverse=True)
+        known = np.array([chips.get(divmod(key, 65536), -1) for key in keys.tolist()], dtype=np.int64)
+        chip[inputs] = known[inverse]
+    return chip
+
+
+def reaction_times(events):
+    """
+    For every INPUT, the seconds since the player's turn started or since
+    their previous input in the same room (NaN for every other record).
+    """
+    reaction = np.full(len(events), np.nan)
+    rows = np.flatnonzero(np.isin(events.kind, CLOCK_KINDS))
+    if len(rows) < 2:
+        return reaction
+    # Each room's records in time order
+    rows = rows[np.lexsort((events.time[rows], events.room[rows]))]
+    room = events.room[rows]
+    times = events.time[rows]
+    follows = np.zeros(len(rows), dtype=bool)
+    follows[1:] = (room[1:] == room[:-1]) & (events.kind[rows[1:]] == INPUT)
+    gaps = np.zeros(len(rows))
+    gaps[1:] = times[1:] - times[:-1]
+    reaction[rows[follows]] = gaps[follows]
+    return reaction
+
+
+def group_percentiles(groups, values, group_count, fractions):
+    """
+    The percentiles 'fractions' (e.g. (0.5, 0.9) for the median and p90)
+    of 'values' within each group, for groups 0 .. group_count - 1, as one
+    array per fraction. NaN values are left out; a group without values
+    gets NaN. The values are sorted once, whatever the number of fractions.
+    """
+    valid = ~np.isnan(values)
+    groups = groups[valid]
+    values = values[valid]
+    # Sort by value, then stably by group. NumPy sorts small integers
+    # stably with a radix sort, which beats 'np.lexsort' on both at once.
+    order = np.argsort(values)
+    group_keys = groups[order].astype(np.uint16 if group_count <= 65536 else np.int64)
+    values = values[order[np.argsort(group_keys, kind='stable')]]
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+    results = []
+    for fraction in fractions:
+        result = np.full(group_count, np.nan)
+        # The same rank as 'simulate_stations.percentile'
+        ranks = np.minimum(counts[present] - 1, (counts[present] * fraction).astype(np.int64))
+        result[present] = values[starts[present] + ranks]
+        results.append(result)
+    return results
+
+
+def _mean(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+def station_stats(events, reaction=None):
+    """
+    One row per station (chipId): inputs, how many were right or wrong,
+    and the player's reaction time there.
+    """
+    if reaction is None:
+        reaction = reaction_times(events)
+    inputs = events.kind == INPUT
+    chips, station = np.unique(events.chip[inputs], return_inverse=True)
+    station = station.ravel()
+    count = len(chips)
+    value = events.value[inputs]
+    times = reaction[inputs]
+    timed = ~np.isnan(times)
+
+    right = np.bincount(station, weights=np.isin(value, (RESULT_CORRECT, RESULT_LEVEL_COMPLETE)), minlength=count)
+    wrong = np.bincount(station, weights=value == RESULT_WRONG, minlength=count)
+    timed_count = np.bincount(station[timed], minlength=count)
+    mean = _mean(np.bincount(station[timed], weights=times[timed], minlength=count), timed_count)
+    p50, p90 = group_percentiles(station, times, count, (0.5, 0.9))
+
+    return [
+        {
+            'chipId': str(chips[i]) if chips[i] >= 0 else 'unknown',
+            'inputs': int(right[i] + wrong[i]),
+            'correct': int(right[i]),
+            'wrong': int(wrong[i]),
+            'reaction_mean_s': _rounded(mean[i]),
+            'reaction_p50_s': _rounded(p50[i]),
+            'reaction_p90_s': _rounded(p90[i]),
+        }
+        for i in range(count)
+    ]
+
+
+def level_stats(events, reaction=None):
+    """
+    One row per level: turns played, how they ended (completed, wrong
+    input, timeout), how many games ended there, and reaction times.
+    """
+    if reaction is None:
+        reaction = reaction_times(events)
+    if not len(events):
+        return []
+    kind = events.kind
+    level = events.level
+    value = events.value
+    size = int(level.max()) + 1
+
+    def per_level(mask, weights=None):
+        return np.bincount(level[mask], weights=None if weights is None else weights[mask], minlength=size)
+
+    turns = per_level(kind == TURN_STARTED)
+    completed = per_level((kind == INPUT) & (value == RESULT_LEVEL_COMPLETE))
+    wrong = per_level((kind == INPUT) & (value == RESULT_WRONG))
+    timeouts = per_level(kind == TIMEOUT)
+    ended = per_level(kind == GAME_OVER)
+    timed = (kind == INPUT) & ~np.isnan(reaction)
+    reaction_mean = _mean(per_level(timed, reaction), per_level(timed))
+    timeout_rate = _mean(timeouts, turns)
+
+    return [
+        {
+            'level': lvl,
+            'turns': int(turns[lvl]),
+            'completed': int(completed[lvl]),
+            'wrong': int(wrong[lvl]),
+            'timeouts': int(timeouts[lvl]),
+            'timeout_rate': _rounded(timeout_rate[lvl]),
+            'games_ended': int(ended[lvl]),
+            'reaction_mean_s': _rounded(reaction_mean[lvl]),
+        }
+        for lvl in range(1, size) if turns[lvl] or ended[lvl]
+    ]
+
+
+def summary(events, reaction=None):
+    """
+    The whole journal in a few numbers.
+    """
+    if reaction is None:
+        reaction = reaction_times(events)
+    kind = events.kind
+    ended = events.level[kind == GAME_OVER]
+    turns = int(np.count_nonzero(kind == TURN_STARTED))
+    timeouts = int(np.count_nonzero(kind == TIMEOUT))
+    times = reaction[~np.isnan(reaction)]
+    return {
+        'rooms': len(events.rooms),
+        # Only the kinds of record the statistics use are counted
+        'events': len(events),
+        'games_started': int(np.count_nonzero(kind == GAME_STARTED)),
+        'games_over': len(ended),
+        'level_reached_mean': _rounded(ended.mean()) if len(ended) else None,
+        'level_reached_max': int(ended.max()) if len(ended) else None,
+        'turns': turns,
+        'timeout_rate': _rounded(timeouts / turns) if turns else None,
+        'reaction_p50_s': _rounded(np.median(times)) if len(times) else None,
+    }
+
+
+def _rounded(value):
+    return None if np.isnan(value) else round(float(value), 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-station and per-level statistics from the game journal.")
+    parser.add_argument('directory', help="the journal directory (BOXBOTS_JOURNAL_DIR)")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    options = parser.parse_args(argv)
+    if np is None:
+        parser.error("journal statistics need NumPy: pip install numpy")
+
+    started = time.perf_counter()
+    events = load_events(options.directory)
+    loaded = time.perf_counter()
+    reaction = reaction_times(events)
+    report = {
+        'summary': summary(events, reaction),
+        'stations': station_stats(events, reaction),
+        'levels': level_stats(events, reaction),
+    }
+    report['summary']['load_s'] = round(loaded - started, 3)
+    report['summary']['compute_s'] = round(time.perf_counter() - loaded, 3)
+
+    if options.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    total = report['summary']
+    print(f"{total['events']} events, {total['rooms']} room(s): {total['games_started']} games started, "
+          f"{total['games_over']} over, level reached mean={total['level_reached_mean']} "
+          f"max={total['level_reached_max']}, timeout rate={total['timeout_rate']}, "
+          f"reaction p50={total['reaction_p50_s']}s  (load {total['load_s']}s, compute {total['compute_s']}s)")
+    print("station      inputs  correct  wrong  reaction mean / p50 / p90 (s)")
+    for row in report['stations']:
+        print(f"{row['chipId']:<12} {row['inputs']:>6}  {row['correct']:>7}  {row['wrong']:>5}  "
+              f"{row['reaction_mean_s']} / {row['reaction_p50_s']} / {row['reaction_p90_s']}")
+    print("level  turns  completed  wrong  timeouts  timeout rate  games ended  reaction mean (s)")
+    for row in report['levels']:
+        print(f"{row['level']:>5}  {row['turns']:>5}  {row['completed']:>9}  {row['wrong']:>5}  {row['timeouts']:>8}  "
+              f"{row['timeout_rate']!s:>12}  {row['games_ended']:>11}  {row['reaction_mean_s']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+# leaderboard.py
+# This file contains the leaderboard: the level every finished game reached,
+# kept in a small SQLite database, and the rankings the web page shows.
+#
+# Nothing here ever runs on the way of a trigger. When a game ends, 'record'
+# only adds the score to a list in memory. ONE background thread writes the
+# list to the database every LEADERBOARD_FLUSH_INTERVAL seconds, in one
+# transaction, and then works out again every ranking the page has asked
+# for. '/leaderboard' serves those rankings from memory and never queries
+# the database itself: a ranking nobody asked for before is registered,
+# and the writer thread has it ready by its next round (within
+# LEADERBOARD_FLUSH_INTERVAL). A page that reloads the rankings after every
+# game costs the server a dictionary lookup.
+#
+# The database is in WAL mode: the writer never blocks readers, and several
+# worker processes ('cluster.py') can share one file. Each writer thread
+# notices the other processes' commits ('PRAGMA data_version') and refreshes
+# its rankings too.
+#
+#   scores(id, room, day, level, reason, seed, ended_at)
+#
+# 'day' is the local date ('2026-01-31') the game ended on. The indexes on
+# (room, level), (day, level) and (level) make every ranking a short index
+# scan, however many games have been played.
+
+import atexit    # To write out the last scores when the server exits
+import sqlite3   # The embedded database
+import threading # The writer thread and the lock around the pending scores
+import time      # When each game ended, and its day
+
+from log import WARNING, get_logger # Structured, level-gated logging
+import metrics # Leaderboard write timings
+
+log = get_logger('leaderboard')
+
+# --- Metrics ---
+LEADERBOARD_SCORES = metrics.counter('boxbots_leaderboard_scores_total', 'Finished games recorded on the leaderboard.')
+LEADERBOARD_WRITE_SECONDS = metrics.histogram(
+    'boxbots_leaderboard_write_seconds',
+    'Time to write one batch of scores and refresh the cached rankings.'
+)
+
+# Seconds between two writes to the database
+LEADERBOARD_FLUSH_INTERVAL = 1.0
+# How many scores one ranking lists
+LEADERBOARD_TOP_N = 10
+# The most rankings kept in memory; past that, new ones are not served
+# until old ones expire
+LEADERBOARD_CACHE_SIZE = 256
+# Seconds a ranking is kept up to date after it was last asked for
+LEADERBOARD_RANKING_TTL = 600.0
+# Rounds in a row a batch of scores is tried again after the database
+# refused it; after that its scores are written one by one, and the ones
+# that still fail are dropped
+LEADERBOARD_WRITE_ATTEMPTS = 5
+
+INSERT_SCORE = 'INSERT INTO scores (room, day, level, reason, seed, ended_at) VALUES (?, ?, ?, ?, ?, ?)'
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS scores ('
+    ' id INTEGER PRIMARY KEY,'
+    ' room TEXT NOT NULL,'
+    ' day TEXT NOT NULL,'
+    ' level INTEGER NOT NULL,'
+    ' reason TEXT NOT NULL,'
+    ' seed INTEGER,'
+    ' ended_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS scores_by_room ON scores (room, level DESC, ended_at)',
+    'CREATE INDEX IF NOT EXISTS scores_by_day ON scores (day, level DESC, ended_at)',
+    'CREATE INDEX IF NOT EXISTS scores_by_level ON scores (level DESC, ended_at)',
+)
+
+
+def score_day(ended_at):
+    """
+    The day (local date, 'YYYY-MM-DD') of a game that ended at 'ended_at'.
+    """
+    return time.strftime('%Y-%m-%d', time.localtime(ended_at))
+
+
+def parse_day(day):
+    """
+    Reads the 'day' a ranking is for: None (ever), 'today', or a date
+    'YYYY-MM-DD'. Returns None or the date. Raises ValueError for anything
+    else, so a client can't make up new rankings with any string.
+    """
+    if day is None:
+        return None
+    if day == 'today':
+        return score_day(time.time())
+    try:
+        # strptime also accepts '2026-1-5'; only the exact form is a ranking
+        valid = len(day) == 10 and time.strftime('%Y-%m-%d', time.strptime(day, '%Y-%m-%d')) == day
+    except ValueError:
+        # Not a date at all, or one like '2026-02-30'
+        valid = False
+    if not valid:
+        raise ValueError(f"'day' must be 'today' or YYYY-MM-DD, not {day!r}")
+    return day
+
+
+def _score_row(score):
+    """
+    A pending score as the values of INSERT_SCORE. The day is worked out
+    here, on the writer thread, not in 'record'.
+    """
+    room_id, level, reason, seed, ended_at = score
+    return room_id, score_day(ended_at), level, reason, seed, ended_at
+
+
+def leaderboard_answer(room_id, day, scores):
+    """
+    The body of a '/leaderboard' response, for the 'scores' from
+    'Leaderboard.top' (None while the ranking is being worked out).
+    """
+    return {"room": room_id, "day": day, "scores": scores or [], "pending": scores is None}
+
+
+class Leaderboard:
+    """
+    The scores in the SQLite database at 'path'. 'record' and 'top' can be
+    called from any thread (and from the event loop); neither touches the
+    database.
+    """
+
+    def __init__(self, path, top_n=LEADERBOARD_TOP_N, flush_interval=LEADERBOARD_FLUSH_INTERVAL):
+        self.path = path
+        self.top_n = top_n
+        self.flush_interval = flush_interval
+
+        # Scores waiting for the writer thread
+        self._pending = []
+        # Rounds in a row the writer thread failed to write its batch
+        self._failed_rounds = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # { (room_id, day): [score, ...] } for every ranking worked out.
+        # Only the writer thread changes it, by replacing it as a whole.
+        self._cache = {}
+        # { (room_id, day): time.monotonic() it was last asked for }, the
+        # rankings the writer thread keeps in the cache
+        self._wanted = {}
+
+        connection = self._connect()
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        connection.close()
+
+        self._thread = threading.Thread(target=self._run, name='leaderboard-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        log.info('leaderboard_opened', path=path)
+
+    def _connect(self):
+        # Waits for other processes' writes instead of failing straight away
+        connection = sqlite3.connect(self.path, timeout=5.0)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode this is still safe against corruption; a power cut
+        # can only lose the last commits
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def record(self, room_id, level, reason, seed=None):
+        """
+        Adds the score of a game that just ended. It reaches the database
+        (and the rankings) within 'flush_interval'.
+        """
+        # Seeds that don't fit in SQLite's 64-bit integers are left out
+        if not isinstance(seed, int) or not 0 <= seed < 2 ** 63:
+            seed = None
+        with self._lock:
+            self._pending.append((str(room_id), level, reason, seed, time.time()))
+        LEADERBOARD_SCORES.inc()
+
+    def top(self, room_id=None, day=None):
+        """
+        Returns the best scores (highest level first, then the earliest),
+        in one room or all of them ('room_id' None), on one day (a date from
+        'parse_day') or ever ('day' None). Only ever reads the cache: a
+        ranking that isn't worked out yet returns None, and is ready within
+        'flush_interval'.
+        """
+        key = (room_id, day)
+        if key in self._wanted or len(self._wanted) < LEADERBOARD_CACHE_SIZE:
+            self._wanted[key] = time.monotonic()
+        else:
+            log.sampled(WARNING, 'leaderboard_cache_full', rankings=len(self._wanted))
+        return self._cache.get(key)
+
+    def _query(self, connection, room_id, day):
+        conditions = []
+        parameters = []
+        if room_id is not None:
+            conditions.append('room = ?')
+            parameters.append(str(room_id))
+        if day is not None:
+            conditions.append('day = ?')
+            parameters.append(day)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+        rows = connection.execute(
+            f'SELECT room, level, reason, seed, ended_at FROM scores {where}'
+            'ORDER BY level DESC, ended_at LIMIT ?',
+            parameters + [self.top_n]
+        )
+        return [
+            {'room': room, 'level': level, 'reason': reason, 'seed': seed, 'endedAt': ended_at}
+            for room, level, reason, seed, ended_at in rows
+        ]
+
+    def close(self):
+        """
+        Writes out every score still pending and stops the writer. Safe to
+        call more than once.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        """
+        The body of the writer thread: every 'flush_interval', write the
+        pending scores in one transaction, then refresh the rankings if
+        anything (here or in another process) changed the database.
+        """
+        connection = self._connect()
+        data_version = None
+        while True:
+            stopped = self._stopped.wait(self.flush_interval)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            started_at = time.perf_counter()
+            written = bool(batch) and self._write(connection, batch, last_round=stopped)
+            try:
+                # Changes only when another connection committed
+                version = connection.execute('PRAGMA data_version').fetchone()[0]
+                changed = written or version != data_version
+                data_version = version
+                if self._refresh(connection, changed):
+                    LEADERBOARD_WRITE_SECONDS.observe(time.perf_counter() - started_at)
+            except sqlite3.Error:
+                log.exception('leaderboard_refresh_failed')
+            if stopped:
+                connection.close()
+                return
+
+    def _write(self, connection, batch, last_round=False):
+        """
+        Writes 'batch' in one transaction and returns True if any of it was
+        written. If the database refuses it (e.g. 'database is locked' by
+        another worker process), the batch goes back to the front of the
+        pending scores for the next round. After LEADERBOARD_WRITE_ATTEMPTS
+        rounds (or in the 'last_round'), its scores are written one by one
+        and only the ones that still fail are dropped, so one bad score
+        can't hold up the others for ever.
+        """
+        try:
+            with connection:
+                connection.executemany(INSERT_SCORE, [_score_row(score) for score in batch])
+            self._failed_rounds = 0
+            return True
+        except sqlite3.Error as e:
+            self._failed_rounds += 1
+            if self._failed_rounds < LEADERBOARD_WRITE_ATTEMPTS and not last_round:
+                log.warning('leaderboard_write_failed', scores=len(batch), attempt=self._failed_rounds, error=e)
+                with self._lock:
+                    self._pending[:0] = batch
+                return False
+
+        self._failed_rounds = 0
+        written = False
+        for score in batch:
+            try:
+                with connection:
+                    connection.execute(INSERT_SCORE, _score_row(score))
+                written = True
+            except sqlite3.Error as e:
+                log.error('leaderboard_score_dropped', room=score[0], level=score[1], error=e)
+        return written
+
+    def _refresh(self, connection, changed):
+        """
+        Works out the rankings asked for since the last round (all of them
+        if the database 'changed'), drops the ones nobody asked for in
+        LEADERBOARD_RANKING_TTL, then swaps in the new cache in one go, so
+        readers never see it half done. Returns True if it queried anything.
+        """
+        expired_at = time.monotonic() - LEADERBOARD_RANKING_TTL
+        for key, asked_at in list(self._wanted.items()):
+            if asked_at < expired_at:
+                self._wanted.pop(key, None)
+
+        cache = self._cache
+        wanted = list(self._wanted)
+        if not changed and all(key in cache for key in wanted):
+            if len(cache) != len(wanted):
+                self._cache = {key: cache[key] for key in wanted}
+            return False
+        self._cache = {
+            (room_id, day): cache[(room_id, day)] if not changed and (room_id, day) in cache
+            else self._query(connection, room_id, day)
+            for room_id, day in wanted
+        }
+        return True
@@ -0,0 +1,188 @@
+# log.py
+# This file contains the server's logging subsystem. It replaces the plain
+# 'print' calls that used to be everywhere in 'app.py' and 'game.py'.
+#
+# - Every line is structured: an event name plus 'key=value' fields.
+# - Every line has a level (DEBUG, INFO, WARNING, ERROR). Lines below the
+#   configured level cost almost nothing: they are dropped before any
+#   formatting happens.
+# - Writing to the console never blocks the caller. Log records go into a
+#   bounded queue and ONE background thread writes them out. If the queue is
+#   full (the console can't keep up) records are dropped and counted.
+# - High-frequency events (e.g. every trigger) can be sampled, so only one
+#   in every N of them is logged.
+#
+# The level is set with the BOXBOTS_LOG_LEVEL environment variable
+# (default: INFO). Use DEBUG to see every trigger and every input again.
+
+import atexit    # To flush the queue when the server exits
+import logging   # Python's standard logging, which we build on
+import logging.handlers # QueueHandler / QueueListener
+import os        # To read the BOXBOTS_LOG_LEVEL environment variable
+import queue     # The bounded queue between callers and the writer thread
+import sys       # Log lines go to standard output, like the old 'print's
+
+# The parent of every logger created by 'get_logger'
+ROOT_LOGGER_NAME = 'boxbots'
+
+# How many records may wait for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+
+# Log one in this many sampled events unless the caller says otherwise
+DEFAULT_SAMPLE_EVERY = 100
+
+# Re-exported so callers don't need to import 'logging' themselves
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# The background writer, started by 'setup_logging'
+_listener = None
+# The handler in front of the queue, so its drop count can be read
+_queue_handler = None
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats a record as:
+    2026-01-31 18:04:05,123 INFO  game level_advanced room=default level=3
+    """
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        line = f"{self.formatTime(record)} {record.levelname:<5} {record.name[len(ROOT_LOGGER_NAME) + 1:]} {record.msg}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that never blocks and never formats in the caller's
+    thread. All formatting happens in the writer thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        # How many records were dropped because the queue was full
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The standard QueueHandler formats the message here, in the
+        # caller's thread. Our records are already plain data, so we pass
+        # them through untouched and let the writer thread format them.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredLogger:
+    """
+    A small wrapper around a standard logger that takes an event name and
+    keyword fields, e.g. log.info('board_connected', chip_id=..., room=...).
+    The event name is positional-only, so any field name (even 'level' or
+    'event') can be used.
+    """
+
+    def __init__(self, name):
+        self._logger = logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+        # { event_name: how many times it has been seen } for 'sampled'
+        self._sample_counts = {}
+
+    def is_enabled(self, level):
+        """
+        True if lines at 'level' would be written. Use this to skip work
+        (e.g. building a big field value) for lines that would be dropped.
+        """
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level, event, /, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event, /, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, /, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, /, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, /, **fields):
+        self.log(ERROR, event, **fields)
+
+    def exception(self, event, /, **fields):
+        """
+        Logs at ERROR level with the current exception's traceback.
+        """
+        if self._logger.isEnabledFor(ERROR):
+            self._logger.error(event, exc_info=True, extra={'fields': fields})
+
+    def sampled(self, level, event, /, every=DEFAULT_SAMPLE_EVERY, **fields):
+        """
+        Logs only the 1st, (every+1)th, (2*every+1)th, ... occurrence of a
+        high-frequency event. The count is approximate if several threads
+        log the same event at once, which is fine for sampling.
+        """
+        if not self._logger.isEnabledFor(level):
+            return
+
+        count = self._sample_counts.get(event, 0)
+        self._sample_counts[event] = count + 1
+        if count % every == 0:
+            fields['sample'] = f"1/{every}"
+            self._logger.log(level, event, extra={'fields': fields})
+
+
+def get_logger(name):
+    """
+    Returns the StructuredLogger for one part of the server, e.g. 'game'.
+    """
+    return StructuredLogger(name)
+
+
+def dropped_count():
+    """
+    Returns how many log records were dropped because the queue was full.
+    """
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def setup_logging(level=None):
+    """
+    Sends every 'boxbots' log line through the non-blocking queue to
+    standard output. Call this once at server start-up; calling it again
+    only changes the level.
+    """
+    global _listener, _queue_handler
+
+    if level is None:
+        level = os.environ.get('BOXBOTS_LOG_LEVEL', 'INFO').upper()
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level)
+    if _listener is not None:
+        return
+
+    # Our lines shouldn't also go to any handlers of Python's root logger
+    root.propagate = False
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(KeyValueFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, console_handler)
+    _listener.start()
+
+    # Write out whatever is still queued when the server exits
+    atexit.register(_listener.stop)
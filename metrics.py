@@ -0,0 +1,214 @@
+# metrics.py
+# This file contains a small in-process metrics registry, so we can see
+# where the server spends its time under real load. It supports:
+#
+# - Counters: numbers that only go up (e.g. triggers received per chip)
+# - Histograms: timings sorted into fixed buckets (e.g. '/data' latency)
+# - Gauges: a value read from a function when metrics are collected
+#
+# Every metric can have labels (e.g. chip_id="9072791"). The whole registry
+# is rendered in the Prometheus text format by 'render()', which the servers
+# expose on their '/metrics' endpoint.
+
+import bisect    # Finds a value's histogram bucket in O(log buckets)
+import threading # Each metric has a small lock so threads can't lose updates
+import time      # For timing blocks of code
+
+# Default histogram buckets, in seconds. They cover everything from a fast
+# in-memory call (50 microseconds) up to a slow network round trip (5 seconds).
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _label_key(labels):
+    """
+    Turns keyword labels into a hashable key, e.g. (('chip_id', '123'),).
+    """
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key, extra=None):
+    """
+    Formats a label key as Prometheus text, e.g. {chip_id="123",le="0.5"}.
+    """
+    pairs = list(key)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """
+    A number that only goes up, optionally split by labels.
+    """
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        # { label_key: value }
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """
+        Returns the current value for one set of labels.
+        """
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Counts observations (usually durations in seconds) into fixed buckets,
+    optionally split by labels.
+    """
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # { label_key: [bucket counts..., +Inf count, sum] }
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One slot per bucket, one for +Inf, one for the sum
+                counts = [0] * (len(self.buckets) + 2)
+                self._values[key] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Times a block of code:   with HISTOGRAM.time(route='/data'): ...
+        """
+        return _Timer(self, labels)
+
+    def get_count(self, **labels):
+        """
+        Returns how many observations were made for one set of labels.
+        """
+        counts = self._values.get(_label_key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in items:
+            # Prometheus buckets are cumulative ("less than or equal to")
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', bound))} {cumulative}")
+            cumulative += counts[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    """
+    The context manager returned by 'Histogram.time()'.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Gauge:
+    """
+    A value that can go up and down, read from a function whenever the
+    metrics are rendered (e.g. the number of rooms).
+    """
+
+    def __init__(self, name, help_text, read_value):
+        self.name = name
+        self.help_text = help_text
+        self.read_value = read_value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.read_value()}"]
+
+
+class MetricsRegistry:
+    """
+    Holds every metric in the process and renders them all at once.
+    """
+
+    def __init__(self):
+        # { name: metric }, kept in the order they were created
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Modules may be imported more than once (e.g. by both servers);
+            # always hand back the first metric with a given name.
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, read_value):
+        return self._register(Gauge(name, help_text, read_value))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# The registry shared by the whole process
+REGISTRY = MetricsRegistry()
+
+# The content type Prometheus expects from a '/metrics' endpoint
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Convenience functions that create metrics in the shared registry
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+render = REGISTRY.render
+
+# CPU time used by this process, so load tests can work out CPU cost per event
+gauge('process_cpu_seconds_total', 'Total user and system CPU time spent by the server process.', time.process_time)
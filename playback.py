@@ -0,0 +1,75 @@
+# playback.py
+# This file contains the sequence playback shared by both servers.
+#
+# Showing a level used to keep one background task (or thread) busy per
+# room for the whole playback: emit a flash, sleep one second, emit the
+# next one... A level-50 sequence held it for almost a minute, and a
+# thousand rooms showing their sequence at once held a thousand of them.
+#
+# Now a playback is a tiny object that knows its timeline up front (the
+# lead-in, then one flash per second) and arms ONE timer at a time on the
+# game's shared scheduler ('scheduler.py'). Between two flashes it holds
+# no task, no thread and no stack, whatever the level.
+
+import time # Every deadline is counted from the start of the playback
+
+# Seconds between the "Level X" message and the first flash
+LEAD_IN_SECONDS = 1.5
+# Seconds between two flashes, and after the last one before the turn starts
+FLASH_INTERVAL_SECONDS = 1.0
+# Seconds between a completed level and the next level's "Level X" message,
+# so the player can celebrate. Also a timer, not a sleeping task.
+LEVEL_COMPLETE_PAUSE_SECONDS = 2.5
+
+
+def playback_duration(flashes):
+    """
+    How long a playback of 'flashes' flashes takes, from the "Level X"
+    message to the start of the player's turn.
+    """
+    return LEAD_IN_SECONDS + FLASH_INTERVAL_SECONDS * flashes
+
+
+class SequencePlayback:
+    """
+    Plays one sequence: calls 'on_flash(chip_id)' for every board at its
+    time in the timeline, then 'on_finished(flashes)' when the player's turn
+    should start. As soon as 'is_current()' returns False (the game was
+    restarted, or handed to another worker) it stops quietly.
+    """
+
+    __slots__ = ('scheduler', 'chip_ids', 'is_current', 'on_flash', 'on_finished', 'position', 'started_at')
+
+    def __init__(self, scheduler, chip_ids, is_current, on_flash, on_finished):
+        self.scheduler = scheduler
+        self.chip_ids = chip_ids
+        self.is_current = is_current
+        self.on_flash = on_flash
+        self.on_finished = on_finished
+        # How many flashes have been shown so far
+        self.position = 0
+        self.started_at = None
+
+    def start(self):
+        """
+        Starts the playback and returns straight away.
+        """
+        self.started_at = time.monotonic()
+        self._arm()
+        return self
+
+    def _arm(self):
+        # Deadlines come from the start time, not from the previous flash,
+        # so a late timer doesn't push all the following flashes back
+        deadline = self.started_at + playback_duration(self.position)
+        self.scheduler.call_later(max(0.0, deadline - time.monotonic()), self._step)
+
+    def _step(self):
+        if not self.is_current():
+            return
+        if self.position < len(self.chip_ids):
+            self.on_flash(self.chip_ids[self.position])
+            self.position += 1
+            self._arm()
+        else:
+            self.on_finished(self.position)
@@ -0,0 +1,117 @@
+# protocol.py
+# This file defines the compact binary trigger packet that stations can send
+# instead of JSON. It is a fixed 24-byte layout, so the server can read every
+# field straight out of the received buffer with 'struct' (no JSON parsing,
+# no intermediate dictionaries).
+#
+# Layout (little-endian, no padding):
+#
+#   offset  size  field
+#   0       1     magic        always 0xB7 (a JSON body can never start with it)
+#   1       1     version      always 1
+#   2       4     chip_id      ESP.getChipId()
+#   6       2     distance_mm  distance in millimetres (0 = registration packet)
+#   8       4     seq          per-station counter, +1 for every packet sent
+#   12      4     station_ms   millis() on the station when it fired
+#   16      8     room_id      ASCII room name, NUL-padded (all NULs = default room)
+#
+# It must match the 'TriggerPacket' struct in 'esp8266/client.ino'.
+#
+# JSON triggers ('parse_json_trigger') carry the same fields by name:
+#   {"chipId": 9072791, "roomId": "gym-1", "distance": 12.5, "seq": 7, "ms": 123456}
+
+import math   # Rejects a JSON distance that isn't a finite number
+import struct # Reads and writes the fixed binary layout
+
+TRIGGER_MAGIC = 0xB7
+TRIGGER_VERSION = 1
+
+# The compiled layout. 'unpack_from' reads it directly out of any buffer
+# (bytes, bytearray or memoryview) without copying the packet first.
+TRIGGER_PACKET = struct.Struct('<BBIHII8s')
+TRIGGER_PACKET_SIZE = TRIGGER_PACKET.size # 24 bytes
+
+# The longest room name that fits in a binary packet
+MAX_BINARY_ROOM_ID_LENGTH = 8
+
+# Virtual stations played by 'simulate_stations.py' use chip IDs starting
+# here, far above any real ESP.getChipId() we have seen
+SIMULATED_CHIP_ID_BASE = 100000000
+
+
+def is_binary_trigger(buffer):
+    """
+    Returns True if 'buffer' looks like a binary trigger packet (and not JSON).
+    """
+    return len(buffer) >= TRIGGER_PACKET_SIZE and buffer[0] == TRIGGER_MAGIC
+
+
+def parse_trigger(buffer, offset=0):
+    """
+    Reads one binary trigger packet starting at 'offset' in 'buffer'.
+    Returns a tuple (chip_id, room_id, distance_cm, seq, station_ms), where
+    'chip_id' is a string like the JSON path uses and 'room_id' is None for
+    the default room. Raises ValueError if the packet is not valid.
+    """
+    if len(buffer) - offset < TRIGGER_PACKET_SIZE:
+        raise ValueError("Trigger packet is too short")
+
+    magic, version, chip_id, distance_mm, seq, station_ms, room_id = TRIGGER_PACKET.unpack_from(buffer, offset)
+    if magic != TRIGGER_MAGIC or version != TRIGGER_VERSION:
+        raise ValueError("Not a version 1 trigger packet")
+
+    room_id = room_id.rstrip(b'\0')
+    return (
+        str(chip_id),
+        room_id.decode('ascii', 'replace') if room_id else None,
+        distance_mm / 10.0,
+        seq,
+        station_ms
+    )
+
+
+def parse_json_trigger(data, room_id=None):
+    """
+    Reads one JSON trigger (an already decoded JSON value) and checks the
+    type of every field the server uses. Returns the same tuple as
+    'parse_trigger'; 'room_id' is the room for a trigger that doesn't name
+    its own. Raises ValueError if the trigger is not valid, so a bad one
+    (e.g. '"distance": null') is rejected before anything is done with it.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Trigger JSON must be an object")
+
+    chip_id = data.get('chipId', 'Unknown')
+    # 'bool' is a subclass of 'int', but never a chipId
+    if isinstance(chip_id, bool) or not isinstance(chip_id, (str, int)):
+        raise ValueError("'chipId' must be a number or a string")
+
+    room_id = data.get('roomId', room_id)
+    if room_id is not None and (isinstance(room_id, bool) or not isinstance(room_id, (str, int))):
+        raise ValueError("'roomId' must be a string")
+
+    distance = data.get('distance', 0.0)
+    if isinstance(distance, bool) or not isinstance(distance, (int, float)) or not math.isfinite(distance):
+        raise ValueError("'distance' must be a number")
+
+    return str(chip_id), room_id, float(distance), data.get('seq'), data.get('ms')
+
+
+def pack_trigger(chip_id, distance_cm, seq=0, station_ms=0, room_id=None):
+    """
+    Builds one binary trigger packet. The firmware does this in C; this
+    version is for tools and simulators written in Python.
+    """
+    room_bytes = (room_id or '').encode('ascii')
+    if len(room_bytes) > MAX_BINARY_ROOM_ID_LENGTH:
+        raise ValueError(f"Room ID '{room_id}' is longer than {MAX_BINARY_ROOM_ID_LENGTH} characters")
+
+    return TRIGGER_PACKET.pack(
+        TRIGGER_MAGIC,
+        TRIGGER_VERSION,
+        int(chip_id),
+        min(int(round(distance_cm * 10)), 0xFFFF),
+        seq & 0xFFFFFFFF,
+        station_ms & 0xFFFFFFFF,
+        room_bytes
+    )
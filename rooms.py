@@ -0,0 +1,377 @@
+# rooms.py
+# This file contains the room registry that lets one server process host
+# many independent "Simon Says" games at the same time.
+# Like 'game.py', it does not contain any Flask or SocketIO-specific code.
+
+import threading # Used to protect the registry when rooms are created
+import time # When each board was last seen
+
+from game import Game # Each room owns its own Game instance
+from log import DEBUG, get_logger # Structured, level-gated logging
+import metrics # Trigger counters and input-check timings
+
+log = get_logger('rooms')
+
+# --- Metrics ---
+TRIGGERS = metrics.counter('boxbots_triggers_total', 'Triggers received from stations, by chip.')
+CHECK_INPUT_SECONDS = metrics.histogram(
+    'boxbots_check_player_input_seconds',
+    'Time spent in Game.check_player_input for one trigger.'
+)
+PLAYER_INPUTS = metrics.counter('boxbots_player_inputs_total', 'Checked player inputs, by result.')
+TRIGGERS_DROPPED = metrics.counter(
+    'boxbots_triggers_dropped_total',
+    'Triggers dropped as a repeat of an earlier one, by reason.'
+)
+
+# The room used by stations and browsers that don't ask for a specific one.
+# This keeps old firmware (which never sends a 'roomId') working unchanged.
+DEFAULT_ROOM_ID = 'default'
+
+# A trigger whose 'seq' is at most this far behind the last one seen from
+# its station is a retry or a late duplicate (UDP can deliver a datagram
+# twice, or out of order), not a new trigger
+SEQ_REPLAY_WINDOW = 8
+
+# Station counters are 32 bits and wrap around
+SEQ_MASK = 0xFFFFFFFF
+
+
+def room_key(room_id):
+    """
+    The registry's name for 'room_id': a missing or empty room ID means the
+    default room.
+    """
+    return str(room_id) if room_id else DEFAULT_ROOM_ID
+
+
+def socketio_room_name(room_id):
+    """
+    The SocketIO room that browsers watching 'room_id' join. We prefix it
+    so it can never clash with a client's own sid room.
+    """
+    return f"game:{room_id}"
+
+
+class Board:
+    """
+    One station connected to a room. A small record with '__slots__' (no
+    per-instance dictionary), since a server can hold many thousands.
+    """
+
+    __slots__ = ('chip_id', 'color', 'index', 'last_seen', 'triggers', 'last_seq', 'last_flash')
+
+    def __init__(self, chip_id, color, index):
+        self.chip_id = chip_id
+        self.color = color
+        # The board index the room's Game gave this chipId
+        self.index = index
+        # time.monotonic() of the last trigger from this board
+        self.last_seen = time.monotonic()
+        # How many triggers this board has sent
+        self.triggers = 0
+        # The 'seq' of the last trigger from this board (None if it never
+        # sent one) and the time.monotonic() of its last accepted flash
+        self.last_seq = None
+        self.last_flash = None
+
+    def drop_reason(self, distance, seq, now, debounce_seconds):
+        """
+        Says whether a trigger from this board only repeats an earlier one:
+        'duplicate' if its 'seq' was already seen, 'debounced' if it came
+        less than 'debounce_seconds' after the last flash, otherwise None.
+        """
+        # A 0.0 registration packet is sent when a station (re)starts, so its
+        # counter starts over; it is never dropped
+        if distance <= 0.0:
+            return None
+        if isinstance(seq, int) and self.last_seq is not None:
+            # How far behind the last seq this one is. A station that
+            # restarted without registering again is far "behind" and
+            # counts as new, like a counter that wrapped around.
+            if (self.last_seq - seq) & SEQ_MASK < SEQ_REPLAY_WINDOW:
+                return 'duplicate'
+        if self.last_flash is not None and now - self.last_flash < debounce_seconds:
+            return 'debounced'
+        return None
+
+    def remember(self, distance, seq, now):
+        """
+        Records an accepted trigger, so later repeats of it can be dropped.
+        """
+        # (a JSON trigger's 'seq' is only trusted if it is a number)
+        if isinstance(seq, int):
+            self.last_seq = seq & SEQ_MASK
+        if distance > 0.0:
+            self.last_flash = now
+
+
+class Room:
+    """
+    Everything that belongs to a single game room: its Game instance,
+    the boards that have connected to it, and its SocketIO room name.
+    Like Game and Board, it uses '__slots__' to stay small while idle.
+    """
+
+    __slots__ = (
+        'room_id', 'socketio_room', 'boards', 'connected_boards', 'watchers',
+        'player_timeout_callback', 'debounce_seconds', 'game'
+    )
+
+    def __init__(self, room_id, player_timeout_callback, scheduler=None, avoid_repeats=False, debounce_seconds=0.0,
+                 journal=None, leaderboard=None):
+        # The public name of the room (e.g. 'default', 'gym-1')
+        self.room_id = room_id
+
+        # The SocketIO room that browsers watching this game join
+        self.socketio_room = socketio_room_name(room_id)
+
+        # { chipId: Board } for the *active* boards of this room only
+        self.boards = {}
+        # The same boards as { chipId: color }, which is exactly what the
+        # browsers get in 'update_boards', so it is kept ready to send.
+        # Example: { "123456": "red", "789012": "green" }
+        self.connected_boards = {}
+
+        # The SocketIO session IDs of the browsers watching this room.
+        # Nothing is emitted to a room that nobody is watching.
+        self.watchers = set()
+
+        # Triggers from one board closer together than this are dropped
+        self.debounce_seconds = debounce_seconds
+
+        # The game logic for this room. The timeout callback is given the
+        # room so the server knows *which* game timed out.
+        self.player_timeout_callback = player_timeout_callback
+        self.game = Game(
+            player_timeout_callback=self._on_player_timeout,
+            scheduler=scheduler,
+            room_id=room_id,
+            avoid_repeats=avoid_repeats,
+            journal=journal,
+            leaderboard=leaderboard
+        )
+
+    def _on_player_timeout(self):
+        self.player_timeout_callback(self)
+
+    def register_board(self, chip_id, color):
+        """
+        Adds a board to this room.
+        Returns True if the board is new, False if it was already connected.
+        """
+        if chip_id in self.boards:
+            return False
+
+        # Give the game the new board first, so it gets its board index
+        self.game.set_available_boards((chip_id,))
+        self.boards[chip_id] = Board(chip_id, color, self.game.board_indexes[chip_id])
+        self.connected_boards[chip_id] = color
+        log.info('board_connected', room=self.room_id, chip_id=chip_id, color=color)
+        return True
+
+    def restore(self, boards, handed_off):
+        """
+        Puts back a room that another worker handed over, or that a snapshot
+        saved before a restart: 'boards' maps chipIds to colors, in the order
+        they connected (so every board gets its old board index back), and
+        'handed_off' is the game from 'Game.hand_off' or 'Game.describe'
+        (None if no game was running). Returns the epoch from
+        'Game.take_over', or None.
+        """
+        for chip_id, color in boards.items():
+            self.register_board(chip_id, color)
+        if handed_off is None:
+            return None
+        return self.game.take_over(handed_off)
+
+    def add_watcher(self, sid):
+        self.watchers.add(sid)
+
+    def remove_watcher(self, sid):
+        self.watchers.discard(sid)
+
+    def has_watchers(self):
+        """
+        True if at least one browser is watching this room.
+        """
+        return bool(self.watchers)
+
+    def is_idle(self):
+        """
+        True if nothing is left in this room: nobody watching, no boards
+        and no game running. Such a room can be forgotten and created
+        again the next time it is needed.
+        """
+        return not self.watchers and not self.boards and not self.game.is_active()
+
+    def drop_trigger(self, chip_id, distance, seq=None):
+        """
+        Checks a trigger before anything else is done with it. Returns the
+        reason it should be dropped ('duplicate' or 'debounced'), or None to
+        process it. A station's retries and noisy repeated readings never
+        reach the game or the browsers.
+        """
+        board = self.boards.get(chip_id)
+        if board is None:
+            # The board's first trigger can't repeat anything
+            return None
+        reason = board.drop_reason(distance, seq, time.monotonic(), self.debounce_seconds)
+        if reason is not None:
+            TRIGGERS_DROPPED.inc(reason=reason)
+            log.sampled(DEBUG, 'trigger_dropped', room=self.room_id, chip_id=chip_id, seq=seq, reason=reason)
+        return reason
+
+    def process_trigger(self, chip_id, color, distance, seq=None):
+        """
+        Runs one trigger from a known station through this room. This is the
+        part of '/data' that every server mode (Flask or asyncio) shares.
+        Call 'drop_trigger' first; 'seq' is the station's counter, if it
+        sent one.
+
+        Returns (board_added, result):
+        - board_added: True if this trigger registered a new board
+        - result: the game's answer ('CORRECT', 'WRONG', 'LEVEL_COMPLETE',
+          'INVALID'), or None if the trigger wasn't checked as player input
+        """
+        board_added = self.register_board(chip_id, color)
+        board = self.boards[chip_id]
+        board.last_seen = time.monotonic()
+        board.triggers += 1
+        board.remember(distance, seq, board.last_seen)
+
+        # Log the data (every trigger at DEBUG level, sampled so a busy
+        # server isn't slowed down by its own console output)
+        log.sampled(DEBUG, 'trigger', room=self.room_id, chip_id=chip_id, distance=distance)
+        TRIGGERS.inc(chip_id=chip_id)
+
+        result = None
+        # A distance of 0.0 is the special registration packet, so it is
+        # never player input. Otherwise, check it if it's the player's turn.
+        if distance > 0.0 and self.game.state == 'PLAYER_TURN':
+            with CHECK_INPUT_SECONDS.time():
+                result = self.game.check_player_input(chip_id)
+            PLAYER_INPUTS.inc(result=result)
+        return board_added, result
+
+
+class RoomRegistry:
+    """
+    Maps a room ID to its Room. Rooms are created lazily by the first
+    trigger or 'start_game' that names them, and forgotten again once they
+    are idle. A browser that only watches a room never creates it, so a
+    client can't make the server keep (and journal, and snapshot) a Game
+    for every room name it makes up.
+    """
+
+    def __init__(self, player_timeout_callback, scheduler=None, avoid_repeats=False, debounce_seconds=0.0,
+                 journal=None, leaderboard=None):
+        # The callback every new room's Game will use when a player times out
+        self.player_timeout_callback = player_timeout_callback
+        # The timer scheduler every new room's Game will use
+        # (None means the shared thread-based default scheduler)
+        self.scheduler = scheduler
+        # Whether every new room's sequences avoid picking a board twice in a row
+        self.avoid_repeats = avoid_repeats
+        # How close together two triggers from one board may be in every new room
+        self.debounce_seconds = debounce_seconds
+        # The journal every new room's Game records itself in (None: no journal)
+        self.journal = journal
+        # The leaderboard every new room's finished games go on (None: no leaderboard)
+        self.leaderboard = leaderboard
+
+        # { room_id: Room }
+        self.rooms = {}
+        # { room_id: {sid, ...} } for the browsers watching a room that
+        # doesn't exist (yet). They become the room's watchers when it is
+        # created. Each browser watches one room, so this can't grow past
+        # the number of connected browsers.
+        self.waiting_watchers = {}
+
+        # Requests arrive on many threads at once; this lock makes sure two
+        # of them can never create the same room twice.
+        self._lock = threading.Lock()
+
+        # Each server process has one registry, so the first one owns the gauge
+        metrics.gauge('boxbots_rooms', 'Rooms hosted by this process.', lambda: len(self.rooms))
+        metrics.gauge('boxbots_watchers', 'Browsers watching a room on this process.',
+                      lambda: sum(len(room.watchers) for room in list(self.rooms.values())))
+
+    def get(self, room_id):
+        """
+        Returns the Room for 'room_id', or None if it doesn't exist yet.
+        A missing or empty room ID means the default room.
+        """
+        return self.rooms.get(room_key(room_id))
+
+    def get_or_create(self, room_id=None):
+        """
+        Returns the Room for 'room_id', creating it if needed.
+        A missing or empty room ID means the default room.
+        """
+        room_id = room_key(room_id)
+
+        # Fast path: the room already exists, no lock needed
+        room = self.rooms.get(room_id)
+        if room is not None:
+            return room
+
+        with self._lock:
+            # Check again, another thread may have created it meanwhile
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = Room(
+                    room_id, self.player_timeout_callback, self.scheduler,
+                    self.avoid_repeats, self.debounce_seconds, self.journal, self.leaderboard
+                )
+                # The browsers already waiting for this room watch it now
+                room.watchers = self.waiting_watchers.pop(room_id, set())
+                self.rooms[room_id] = room
+                log.info('room_created', room=room_id)
+            return room
+
+    def watch(self, room_id, sid):
+        """
+        Adds the browser 'sid' to the watchers of 'room_id' (a room_key),
+        without creating the room. Returns the Room, or None if it doesn't
+        exist yet.
+        """
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                self.waiting_watchers.setdefault(room_id, set()).add(sid)
+            else:
+                room.add_watcher(sid)
+            return room
+
+    def unwatch(self, room_id, sid):
+        """
+        Removes the browser 'sid' from the watchers of 'room_id' (a
+        room_key), and forgets the room if that left it idle.
+        """
+        with self._lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                waiting = self.waiting_watchers.get(room_id)
+                if waiting is not None:
+                    waiting.discard(sid)
+                    if not waiting:
+                        del self.waiting_watchers[room_id]
+                return
+            room.remove_watcher(sid)
+        self.discard_if_idle(room)
+
+    def discard_if_idle(self, room):
+        """
+        Forgets 'room' if it is idle (see 'Room.is_idle'). The next trigger
+        or 'start_game' naming it creates it again. Returns True if it was
+        forgotten.
+        """
+        # A trigger that fetched the room just before this only loses its
+        # own effect: the next one creates the room again
+        with self._lock:
+            if self.rooms.get(room.room_id) is not room or not room.is_idle():
+                return False
+            del self.rooms[room.room_id]
+        log.info('room_removed', room=room.room_id)
+        return True
@@ -0,0 +1,192 @@
+# scheduler.py
+# This file contains a shared timer service for all games.
+# Instead of every Game starting its own 'threading.Timer' (a whole OS thread
+# per turn), every game registers its deadlines here, and ONE background
+# thread fires them in order. Arming a timer is O(log n), cancelling is O(1).
+
+import asyncio   # For the asyncio server mode's event-loop timers
+import heapq     # A binary heap keeps the earliest deadline at the front
+import itertools # Gives every timer a unique, increasing tie-breaker number
+import threading # For the single timer thread and its lock
+import time      # For the monotonic clock used by all deadlines
+
+from log import get_logger # Structured, level-gated logging
+import metrics # Timer lateness histogram
+
+log = get_logger('scheduler')
+
+# How late each timer fired compared to its deadline. If this grows, the
+# timer thread (or the event loop) is falling behind.
+TIMER_LATENESS_SECONDS = metrics.histogram(
+    'boxbots_timer_lateness_seconds',
+    'How long after its deadline each timer callback started.'
+)
+
+
+class TimerHandle:
+    """
+    Returned by 'TimerScheduler.call_later'. Works like a 'threading.Timer'
+    that has already been started: call 'cancel()' to stop it from firing.
+    """
+
+    def __init__(self, scheduler, deadline, callback):
+        self.scheduler = scheduler
+        # The time.monotonic() value at which the callback should run
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stops the timer. Safe to call more than once, or after it fired.
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler._on_cancel()
+
+    def remaining(self):
+        """
+        Seconds left before the timer fires (0.0 if it is already due).
+        """
+        return max(0.0, self.deadline - time.monotonic())
+
+
+class TimerScheduler:
+    """
+    A heap-based timer service. Any number of games share one thread.
+    """
+
+    def __init__(self):
+        # The heap holds (deadline, tie_breaker, handle) tuples
+        self._heap = []
+        self._counter = itertools.count()
+        # How many cancelled handles are still sitting in the heap
+        self._cancelled_count = 0
+        # The condition wakes the timer thread when an earlier deadline arrives
+        self._condition = threading.Condition()
+        # The timer thread is only started the first time it is needed
+        self._thread = None
+
+    def call_later(self, delay, callback):
+        """
+        Runs 'callback()' on the timer thread after 'delay' seconds.
+        Returns a TimerHandle that can be used to cancel it.
+        """
+        handle = TimerHandle(self, time.monotonic() + delay, callback)
+        with self._condition:
+            heapq.heappush(self._heap, (handle.deadline, next(self._counter), handle))
+            self._ensure_thread()
+            # Only wake the thread if this is now the earliest deadline
+            if self._heap[0][2] is handle:
+                self._condition.notify()
+        return handle
+
+    def pending_count(self):
+        """
+        Returns how many timers are armed and not cancelled.
+        """
+        with self._condition:
+            return len(self._heap) - self._cancelled_count
+
+    def _on_cancel(self):
+        """
+        Called by TimerHandle.cancel(). Cancelled handles are left in the heap
+        and skipped when they reach the front ("lazy deletion"). If they pile
+        up, we rebuild the heap without them so memory stays bounded.
+        """
+        with self._condition:
+            self._cancelled_count += 1
+            if self._cancelled_count > 64 and self._cancelled_count > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_count = 0
+
+    def _ensure_thread(self):
+        """
+        Starts the timer thread if it isn't running yet. Caller holds the lock.
+        """
+        if self._thread is None:
+            # 'daemon=True' so the thread never keeps the server from exiting
+            self._thread = threading.Thread(target=self._run, name='timer-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """
+        The body of the timer thread: sleep until the earliest deadline,
+        then fire every timer that is due.
+        """
+        while True:
+            with self._condition:
+                # Drop cancelled timers from the front of the heap
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled_count -= 1
+
+                if not self._heap:
+                    # Nothing to do, sleep until a timer is armed
+                    self._condition.wait()
+                    continue
+
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    # Not due yet. Wake up on time, or earlier if notified.
+                    self._condition.wait(delay)
+                    continue
+
+                _, _, handle = heapq.heappop(self._heap)
+                # Mark it so a late 'cancel()' doesn't count it as pending
+                handle.cancelled = True
+
+            TIMER_LATENESS_SECONDS.observe(-delay)
+            # Run the callback *outside* the lock so it can arm new timers
+            try:
+                handle.callback()
+            except Exception:
+                log.exception('timer_callback_failed')
+
+
+class AsyncioScheduler:
+    """
+    The same interface as TimerScheduler, for the asyncio server mode.
+    Timers live on the event loop's own heap ('loop.call_later'), so no
+    extra thread is needed at all. Must be used from the event loop thread.
+    """
+
+    def __init__(self, loop=None):
+        # The event loop to arm timers on (None means the running loop)
+        self.loop = loop
+
+    def call_later(self, delay, callback):
+        """
+        Runs 'callback()' on the event loop after 'delay' seconds.
+        Returns a handle with the same 'cancel()'/'remaining()' methods
+        as a TimerHandle.
+        """
+        loop = self.loop or asyncio.get_running_loop()
+        deadline = loop.time() + delay
+
+        def fire():
+            TIMER_LATENESS_SECONDS.observe(max(0.0, loop.time() - deadline))
+            callback()
+
+        return _AsyncioTimerHandle(loop, loop.call_at(deadline, fire))
+
+
+class _AsyncioTimerHandle:
+    """
+    Wraps an 'asyncio.TimerHandle' so it looks like a TimerHandle.
+    """
+
+    def __init__(self, loop, handle):
+        self.loop = loop
+        self.handle = handle
+
+    def cancel(self):
+        self.handle.cancel()
+
+    def remaining(self):
+        return max(0.0, self.handle.when() - self.loop.time())
+
+
+# The scheduler shared by every Game in this process
+default_scheduler = TimerScheduler()
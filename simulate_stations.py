@@ -0,0 +1,454 @@
+# simulate_stations.py
+# This file is a station simulator and load generator, so the server can be
+# load-tested without any physical ESP8266 boxes.
+#
+# It plays N virtual stations. Each one registers like 'client.ino' does
+# (a 0.0 distance packet over HTTP) and then sends triggers at a chosen rate
+# and distribution over any transport the server supports:
+#
+#   http-json    POST /data with the same JSON as 'client.ino'
+#   http-binary  POST /data with the 24-byte packet from 'protocol.py'
+#   udp-json     the same JSON as one UDP datagram to the trigger port
+#   udp-binary   the 24-byte packet as one UDP datagram
+#
+# It can also connect one SocketIO client per room to measure how long a
+# trigger takes to come back as 'new_message' (--observe), and play a
+# "perfect player" in the first room that copies every 'show_flash'
+# sequence back to the server (--perfect-player).
+#
+# The server only accepts chip IDs it knows, so start it with
+# BOXBOTS_SIMULATED_STATIONS set to at least the number of stations:
+#
+#   BOXBOTS_SIMULATED_STATIONS=1000 python app.py
+#   python simulate_stations.py --stations 1000 --rate 0.5 --duration 30 --observe
+#
+# The server drops triggers from one station that come closer together than
+# its debounce window (150 ms); add BOXBOTS_DEBOUNCE_MS=0 to measure them all.
+#
+# --observe and --perfect-player need the asyncio SocketIO client:
+#   pip install "python-socketio[asyncio_client]"
+
+import argparse # Command line options
+import asyncio  # Every station is a coroutine, so 1000+ fit in one process
+import json     # The JSON trigger format and the --json report
+import random   # Trigger timing, distances and burst phases
+import time     # For measuring latencies
+from urllib.parse import urlsplit # To split '--server' into host and port
+
+from protocol import MAX_BINARY_ROOM_ID_LENGTH, SIMULATED_CHIP_ID_BASE, pack_trigger
+
+try:
+    import socketio # python-socketio, only needed for --observe / --perfect-player
+except ImportError:
+    socketio = None
+
+TRANSPORTS = ('http-json', 'http-binary', 'udp-json', 'udp-binary')
+DISTRIBUTIONS = ('constant', 'poisson', 'burst')
+
+# Triggers inside one burst are this far apart (seconds)
+BURST_SPACING = 0.05
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value below which 'fraction' (e.g. 0.99) of the sorted
+    values fall, or None if there are none.
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize_latencies(latencies):
+    """
+    Turns a list of latencies in seconds into a dictionary of milliseconds.
+    """
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    for name, fraction in (('p50_ms', 0.50), ('p90_ms', 0.90), ('p99_ms', 0.99)):
+        value = percentile(values, fraction)
+        summary[name] = round(value * 1000.0, 3) if value is not None else None
+    summary['max_ms'] = round(values[-1] * 1000.0, 3) if values else None
+    return summary
+
+
+async def http_request(host, port, method, path, body=b'', content_type='application/json'):
+    """
+    Sends one HTTP request on a new connection (like 'client.ino' does)
+    and returns (status_code, response_body).
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('ascii') + body
+        )
+        await writer.drain()
+        # Read everything, until the server closes the connection
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, response_body = response.partition(b'\r\n\r\n')
+    return int(head.split(None, 2)[1]), response_body
+
+
+class Station:
+    """
+    One virtual station: a chip ID, the room it plays in, and its own
+    packet counter, like 'triggerSeq' in 'client.ino'.
+    """
+
+    def __init__(self, chip_id, room_id):
+        self.chip_id = chip_id
+        self.room_id = room_id
+        self.seq = 0
+
+    def build_json(self, distance):
+        self.seq += 1
+        return json.dumps({
+            'message': 'Triggered',
+            'chipId': self.chip_id,
+            'roomId': self.room_id,
+            'distance': round(distance, 2),
+            'seq': self.seq,
+            'ms': int(time.monotonic() * 1000) & 0xFFFFFFFF
+        }).encode('utf-8')
+
+    def build_binary(self, distance):
+        self.seq += 1
+        return pack_trigger(self.chip_id, distance, self.seq, int(time.monotonic() * 1000), self.room_id)
+
+
+class Simulator:
+    """
+    Runs every virtual station, the optional observers and the optional
+    perfect player, and collects the numbers for the report.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        url = urlsplit(options.server)
+        self.host = url.hostname or '127.0.0.1'
+        self.port = url.port or 80
+
+        rooms = [f"{options.room_prefix}{i}" for i in range(options.rooms)]
+        self.rooms = rooms
+        # Stations are dealt out to the rooms in turn
+        self.stations = [
+            Station(SIMULATED_CHIP_ID_BASE + i, rooms[i % len(rooms)])
+            for i in range(options.stations)
+        ]
+        # { chip_id: Station }, for the perfect player
+        self.stations_by_chip = {station.chip_id: station for station in self.stations}
+
+        # Limits open HTTP connections, so we don't run out of sockets
+        self.in_flight = asyncio.Semaphore(options.max_in_flight)
+        # The shared UDP socket (created in 'run' for UDP transports)
+        self.udp_transport = None
+
+        # --- Results ---
+        self.sent = 0
+        self.ok = 0
+        self.errors = 0
+        # Seconds from sending a request to reading its response (HTTP only)
+        self.response_latencies = []
+        # { (chip_id, seq): time sent }, waiting to be seen as 'new_message'
+        self.pending_flashes = {}
+        # Seconds from sending a trigger to an observer seeing 'new_message'
+        self.flash_latencies = []
+        self.levels_completed = 0
+        self.games_over = 0
+
+    # --- Sending ---
+
+    async def post(self, path, body, content_type):
+        """
+        Sends one HTTP POST and returns the response status code.
+        """
+        async with self.in_flight:
+            status, _ = await http_request(self.host, self.port, 'POST', path, body, content_type)
+            return status
+
+    async def send_trigger(self, station, distance, transport=None):
+        """
+        Sends one trigger from 'station' and records the result.
+        """
+        transport = transport or self.options.transport
+        if transport.endswith('binary'):
+            body = station.build_binary(distance)
+        else:
+            body = station.build_json(distance)
+
+        if self.options.observe and distance > 0.0:
+            self.pending_flashes[(str(station.chip_id), station.seq)] = time.perf_counter()
+
+        self.sent += 1
+        if transport.startswith('udp'):
+            # Fire and forget, exactly like a station in UDP mode
+            self.udp_transport.sendto(body)
+            self.ok += 1
+            return
+
+        content_type = 'application/octet-stream' if transport.endswith('binary') else 'application/json'
+        started = time.perf_counter()
+        try:
+            status = await self.post('/data', body, content_type)
+        except (OSError, ValueError, IndexError):
+            self.errors += 1
+            return
+        self.response_latencies.append(time.perf_counter() - started)
+        if 200 <= status < 300:
+            self.ok += 1
+        else:
+            self.errors += 1
+
+    async def register_all(self):
+        """
+        Registers every station with a 0.0 distance packet over HTTP,
+        like 'client.ino' does when it finds the server.
+        """
+        await asyncio.gather(*(self.send_trigger(station, 0.0, 'http-json') for station in self.stations))
+
+    # --- Load ---
+
+    def intervals(self):
+        """
+        Yields the gaps (seconds) between one station's triggers for the
+        chosen distribution, all averaging '--rate' triggers per second.
+        """
+        rate = self.options.rate
+        distribution = self.options.distribution
+        while True:
+            if distribution == 'constant':
+                yield 1.0 / rate
+            elif distribution == 'poisson':
+                yield random.expovariate(rate)
+            else:
+                # 'burst': several triggers close together, then a pause
+                burst = self.options.burst_size
+                for _ in range(burst - 1):
+                    yield BURST_SPACING
+                yield max(0.0, burst / rate - (burst - 1) * BURST_SPACING)
+
+    async def run_station(self, station, deadline):
+        """
+        Sends random triggers from one station until 'deadline'. The load is
+        open-loop: a slow response never delays the next trigger.
+        """
+        loop = asyncio.get_running_loop()
+        # Start at a random point so the stations don't all fire together
+        next_at = loop.time() + random.uniform(0.0, 1.0 / self.options.rate)
+        tasks = set()
+        for interval in self.intervals():
+            if next_at >= deadline:
+                break
+            await asyncio.sleep(max(0.0, next_at - loop.time()))
+            task = asyncio.ensure_future(self.send_trigger(station, random.uniform(5.0, 50.0)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += interval
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    # --- SocketIO Clients ---
+
+    async def connect_client(self, room_id):
+        """
+        Connects one SocketIO client to a room, like a browser showing
+        '/?room=<room_id>'.
+        """
+        client = socketio.AsyncClient(reconnection=False)
+
+        @client.on('new_message')
+        async def on_new_message(data):
+            sent_at = self.pending_flashes.pop((str(data.get('chipId')), data.get('seq')), None)
+            if sent_at is not None:
+                self.flash_latencies.append(time.perf_counter() - sent_at)
+            # Acknowledge it, like the page does, so '/traces' is complete
+            if data.get('traceId'):
+                await client.emit('trace_ack', {'traceId': data['traceId']})
+
+        await client.connect(f"{self.options.server}?room={room_id}", transports=['websocket'])
+        return client
+
+    async def perfect_player(self, client, room_id):
+        """
+        Plays the game in 'room_id' without ever making a mistake: it
+        remembers every 'show_flash' and then triggers the same stations in
+        the same order. When the game ends, it starts a new one.
+        """
+        sequence = []
+
+        async def play(moves):
+            for chip_id in moves:
+                await asyncio.sleep(self.options.player_delay)
+                # A board left over from an earlier run is played as a new station
+                station = self.stations_by_chip.setdefault(int(chip_id), Station(int(chip_id), room_id))
+                await self.send_trigger(station, 10.0)
+
+        async def restart():
+            await asyncio.sleep(1.0)
+            await client.emit('start_game', {'room': room_id, 'seed': self.options.seed})
+
+        @client.on('show_flash')
+        async def on_show_flash(data):
+            sequence.append(data['chipId'])
+
+        @client.on('game_update')
+        async def on_game_update(data):
+            status = data.get('status')
+            if status == 'SHOWING':
+                sequence.clear()
+            elif status == 'PLAYER_TURN':
+                asyncio.ensure_future(play(list(sequence)))
+            elif status == 'LEVEL_COMPLETE':
+                self.levels_completed += 1
+            elif status == 'GAME_OVER':
+                self.games_over += 1
+                asyncio.ensure_future(restart())
+            elif status == 'ERROR':
+                # e.g. the boards weren't registered yet
+                asyncio.ensure_future(restart())
+
+        await client.emit('start_game', {'room': room_id, 'seed': self.options.seed})
+
+    # --- Main ---
+
+    async def run(self):
+        options = self.options
+        loop = asyncio.get_running_loop()
+
+        if options.transport.startswith('udp'):
+            self.udp_transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, remote_addr=(self.host, options.trigger_port))
+
+        await self.register_all()
+        registration_errors = self.errors
+        # Registration isn't part of the load, so start counting afresh
+        self.sent = self.ok = self.errors = 0
+        self.response_latencies.clear()
+
+        clients = []
+        if options.observe or options.perfect_player:
+            clients = [await self.connect_client(room_id) for room_id in self.rooms]
+        player_room = self.rooms[0] if options.perfect_player else None
+        if player_room is not None:
+            await self.perfect_player(clients[0], player_room)
+
+        started = time.perf_counter()
+        deadline = loop.time() + options.duration
+        # The player's room only gets the player's triggers, so random
+        # triggers can't make it lose
+        noise = [station for station in self.stations if station.room_id != player_room]
+        if options.rate > 0:
+            await asyncio.gather(*(self.run_station(station, deadline) for station in noise))
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+        # Give the last flashes a moment to arrive
+        if options.observe:
+            await asyncio.sleep(1.0)
+        elapsed = time.perf_counter() - started
+
+        for client in clients:
+            await client.disconnect()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+
+        report = {
+            'transport': options.transport,
+            'distribution': options.distribution,
+            'stations': len(self.stations),
+            'rooms': len(self.rooms),
+            'target_rate': round(options.rate * len(noise), 3),
+            'duration_s': round(elapsed, 3),
+            'registration_errors': registration_errors,
+            'sent': self.sent,
+            'ok': self.ok,
+            'errors': self.errors,
+            'throughput_per_s': round(self.ok / elapsed, 3) if elapsed else 0.0,
+        }
+        if not options.transport.startswith('udp'):
+            report['response_latency'] = summarize_latencies(self.response_latencies)
+        if options.observe:
+            report['flash_latency'] = summarize_latencies(self.flash_latencies)
+            report['flash_latency']['missing'] = len(self.pending_flashes)
+        if options.perfect_player:
+            report['levels_completed'] = self.levels_completed
+            report['games_over'] = self.games_over
+        return report
+
+
+def print_report(report):
+    """
+    Prints the report for a human.
+    """
+    print(f"{report['stations']} stations in {report['rooms']} room(s), {report['transport']}, "
+          f"{report['distribution']}, target {report['target_rate']} triggers/s")
+    if report['registration_errors']:
+        print(f"  registration errors: {report['registration_errors']}")
+    print(f"  sent {report['sent']}, ok {report['ok']}, errors {report['errors']} "
+          f"in {report['duration_s']}s -> {report['throughput_per_s']} triggers/s")
+    for name in ('response_latency', 'flash_latency'):
+        if name in report:
+            latency = report[name]
+            line = (f"  {name}: n={latency['count']} p50={latency['p50_ms']}ms p90={latency['p90_ms']}ms "
+                    f"p99={latency['p99_ms']}ms max={latency['max_ms']}ms")
+            if 'missing' in latency:
+                line += f" missing={latency['missing']}"
+            print(line)
+    if 'levels_completed' in report:
+        print(f"  perfect player: {report['levels_completed']} levels completed, {report['games_over']} games over")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate many boxBots stations against a running server.")
+    parser.add_argument('--server', default='http://127.0.0.1:5000', help="the server's base URL")
+    parser.add_argument('--trigger-port', type=int, default=5008, help="the server's UDP trigger port")
+    parser.add_argument('--stations', type=int, default=100, help="number of virtual stations")
+    parser.add_argument('--rooms', type=int, default=1, help="number of rooms the stations are spread over")
+    parser.add_argument('--room-prefix', default='sim-', help="rooms are named <prefix>0, <prefix>1, ...")
+    parser.add_argument('--transport', choices=TRANSPORTS, default='http-json')
+    parser.add_argument('--rate', type=float, default=1.0, help="triggers per second per station (0 = none)")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='poisson',
+                        help="how each station's triggers are spread out in time")
+    parser.add_argument('--burst-size', type=int, default=5, help="triggers per burst for --distribution burst")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to send triggers for")
+    parser.add_argument('--max-in-flight', type=int, default=512, help="most HTTP requests open at once")
+    parser.add_argument('--observe', action='store_true',
+                        help="measure trigger -> 'new_message' latency with one SocketIO client per room")
+    parser.add_argument('--perfect-player', action='store_true',
+                        help="play the game in the first room, copying every sequence back")
+    parser.add_argument('--player-delay', type=float, default=0.2, help="seconds between the player's moves")
+    parser.add_argument('--seed', type=int, help="seed for the perfect player's games, so every run plays the same sequence")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    options = parser.parse_args(argv)
+
+    if options.stations < 1 or options.rooms < 1:
+        parser.error("--stations and --rooms must be at least 1")
+    if options.rate < 0:
+        parser.error("--rate can't be negative")
+    if options.burst_size < 1:
+        parser.error("--burst-size must be at least 1")
+    longest_room = f"{options.room_prefix}{options.rooms - 1}"
+    if options.transport.endswith('binary') and len(longest_room) > MAX_BINARY_ROOM_ID_LENGTH:
+        parser.error(f"room '{longest_room}' is too long for binary packets; use a shorter --room-prefix")
+    if (options.observe or options.perfect_player) and socketio is None:
+        parser.error('--observe and --perfect-player need: pip install "python-socketio[asyncio_client]"')
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = asyncio.run(Simulator(options).run())
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# snapshot.py
+# This file contains the snapshots behind a warm restart.
+#
+# Every SNAPSHOT_INTERVAL seconds a background thread writes down every room
+# that has boards: its boards (chipId -> color, in the order they connected)
+# and, if a game is running, the game as 'Game.describe' gives it (state,
+# sequence, seed, the player's input index and the time left in the turn).
+# That is exactly the 'take_over' message a worker gets when a room is
+# handed to it ('asgi_app.py'), so a restarted server carries on with its
+# old rooms the same way: the boards come back with their old board
+# indexes, a player's turn goes on with the time that was left, and a level
+# that was being shown is shown again.
+#
+# A snapshot is one small JSON file. It is written to a temporary file,
+# fsynced, then renamed over the old one, so a crash at any moment leaves
+# either the old snapshot or the new one, never half of one. A crash loses
+# at most the last SNAPSHOT_INTERVAL: a turn restored from an older
+# snapshot just gets that much extra time.
+#
+# The journal ('journal.py') can rebuild the same games, but it has to be
+# replayed from the start; a snapshot is read in a millisecond.
+
+import atexit    # To take one last snapshot when the server exits
+import json      # The snapshot file format
+import os        # Atomic rename and fsync
+import threading # The snapshot writer thread
+import time      # The snapshot's age
+
+from log import get_logger # Structured, level-gated logging
+import metrics # Snapshot write timings
+
+log = get_logger('snapshot')
+
+# --- Metrics ---
+SNAPSHOT_WRITE_SECONDS = metrics.histogram(
+    'boxbots_snapshot_write_seconds',
+    'Time to take, write and fsync one snapshot of every room.'
+)
+
+# Seconds between two snapshots
+SNAPSHOT_INTERVAL = 1.0
+# Bumped whenever the snapshot layout changes; other versions are ignored
+SNAPSHOT_VERSION = 1
+
+
+def room_snapshot(room):
+    """
+    Returns one room as a JSON-able dictionary (the same shape as a
+    'take_over' message), or None if the room has nothing worth keeping.
+    """
+    boards = dict(room.connected_boards)
+    if not boards:
+        return None
+    game = room.game
+    return {
+        'roomId': room.room_id,
+        'boards': boards,
+        'game': game.describe() if game.is_active() else None
+    }
+
+
+def take_snapshot(room_registry):
+    """
+    Returns every room of 'room_registry' as one JSON-able dictionary.
+    """
+    rooms = []
+    for room in list(room_registry.rooms.values()):
+        saved = room_snapshot(room)
+        if saved is not None:
+            rooms.append(saved)
+    return {'version': SNAPSHOT_VERSION, 'takenAt': time.time(), 'rooms': rooms}
+
+
+def write_snapshot(path, snapshot):
+    """
+    Replaces the snapshot file at 'path' with 'snapshot', atomically.
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path):
+    """
+    Returns the snapshot saved at 'path', or None if there is none (or it
+    can't be used; the server then simply starts empty).
+    """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning('snapshot_unreadable', path=path, error=e)
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        log.warning('snapshot_unreadable', path=path, error='unknown version')
+        return None
+    log.info('snapshot_read', path=path, rooms=len(snapshot['rooms']),
+             age=round(time.time() - snapshot['takenAt'], 3))
+    return snapshot
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot of 'room_registry' to 'path' every 'interval' seconds
+    from a background thread, and one last time when it is stopped (or the
+    server exits).
+    """
+
+    def __init__(self, path, room_registry, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.room_registry = room_registry
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # The rooms of the last snapshot written, so an idle server doesn't
+        # rewrite the same file every second
+        self._last_rooms = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        log.info('snapshots_started', path=self.path, interval=self.interval)
+        return self
+
+    def stop(self):
+        """
+        Stops the thread and writes the final snapshot. Safe to call more
+        than once.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+    def write(self):
+        """
+        Takes a snapshot and writes it, if any room changed since the last one.
+        """
+        # The thread and 'stop' may both get here; one write at a time
+        with self._lock:
+            try:
+                with SNAPSHOT_WRITE_SECONDS.time():
+                    snapshot = take_snapshot(self.room_registry)
+                    if snapshot['rooms'] == self._last_rooms:
+                        return
+                    write_snapshot(self.path, snapshot)
+                self._last_rooms = snapshot['rooms']
+            except OSError:
+                log.exception('snapshot_write_failed', path=self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
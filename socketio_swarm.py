@@ -0,0 +1,238 @@
+# socketio_swarm.py
+# This file is a load tool for the browser side of the server. It opens
+# thousands of SocketIO connections to one room (no real browser, just the
+# SocketIO protocol), like a hall full of spectators' phones, and measures
+# how the server's room broadcasts ('new_message', 'show_flash',
+# 'game_update', 'update_boards') reach all of them.
+#
+# While the swarm is connected it sends triggers from one simulated station
+# (and, with --start-game, plays a game so 'show_flash' and 'game_update' go
+# out too). For every broadcast it reports:
+#
+#   latency   trigger sent -> each client received 'new_message'
+#   spread    first client received -> last client received, per broadcast
+#   cpu       server CPU seconds per emitted event and per delivered message,
+#             read from the server's '/metrics' before and after
+#
+# The server must accept the simulated station (see 'simulate_stations.py'):
+#
+#   BOXBOTS_SIMULATED_STATIONS=1 python app.py
+#   python socketio_swarm.py --clients 2000 --rate 5 --duration 20
+#
+# Needs the asyncio SocketIO client:  pip install "python-socketio[asyncio_client]"
+# Thousands of sockets may also need a higher open-file limit (ulimit -n).
+
+import argparse # Command line options
+import asyncio  # Every client is a coroutine on one event loop
+import json     # Trigger bodies and the --json report
+import time     # Receive timestamps
+from urllib.parse import urlsplit # To split '--server' into host and port
+
+import socketio # python-socketio's AsyncClient
+
+from protocol import SIMULATED_CHIP_ID_BASE
+from simulate_stations import Station, http_request, summarize_latencies
+
+# The room broadcasts this tool listens for
+EVENTS = ('new_message', 'show_flash', 'game_update', 'update_boards')
+
+
+def parse_metrics(text):
+    """
+    Reads the Prometheus text from '/metrics' into { 'name{labels}': value }.
+    """
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            values[name] = float(value)
+    return values
+
+
+def emit_count(metrics):
+    """
+    The total number of SocketIO room emits in parsed '/metrics' values.
+    """
+    return sum(value for name, value in metrics.items() if name.startswith('boxbots_socketio_emit_seconds_count'))
+
+
+class Swarm:
+    """
+    Many SocketIO clients in one room, plus the station that makes the
+    server broadcast to them.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        url = urlsplit(options.server)
+        self.host = url.hostname or '127.0.0.1'
+        self.port = url.port or 80
+        self.station = Station(SIMULATED_CHIP_ID_BASE, options.room)
+        self.clients = []
+
+        # { (event, key): [receive times] }. Each client receives a room's
+        # broadcasts in order, so the k-th 'show_flash' on every client is
+        # the same broadcast; 'new_message' is keyed by the trigger's seq.
+        self.received = {}
+        # { seq: time the trigger was sent }
+        self.sent_at = {}
+
+    async def connect_one(self, limit):
+        client = socketio.AsyncClient(reconnection=False)
+        counts = {event: 0 for event in EVENTS}
+
+        def listen(event):
+            async def handler(data=None):
+                now = time.perf_counter()
+                if event == 'new_message':
+                    key = data.get('seq')
+                else:
+                    key = counts[event]
+                    counts[event] += 1
+                self.received.setdefault((event, key), []).append(now)
+            client.on(event, handler)
+
+        for event in EVENTS:
+            listen(event)
+
+        async with limit:
+            await client.connect(f"{self.options.server}?room={self.options.room}", transports=['websocket'])
+        self.clients.append(client)
+
+    async def fetch_metrics(self):
+        status, body = await http_request(self.host, self.port, 'GET', '/metrics')
+        if status != 200:
+            raise RuntimeError(f"GET /metrics answered {status}")
+        return parse_metrics(body.decode('utf-8'))
+
+    async def send_trigger(self, distance):
+        body = self.station.build_json(distance)
+        if distance > 0.0:
+            self.sent_at[self.station.seq] = time.perf_counter()
+        await http_request(self.host, self.port, 'POST', '/data', body)
+
+    async def run(self):
+        options = self.options
+
+        # Register the station first, so its square exists for every client
+        await self.send_trigger(0.0)
+
+        limit = asyncio.Semaphore(options.connect_concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.connect_one(limit) for _ in range(options.clients)))
+        connect_seconds = time.perf_counter() - started
+        # Only measure what happens from here on
+        self.received.clear()
+
+        before = await self.fetch_metrics()
+        cpu_started = time.perf_counter()
+
+        if options.start_game:
+            await self.clients[0].emit('start_game', {'room': options.room})
+
+        # Send triggers at a steady rate
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + options.duration
+        triggers = []
+        if options.rate > 0:
+            next_at = loop.time()
+            while next_at < deadline:
+                await asyncio.sleep(max(0.0, next_at - loop.time()))
+                triggers.append(asyncio.ensure_future(self.send_trigger(10.0)))
+                next_at += 1.0 / options.rate
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+        await asyncio.gather(*triggers)
+        # Let the last broadcasts reach every client
+        await asyncio.sleep(options.drain)
+
+        after = await self.fetch_metrics()
+        wall_seconds = time.perf_counter() - cpu_started
+
+        await asyncio.gather(*(client.disconnect() for client in self.clients))
+        return self.report(before, after, connect_seconds, wall_seconds)
+
+    def report(self, before, after, connect_seconds, wall_seconds):
+        clients = len(self.clients)
+        report = {
+            'clients': clients,
+            'connect_s': round(connect_seconds, 3),
+            'duration_s': round(wall_seconds, 3),
+            'events': {},
+        }
+
+        total_broadcasts = 0
+        total_deliveries = 0
+        for event in EVENTS:
+            broadcasts = [(key, times) for (name, key), times in self.received.items() if name == event]
+            if not broadcasts:
+                continue
+            deliveries = sum(len(times) for _, times in broadcasts)
+            spreads = [max(times) - min(times) for _, times in broadcasts]
+            summary = {
+                'broadcasts': len(broadcasts),
+                'delivered': deliveries,
+                'delivery_ratio': round(deliveries / (len(broadcasts) * clients), 4),
+                'spread': summarize_latencies(spreads),
+            }
+            if event == 'new_message':
+                latencies = [
+                    received - self.sent_at[key]
+                    for key, times in broadcasts if key in self.sent_at
+                    for received in times
+                ]
+                summary['latency'] = summarize_latencies(latencies)
+            report['events'][event] = summary
+            total_broadcasts += len(broadcasts)
+            total_deliveries += deliveries
+
+        # Server CPU, from the server's own counters
+        cpu = after.get('process_cpu_seconds_total', 0.0) - before.get('process_cpu_seconds_total', 0.0)
+        emits = emit_count(after) - emit_count(before)
+        report['server_cpu_s'] = round(cpu, 3)
+        report['server_cpu_percent'] = round(100.0 * cpu / wall_seconds, 1) if wall_seconds else None
+        report['server_emits'] = int(emits)
+        report['cpu_ms_per_emit'] = round(1000.0 * cpu / emits, 3) if emits else None
+        report['cpu_us_per_delivery'] = round(1e6 * cpu / total_deliveries, 3) if total_deliveries else None
+        report['broadcasts_seen'] = total_broadcasts
+        return report
+
+
+def print_report(report):
+    print(f"{report['clients']} clients connected in {report['connect_s']}s, measured for {report['duration_s']}s")
+    for event, summary in report['events'].items():
+        spread = summary['spread']
+        line = (f"  {event:<14} broadcasts={summary['broadcasts']} delivered={summary['delivered']} "
+                f"({summary['delivery_ratio'] * 100:.1f}%) spread p50={spread['p50_ms']}ms p99={spread['p99_ms']}ms")
+        if 'latency' in summary:
+            latency = summary['latency']
+            line += f" latency p50={latency['p50_ms']}ms p99={latency['p99_ms']}ms max={latency['max_ms']}ms"
+        print(line)
+    print(f"  server: {report['server_cpu_s']} CPU s ({report['server_cpu_percent']}%), "
+          f"{report['server_emits']} emits, {report['cpu_ms_per_emit']} ms CPU per emit, "
+          f"{report['cpu_us_per_delivery']} us CPU per delivered message")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure SocketIO fan-out with a swarm of headless clients.")
+    parser.add_argument('--server', default='http://127.0.0.1:5000', help="the server's base URL")
+    parser.add_argument('--clients', type=int, default=500, help="number of SocketIO clients")
+    parser.add_argument('--room', default='swarm', help="the room every client watches")
+    parser.add_argument('--connect-concurrency', type=int, default=50, help="clients connecting at once")
+    parser.add_argument('--rate', type=float, default=2.0, help="triggers per second (0 = none)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to send triggers for")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for the last broadcasts")
+    parser.add_argument('--start-game', action='store_true', help="also start a game in the room")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    options = parser.parse_args(argv)
+    if options.clients < 1:
+        parser.error("--clients must be at least 1")
+
+    report = asyncio.run(Swarm(options).run())
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
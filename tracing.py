@@ -0,0 +1,173 @@
+# tracing.py
+# This file contains end-to-end latency tracing for station triggers.
+#
+# Every trigger that flashes a square gets a trace ID. The server records a
+# timestamp at each step ("hop") the trigger goes through:
+#
+#   received      the server started handling it ('handle_trigger')
+#   processed     the room registered it and checked it as player input
+#   emitted       'new_message' was sent to the browsers
+#   browser_ack   a browser flashed the square and sent 'trace_ack' back
+#
+# The trace ID travels inside 'new_message', so the browser can send it back.
+# The station's own sequence number and clock ('seq', 'station_ms') are kept
+# as they were sent, so a trace can be matched to the station's serial log.
+#
+# Traces are kept in a fixed-size ring buffer (the oldest are forgotten
+# first) and can be queried on the '/traces' endpoint.
+
+import itertools # Gives every trace a unique, increasing ID
+import threading # Protects the ring buffer from concurrent requests
+import time      # For the high-resolution clock used by every hop
+from collections import OrderedDict # The ring buffer, in arrival order
+
+# How many traces are kept before the oldest ones are forgotten
+DEFAULT_TRACE_CAPACITY = 1024
+
+# A trace stops recording acks after this many, so a room watched by a
+# hundred browsers can't grow one trace without limit
+MAX_ACKS_PER_TRACE = 8
+
+
+class Trace:
+    """
+    The hops recorded for one trigger. Hop times are in milliseconds since
+    the trace was started, so they can be compared and subtracted directly.
+    """
+
+    def __init__(self, trace_id, chip_id, room_id, seq=None, station_ms=None):
+        self.trace_id = trace_id
+        self.chip_id = chip_id
+        self.room_id = room_id
+        # What the station sent (None for stations that don't send them)
+        self.seq = seq
+        self.station_ms = station_ms
+        # Wall-clock time the trace started, only for display
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        # [ (hop_name, milliseconds_since_start), ... ]
+        self.hops = [('received', 0.0)]
+        self.acks = 0
+        # The game's answer to this trigger, if it was checked as input
+        self.result = None
+
+    def hop(self, name):
+        """
+        Records that the trigger has reached the step 'name' just now.
+        """
+        self.hops.append((name, round((time.perf_counter() - self._start) * 1000.0, 3)))
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'chipId': self.chip_id,
+            'roomId': self.room_id,
+            'seq': self.seq,
+            'stationMs': self.station_ms,
+            'startedAt': self.started_at,
+            'result': self.result,
+            'hops': [{'hop': name, 'ms': ms} for name, ms in self.hops],
+        }
+
+
+class TraceBuffer:
+    """
+    A ring buffer of the most recent traces, looked up by trace ID.
+    """
+
+    def __init__(self, capacity=DEFAULT_TRACE_CAPACITY):
+        self.capacity = capacity
+        # { trace_id: Trace }, oldest first
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def start(self, chip_id, room_id, seq=None, station_ms=None):
+        """
+        Starts a new trace (its 'received' hop is now) and returns it.
+        """
+        with self._lock:
+            trace = Trace(f"{next(self._ids):x}", chip_id, room_id, seq, station_ms)
+            self._traces[trace.trace_id] = trace
+            if len(self._traces) > self.capacity:
+                # Forget the oldest trace
+                self._traces.popitem(last=False)
+        return trace
+
+    def get(self, trace_id):
+        """
+        Returns the Trace with this ID, or None if it was never recorded or
+        has already been pushed out of the buffer.
+        """
+        return self._traces.get(trace_id)
+
+    def ack(self, trace_id):
+        """
+        Records a browser's acknowledgement of a trace.
+        Returns False if the trace is unknown (or too old), True otherwise.
+        """
+        trace = self._traces.get(trace_id)
+        if trace is None:
+            return False
+        with self._lock:
+            if trace.acks >= MAX_ACKS_PER_TRACE:
+                return True
+            trace.acks += 1
+            trace.hop('browser_ack')
+        return True
+
+    def recent(self, limit=50, chip_id=None, room_id=None):
+        """
+        Returns up to 'limit' of the newest traces (newest first) as
+        dictionaries, optionally only for one chip and/or room. A 'limit'
+        of 0 or less returns none.
+        """
+        if limit <= 0:
+            return []
+        with self._lock:
+            traces = list(self._traces.values())
+
+        matches = []
+        for trace in reversed(traces):
+            if chip_id is not None and trace.chip_id != chip_id:
+                continue
+            if room_id is not None and trace.room_id != room_id:
+                continue
+            matches.append(trace.to_dict())
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def summary(self):
+        """
+        For every hop, how long after 'received' it happened across all
+        traces in the buffer: { hop: {"count", "p50_ms", "p95_ms", "max_ms"} }.
+        Only the first time each hop appears in a trace is counted (e.g.
+        the first browser ack).
+        """
+        with self._lock:
+            traces = list(self._traces.values())
+
+        # { hop_name: [ms, ms, ...] }
+        by_hop = {}
+        for trace in traces:
+            seen = set()
+            for name, ms in list(trace.hops):
+                if name not in seen:
+                    seen.add(name)
+                    by_hop.setdefault(name, []).append(ms)
+
+        summary = {}
+        for name, values in by_hop.items():
+            values.sort()
+            summary[name] = {
+                'count': len(values),
+                'p50_ms': values[len(values) // 2],
+                'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+                'max_ms': values[-1],
+            }
+        return summary
+
+
+# The trace buffer shared by the whole process
+trace_buffer = TraceBuffer()